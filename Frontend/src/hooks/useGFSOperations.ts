@@ -106,12 +106,29 @@ export function useGFSOperations() {
       .catch(error => console.error("Upload failed:", error));
   };
 
-  const handleListFiles = () => {
+  const handleListFiles = async () => {
     console.log("Listing files...");
-    fetch('http://localhost:7083/list_files', { method: 'GET' })
-      .then(response => response.json())
-      .then(data => handleServerResponse({ command: 'list_files_response', ...data }))
-      .catch(error => console.error("Failed to list files:", error));
+    // The gateway returns one page at a time; follow nextCursor until the listing is complete
+    const allFiles: any[] = [];
+    let cursor: string | null = null;
+    try {
+      do {
+        const url = cursor === null
+          ? 'http://localhost:7083/list_files'
+          : `http://localhost:7083/list_files?cursor=${encodeURIComponent(cursor)}`;
+        const response = await fetch(url, { method: 'GET' });
+        const data = await response.json();
+        if (data.status !== 'success') {
+          handleServerResponse({ command: 'list_files_response', ...data });
+          return;
+        }
+        allFiles.push(...data.files);
+        cursor = data.nextCursor ?? null;
+      } while (cursor !== null);
+      handleServerResponse({ command: 'list_files_response', status: 'success', files: allFiles });
+    } catch (error) {
+      console.error("Failed to list files:", error);
+    }
   };
 
 
@@ -6,6 +6,10 @@ import pickle
 import hashlib
 import logging
 import time
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # profiling.py is shared with the root servers
+import profiling
 
 logging.basicConfig(filename='chunk_server.log', level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
@@ -13,11 +17,12 @@ logging.basicConfig(filename='chunk_server.log', level=logging.INFO,
 HEARTBEAT_INTERVAL = 5
 
 class ChunkServer:
-    def __init__(self, host, port, myChunkDir, filesystem, master_hosts_ports):
+    def __init__(self, host, port, myChunkDir, filesystem, master_hosts_ports, tags=()):
         self.filesystem = filesystem
         self.myChunkDir = myChunkDir
         self.host = host
         self.port = port
+        self.tags = list(tags)  # Free-form labels (rack, disk type, ...) reported at registration
         self.chunkserver_info = []  # List of stored chunks
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -43,12 +48,21 @@ class ChunkServer:
         """Send periodic heartbeat messages to the MasterServer to indicate server activity."""
         while True:
             time.sleep(HEARTBEAT_INTERVAL)
-            for host, port in self.master_hosts_ports:
+            for host, port in list(self.master_hosts_ports):
                 try:
                     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
                         s.connect((host, port))
-                        heartbeat_message = {'command': 'heartbeat', 'port': self.port}
+                        heartbeat_message = {'command': 'heartbeat', 'host': self.host, 'port': self.port, 'tags': self.tags}
                         s.send(pickle.dumps(heartbeat_message))
+                        reply = s.recv(4096)  # The leader closes without replying; followers redirect
+                    if reply:
+                        response = pickle.loads(reply)
+                        if response.get('status') == 'redirect':
+                            # Try the leader first from now on
+                            leader = (response['leader_host'], response['leader_port'])
+                            self.master_hosts_ports = [leader] + [m for m in self.master_hosts_ports if m != leader]
+                        logging.warning("Heartbeat not accepted by %s:%d: %s", host, port, response.get('message', 'redirected'))
+                        continue
                     logging.info("Heartbeat sent to MasterServer at %s:%d from port %d", host, port, self.port)
                     break  # If successful, no need to try other masters
                 except Exception as e:
@@ -61,6 +75,7 @@ class ChunkServer:
 
     def handle_request(self, client, address):
         """Handle client and chunk server requests."""
+        profile = profiling.PROFILER.begin()
         try:
             request = pickle.loads(client.recv(4096))
             command = request.get('command')
@@ -79,16 +94,23 @@ class ChunkServer:
                 response = self.send_chunk(chunk_id, filename)
                 client.send(pickle.dumps(response))
 
+            elif command == 'profile':
+                client.sendall(pickle.dumps(profiling.PROFILER.handle(request)))
+
+            elif command == 'stacks':
+                client.sendall(pickle.dumps(profiling.thread_stacks()))
+
         except Exception as e:
             logging.error("Error handling request from %s: %s", address, e)
         finally:
+            profiling.PROFILER.end(profile)
             client.close()
 
     def store_chunk(self, chunk_id, filename, data, checksum):
         """Store chunk data from client, ensuring data integrity."""
         try:
-            os.makedirs(self.myChunkDir, exist_ok=True)
             path = os.path.join(self.myChunkDir, f"{filename}_{chunk_id}")
+            os.makedirs(os.path.dirname(path), exist_ok=True)  # Filenames may contain directories
 
             # Verify checksum
             if self.calculate_checksum(data) != checksum:
@@ -121,24 +143,21 @@ class ChunkServer:
             return {'status': 'error', 'message': str(e)}
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a chunk server that registers itself with the masters.")
+    parser.add_argument('port', type=int)
+    parser.add_argument('masters', nargs='+', help="master_host master_port pairs")
+    parser.add_argument('--host', default='localhost', help="address the server binds to and registers under")
+    parser.add_argument('--tags', default='', help="comma-separated labels reported to the masters")
+    args = parser.parse_args()
+    if len(args.masters) % 2 != 0:
+        print("Invalid number of arguments for masters.")
+        sys.exit(1)
     try:
-        port_num = int(sys.argv[1])
-        if len(sys.argv) < 3:
-            print("Usage: python chunk_server.py <port> [master_host master_port] ...")
-            sys.exit(1)
-
-        master_hosts_ports = []
-        if (len(sys.argv) - 2) % 2 != 0:
-            print("Invalid number of arguments for masters.")
-            sys.exit(1)
-        for i in range(2, len(sys.argv), 2):
-            master_host = sys.argv[i]
-            master_port = int(sys.argv[i + 1])
-            master_hosts_ports.append((master_host, master_port))
-
-        filesystem = os.path.join(os.getcwd(), f"chunk_server_{port_num}")
-        chunk_server = ChunkServer('localhost', port_num, filesystem, filesystem, master_hosts_ports)
-        logging.info("Starting Chunk Server on port %d", port_num)
+        master_hosts_ports = [(host, int(port)) for host, port in zip(args.masters[::2], args.masters[1::2])]
+        filesystem = os.path.join(os.getcwd(), f"chunk_server_{args.port}")
+        chunk_server = ChunkServer(args.host, args.port, filesystem, filesystem, master_hosts_ports,
+                                   [tag for tag in args.tags.split(',') if tag])
+        logging.info("Starting Chunk Server %s:%d", args.host, args.port)
         chunk_server.start()
     except Exception as e:
         logging.critical("Failed to start chunk server: %s", e)
@@ -7,10 +7,17 @@ import logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 CHUNK_SIZE = 2048  # Consistent with the chunk size used in Master and ChunkServer
+LIST_PAGE_SIZE = 1000  # Entries fetched per list_files round-trip
+
+def server_address(server):
+    """Split a chunk server ID ('host:port', as registered with the masters) into a (host, port) address."""
+    host, port = server.rsplit(':', 1)
+    return host, int(port)
 
 class Client:
     def __init__(self, master_hosts_ports):
         self.master_hosts_ports = master_hosts_ports  # List of (host, port) tuples
+        self.lease_ids = {}  # Lease IDs of files this client holds, used to renew them
 
     def calculate_checksum(self, data):
         """Calculate the checksum of data for integrity checks."""
@@ -69,27 +76,27 @@ class Client:
                 data = f.read(CHUNK_SIZE)
                 checksum = self.calculate_checksum(data)
 
-                for server_port in servers:
-                    self.send_chunk(server_port, filename, chunk_id, data, checksum)
+                for server in servers:
+                    self.send_chunk(server, filename, chunk_id, data, checksum)
 
-    def send_chunk(self, server_port, filename, chunk_id, data, checksum):
+    def send_chunk(self, server, filename, chunk_id, data, checksum):
         """Send a single chunk to a ChunkServer."""
         try:
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect(('localhost', server_port))
+                s.connect(server_address(server))
                 chunk_request = {'command': 'store', 'filename': filename, 'chunk_id': chunk_id, 'data': data, 'checksum': checksum}
                 s.send(pickle.dumps(chunk_request))
                 response = pickle.loads(s.recv(4096))
 
                 if response.get('status') == 'success':
-                    logging.info("Successfully stored chunk %s on server %d", chunk_id, server_port)
+                    logging.info("Successfully stored chunk %s on server %s", chunk_id, server)
                 else:
-                    logging.error("Failed to store chunk %s on server %d: %s", chunk_id, server_port, response.get('message'))
+                    logging.error("Failed to store chunk %s on server %s: %s", chunk_id, server, response.get('message'))
         except Exception as e:
-            logging.error("Error sending chunk %s to server %d: %s", chunk_id, server_port, e)
+            logging.error("Error sending chunk %s to server %s: %s", chunk_id, server, e)
 
-    def download_file(self, filename):
-        """Download a file from the distributed file system."""
+    def download_file(self, filename, output=None):
+        """Download a file from the distributed file system into output (default downloaded_<filename>)."""
         while True:
             master_sock = self.connect_to_master()
             if not master_sock:
@@ -120,7 +127,8 @@ class Client:
             return
 
         # Reconstruct the file by downloading each chunk
-        with open(f"downloaded_{filename}", 'wb') as f:
+        output = output or f"downloaded_{filename}"
+        with open(output, 'wb') as f:
             sorted_chunks = sorted(chunk_locations.items(), key=lambda x: int(x[0].split('_')[-1]))
             for chunk_id, servers in sorted_chunks:
                 data = self.retrieve_chunk(servers, filename, chunk_id)
@@ -130,14 +138,14 @@ class Client:
                     logging.error("Failed to retrieve chunk %s for file %s", chunk_id, filename)
                     return
 
-        logging.info("File %s downloaded successfully as downloaded_%s", filename, filename)
+        logging.info("File %s downloaded successfully as %s", filename, output)
 
     def retrieve_chunk(self, servers, filename, chunk_id):
         """Retrieve a chunk from available servers and verify its checksum."""
-        for server_port in servers:
+        for server in servers:
             try:
                 with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    s.connect(('localhost', server_port))
+                    s.connect(server_address(server))
                     download_request = {'command': 'download', 'filename': filename, 'chunk_id': chunk_id}
                     s.send(pickle.dumps(download_request))
                     response = pickle.loads(s.recv(4096))
@@ -146,44 +154,55 @@ class Client:
                     data = response['data']
                     checksum = response['checksum']
                     if self.calculate_checksum(data) == checksum:
-                        logging.info("Successfully retrieved and verified chunk %s from server %d", chunk_id, server_port)
+                        logging.info("Successfully retrieved and verified chunk %s from server %s", chunk_id, server)
                         return data
                     else:
-                        logging.warning("Checksum mismatch for chunk %s from server %d, trying next server", chunk_id, server_port)
+                        logging.warning("Checksum mismatch for chunk %s from server %s, trying next server", chunk_id, server)
                 else:
-                    logging.warning("Failed to retrieve chunk %s from server %d: %s", chunk_id, server_port, response.get('message'))
+                    logging.warning("Failed to retrieve chunk %s from server %s: %s", chunk_id, server, response.get('message'))
             except Exception as e:
-                logging.error("Failed to retrieve chunk %s from server %d: %s", chunk_id, server_port, e)
+                logging.error("Failed to retrieve chunk %s from server %s: %s", chunk_id, server, e)
 
         return None
 
-    def list_files(self):
-        """Request a list of files from the MasterServer."""
+    def iter_files(self, prefix='', delimiter=None, page_size=LIST_PAGE_SIZE):
+        """Yield file and directory entries under prefix, fetching one page at a time."""
+        cursor = None
         while True:
             master_sock = self.connect_to_master()
             if not master_sock:
                 return
 
-            list_request = {'command': 'list_files'}
-            master_sock.send(pickle.dumps(list_request))
-            response = pickle.loads(master_sock.recv(4096))
+            list_request = {'command': 'list_files', 'prefix': prefix, 'delimiter': delimiter,
+                            'cursor': cursor, 'limit': page_size}
+            master_sock.sendall(pickle.dumps(list_request))
+            response = pickle.load(master_sock.makefile('rb'))
+            master_sock.close()
 
-            if isinstance(response, list):
-                logging.info("Files available on the server:")
-                for file in response:
-                    print(file)
-                master_sock.close()
-                break
-            elif response.get('status') == 'redirect':
-                master_sock.close()
+            if response.get('status') == 'redirect':
                 leader_host = response.get('leader_host')
                 leader_port = response.get('leader_port')
                 self.master_hosts_ports = [(leader_host, leader_port)]
                 continue
-            else:
+            elif response.get('status') != 'success':
                 logging.error("Failed to retrieve file list: %s", response.get('message'))
-                master_sock.close()
-                break
+                return
+
+            for directory in response['dirs']:
+                yield {'name': directory, 'dir': True}
+            yield from response['files']
+            cursor = response['next_cursor']
+            if cursor is None:
+                return
+
+    def list_files(self, prefix='', delimiter=None):
+        """Print the files (and, with a delimiter, sub-directories) stored under prefix."""
+        logging.info("Files available on the server:")
+        for entry in self.iter_files(prefix, delimiter):
+            if entry.get('dir'):
+                print(entry['name'])
+            else:
+                print(f"{entry['name']}\t{entry['size']} bytes")
 
     def lease_file(self, filename):
         """Request an exclusive lease on a file."""
@@ -203,6 +222,7 @@ class Client:
                 self.master_hosts_ports = [(leader_host, leader_port)]
                 continue
             elif response.get('status') == 'success':
+                self.lease_ids[filename] = response.get('lease_id')
                 logging.info("Lease granted for file %s", filename)
                 master_sock.close()
                 break
@@ -211,6 +231,36 @@ class Client:
                 master_sock.close()
                 break
 
+    def renew_lease(self, filename):
+        """Extend a lease previously granted to this client."""
+        if filename not in self.lease_ids:
+            logging.warning("No lease held on file %s", filename)
+            return
+        while True:
+            master_sock = self.connect_to_master()
+            if not master_sock:
+                return
+
+            renew_request = {'command': 'renew_lease', 'filename': filename, 'lease_id': self.lease_ids[filename]}
+            master_sock.send(pickle.dumps(renew_request))
+            response = pickle.loads(master_sock.recv(4096))
+
+            if response.get('status') == 'redirect':
+                master_sock.close()
+                leader_host = response.get('leader_host')
+                leader_port = response.get('leader_port')
+                self.master_hosts_ports = [(leader_host, leader_port)]
+                continue
+            elif response.get('status') == 'success':
+                logging.info("Lease renewed for file %s", filename)
+                master_sock.close()
+                break
+            else:
+                self.lease_ids.pop(filename, None)
+                logging.warning("Lease renewal failed for file %s: %s", filename, response.get('message'))
+                master_sock.close()
+                break
+
     def unlease_file(self, filename):
         """Release the exclusive lease on a file."""
         while True:
@@ -258,7 +308,8 @@ class Client:
                 filename = input("Enter the filename to download: ").strip()
                 self.download_file(filename)
             elif choice == '3':
-                self.list_files()
+                prefix = input("Enter a directory prefix (blank for all files): ").strip()
+                self.list_files(prefix, '/' if prefix.endswith('/') else None)
             elif choice == '4':
                 filename = input("Enter the filename to lease: ").strip()
                 self.lease_file(filename)
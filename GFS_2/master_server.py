@@ -7,21 +7,161 @@ import time
 import logging
 import math
 import os
+import bisect
+import heapq
+import uuid
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # metrics.py and profiling.py are shared with the root servers
+import metrics
+import profiling
 
 logging.basicConfig(filename='master_server.log', level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
-CHUNK_PORTS = [6467, 6468, 6469, 6470]
 REPLICATION_FACTOR = 2
 HEARTBEAT_INTERVAL = 5
+SERVER_TIMEOUT = 3 * HEARTBEAT_INTERVAL  # Seconds without a heartbeat before a chunk server is declared failed
+METRICS_OFFSET = 2000  # Metrics endpoint of each master: http://<host>:<port + offset>/metrics
+
+REQUESTS = metrics.REGISTRY.counter('gfs_master_requests_total', "Requests handled, by command", ['command'])
+REQUEST_ERRORS = metrics.REGISTRY.counter('gfs_master_request_errors_total', "Requests that failed with an exception, by command", ['command'])
+REQUEST_SECONDS = metrics.REGISTRY.histogram('gfs_master_request_seconds', "Request handling time, by command", ['command'])
+RAFT_COMMIT_SECONDS = metrics.REGISTRY.histogram('gfs_master_raft_commit_seconds', "Time to commit a Raft log entry, by entry type", ['cmd'])
 LEASE_DURATION = 30  # Lease duration in seconds
+LEASE_RETRY_INTERVAL = 1  # Seconds before a follower, or a leader whose expiry commit failed, checks due leases again
+LIST_PAGE_SIZE = 1000  # Default and maximum entries per list_files page
+
+class NamespaceIndex:
+    """Sorted index of file paths supporting prefix, directory and cursor-paginated listing.
+
+    Paths are kept in a list of sorted buckets (the layout used by sortedcontainers), so
+    inserts and removals cost O(sqrt(n)) and a listing page costs O(log n + page size)
+    regardless of how many files the namespace holds.
+    """
+
+    BUCKET_SIZE = 1000
+
+    def __init__(self):
+        self.buckets = []  # Sorted, non-empty lists of paths
+        self.maxes = []  # Last path of each bucket, for bisecting to the right bucket
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, path):
+        pos = bisect.bisect_left(self.maxes, path)
+        if pos == len(self.maxes):
+            return False
+        bucket = self.buckets[pos]
+        i = bisect.bisect_left(bucket, path)
+        return i < len(bucket) and bucket[i] == path
+
+    def add(self, path):
+        """Insert path into the index; returns False if it was already present."""
+        if not self.maxes:
+            self.buckets.append([path])
+            self.maxes.append(path)
+            self.size += 1
+            return True
+
+        pos = bisect.bisect_left(self.maxes, path)
+        if pos == len(self.maxes):
+            pos -= 1
+            self.buckets[pos].append(path)
+            self.maxes[pos] = path
+        else:
+            bucket = self.buckets[pos]
+            i = bisect.bisect_left(bucket, path)
+            if bucket[i] == path:
+                return False
+            bucket.insert(i, path)
+
+        bucket = self.buckets[pos]
+        if len(bucket) > 2 * self.BUCKET_SIZE:
+            self.buckets[pos:pos + 1] = [bucket[:self.BUCKET_SIZE], bucket[self.BUCKET_SIZE:]]
+            self.maxes[pos:pos + 1] = [bucket[self.BUCKET_SIZE - 1], bucket[-1]]
+        self.size += 1
+        return True
+
+    def remove(self, path):
+        """Remove path from the index; returns False if it was not present."""
+        pos = bisect.bisect_left(self.maxes, path)
+        if pos == len(self.maxes):
+            return False
+        bucket = self.buckets[pos]
+        i = bisect.bisect_left(bucket, path)
+        if i == len(bucket) or bucket[i] != path:
+            return False
+        del bucket[i]
+        if bucket:
+            self.maxes[pos] = bucket[-1]
+        else:
+            del self.buckets[pos]
+            del self.maxes[pos]
+        self.size -= 1
+        return True
+
+    def iter_from(self, key):
+        """Yield indexed paths >= key in sorted order."""
+        pos = bisect.bisect_left(self.maxes, key)
+        if pos == len(self.maxes):
+            return
+        yield from self.buckets[pos][bisect.bisect_left(self.buckets[pos], key):]
+        for j in range(pos + 1, len(self.buckets)):
+            yield from self.buckets[j]
+
+    def list(self, prefix='', delimiter=None, cursor=None, limit=100):
+        """Return (files, dirs, next_cursor) for one page of paths under prefix.
+
+        With a delimiter, paths that continue past the next delimiter are rolled up into a
+        single "directory" entry (e.g. 'logs/2024/') and the whole subtree is skipped.
+        Pass the returned next_cursor back to continue; it is None on the last page. The cursor
+        is the last entry returned, tagged 'f' for a file or 'd' for a directory, since a file
+        name may end with the delimiter too.
+        """
+        files, dirs = [], []
+        start = prefix
+        if cursor and cursor[1:] >= prefix:
+            # Resume after the cursor; a directory cursor resumes after its whole subtree
+            after = cursor[1:]
+            start = after + '\0'
+            if cursor[0] == 'd' and delimiter and after.endswith(delimiter):
+                start = after[:-len(delimiter)] + chr(ord(delimiter[0]) + 1)
+
+        last = None
+        while True:
+            restart = None
+            for path in self.iter_from(start):
+                if not path.startswith(prefix):
+                    return files, dirs, None
+                if len(files) + len(dirs) >= limit:
+                    return files, dirs, last
+                if delimiter:
+                    cut = path.find(delimiter, len(prefix))
+                    if cut >= 0:
+                        directory = path[:cut + len(delimiter)]
+                        dirs.append(directory)
+                        last = 'd' + directory
+                        restart = path[:cut] + chr(ord(delimiter[0]) + 1)
+                        break
+                files.append(path)
+                last = 'f' + path
+            if restart is None:
+                return files, dirs, None
+            start = restart
 
 class MasterStateMachine:
     def __init__(self):
         self.chunksize = 2048
         self.file_map = {}  # Maps filenames to their chunk information
+        self.file_sizes = {}  # Maps filenames to their size in bytes
+        self.namespace = NamespaceIndex()  # Sorted index of filenames for prefix/directory listing
         self.chunk_locations = {}  # Maps chunk IDs to their respective chunk servers
-        self.leases = {}  # Tracks leases: {'filename': {'expires': <time>, 'client': <client_address>}}
+        self.leases = {}  # Tracks leases: {'filename': {'expires': <time>, 'client': <client_address>, 'lease_id': <id>}}
+        self.lease_deadlines = []  # Heap of (expires, filename) fed by applied lease entries
+        self.lease_cond = threading.Condition()  # Wakes the leader's expiry timer on new deadlines
 
     async def apply(self, command):
         """Apply committed log entries to the state machine."""
@@ -30,14 +170,25 @@ class MasterStateMachine:
             filename = command['filename']
             chunk_ids = command['chunk_ids']
             self.file_map[filename] = chunk_ids
+            self.file_sizes[filename] = command.get('file_size', 0)
+            self.namespace.add(filename)
         elif cmd == 'lease_file':
             filename = command['filename']
             lease_info = command['lease_info']
             self.leases[filename] = lease_info
+            with self.lease_cond:
+                heapq.heappush(self.lease_deadlines, (lease_info['expires'], filename))
+                self.lease_cond.notify()
         elif cmd == 'unlease_file':
             filename = command['filename']
             if filename in self.leases:
                 del self.leases[filename]
+        elif cmd == 'expire_leases':
+            # One entry expires every lease that was due when the leader proposed it
+            for filename, expires in command['leases']:
+                lease = self.leases.get(filename)
+                if lease is not None and lease['expires'] == expires:
+                    del self.leases[filename]
         # Handle other commands as needed
 
 class MasterServer:
@@ -48,8 +199,9 @@ class MasterServer:
 
         self.state_machine = MasterStateMachine()
 
-        self.chunk_servers_info = {p: [] for p in CHUNK_PORTS}  # Tracks chunks held by each server
-        self.active_servers = set()  # Set of active chunk servers for quick access
+        self.servers = {}  # Membership table: {'host:port': {'host', 'port', 'tags', 'registered', 'last_seen'}}
+        self.chunk_servers_info = {}  # Tracks chunks held by each registered server
+        self.active_servers = set()  # Registered servers whose heartbeats are current
 
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -80,6 +232,13 @@ class MasterServer:
         """Run the TCP server to handle client requests."""
         self.sock.listen(5)
         logging.info("Master Server started, listening for connections.")
+        metrics.REGISTRY.gauge('gfs_master_is_leader', "1 on the current Raft leader", lambda: int(self.is_leader()))
+        metrics.REGISTRY.gauge('gfs_master_chunk_servers', "Registered chunk servers, by state",
+                               lambda: {('active',): len(self.active_servers),
+                                        ('failed',): len(self.servers) - len(self.active_servers)}, ['state'])
+        metrics.REGISTRY.gauge('gfs_master_files', "Files in the namespace", lambda: len(self.state_machine.file_map))
+        metrics.REGISTRY.gauge('gfs_master_leases', "File leases currently held", lambda: len(self.state_machine.leases))
+        metrics.start_http_server(self.port + METRICS_OFFSET, self.host)
 
         threading.Thread(target=self.heartbeat, daemon=True).start()
         threading.Thread(target=self.check_replication_integrity, daemon=True).start()
@@ -90,6 +249,12 @@ class MasterServer:
             client, address = await loop.run_in_executor(None, self.sock.accept)
             threading.Thread(target=self.handle_client, args=(client, address), daemon=True).start()
 
+    async def commit(self, entry):
+        """Commit an entry to the Raft log, recording how long consensus took."""
+        start = time.perf_counter()
+        await raftos.commit(entry)
+        RAFT_COMMIT_SECONDS.labels(entry['cmd']).observe(time.perf_counter() - start)
+
     def num_chunks(self, size):
         return math.ceil(size / self.state_machine.chunksize)
 
@@ -107,10 +272,20 @@ class MasterServer:
 
     def handle_client(self, client, address):
         """Handle incoming client requests."""
+        start = time.perf_counter()
+        command = None
+        profile = profiling.PROFILER.begin()
         try:
             request = pickle.loads(client.recv(4096))
             command = request.get('command')
 
+            if command in ('profile', 'stacks'):
+                # Diagnostics are about this node, so followers answer them too
+                response = profiling.PROFILER.handle(request) if command == 'profile' else profiling.thread_stacks()
+                client.sendall(pickle.dumps(response))
+                client.close()
+                return
+
             if not self.is_leader():
                 # Redirect client to leader
                 leader_host, leader_port = self.get_leader_address()
@@ -137,8 +312,9 @@ class MasterServer:
                 client.send(pickle.dumps(response))
 
             elif command == 'list_files':
-                response = list(self.state_machine.file_map.keys())
-                client.send(pickle.dumps(response))
+                response = self.list_files(request.get('prefix', ''), request.get('delimiter'),
+                                           request.get('cursor'), request.get('limit', LIST_PAGE_SIZE))
+                client.sendall(pickle.dumps(response))
 
             elif command == 'lease':
                 filename = request['filename']
@@ -149,6 +325,13 @@ class MasterServer:
                 client.send(pickle.dumps(response))
                 loop.close()
 
+            elif command == 'renew_lease':
+                loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(loop)
+                response = loop.run_until_complete(self.renew_lease(request['filename'], request['lease_id']))
+                client.send(pickle.dumps(response))
+                loop.close()
+
             elif command == 'unlease':
                 filename = request['filename']
                 loop = asyncio.new_event_loop()
@@ -158,14 +341,26 @@ class MasterServer:
                 loop.close()
 
             elif command == 'heartbeat':
-                port = request['port']
-                self.update_server_status(port)
+                self.update_server_status(request['host'], request['port'], request.get('tags', ()))
                 # No response needed
 
+            elif command == 'list_servers':
+                servers = {server: dict(info, active=server in self.active_servers) for server, info in self.servers.items()}
+                client.send(pickle.dumps({'status': 'success', 'servers': servers}))
+
+            elif command == 'metrics':
+                client.sendall(pickle.dumps({'status': 'success', 'metrics': metrics.REGISTRY.render()}))
+
             client.close()
         except Exception as e:
+            REQUEST_ERRORS.labels(str(command)).inc()
             logging.error("Error handling client request from %s: %s", address, e)
             client.close()
+        finally:
+            profiling.PROFILER.end(profile)
+            if command is not None:
+                REQUESTS.labels(command).inc()
+                REQUEST_SECONDS.labels(command).observe(time.perf_counter() - start)
 
     async def handle_upload(self, filename, file_size):
         """Handle file upload requests by allocating chunks and assigning servers."""
@@ -175,7 +370,7 @@ class MasterServer:
         num_chunks = self.num_chunks(file_size)
         chunk_ids = [f"{filename}_chunk_{i}" for i in range(num_chunks)]
         # Update state via Raft log
-        await raftos.commit({'cmd': 'add_file', 'filename': filename, 'chunk_ids': chunk_ids})
+        await self.commit({'cmd': 'add_file', 'filename': filename, 'chunk_ids': chunk_ids, 'file_size': file_size})
 
         # Allocate chunks to servers
         chunk_allocation = self.allocate_chunks(chunk_ids)
@@ -189,6 +384,13 @@ class MasterServer:
         chunk_locations = {chunk_id: self.state_machine.chunk_locations.get(chunk_id, []) for chunk_id in self.state_machine.file_map[filename]}
         return {'status': 'success', 'chunk_locations': chunk_locations}
 
+    def list_files(self, prefix, delimiter, cursor, limit):
+        """Return one page of files (with sizes) and sub-directories under prefix."""
+        limit = max(1, min(limit, LIST_PAGE_SIZE))
+        names, dirs, next_cursor = self.state_machine.namespace.list(prefix, delimiter, cursor, limit)
+        files = [{'name': name, 'size': self.state_machine.file_sizes.get(name, 0)} for name in names]
+        return {'status': 'success', 'files': files, 'dirs': dirs, 'next_cursor': next_cursor}
+
     async def lease_file(self, filename, client_address):
         """Lease a file to a client for exclusive write access."""
         current_time = time.time()
@@ -198,33 +400,71 @@ class MasterServer:
         # Grant lease and set expiration time
         lease_info = {
             'expires': current_time + LEASE_DURATION,
-            'client': client_address
+            'client': client_address,
+            'lease_id': uuid.uuid4().hex
         }
-        await raftos.commit({'cmd': 'lease_file', 'filename': filename, 'lease_info': lease_info})
+        await self.commit({'cmd': 'lease_file', 'filename': filename, 'lease_info': lease_info})
         logging.info("Leased file %s to client %s for %d seconds", filename, client_address, LEASE_DURATION)
-        return {'status': 'success', 'message': f'File {filename} leased for {LEASE_DURATION} seconds.'}
+        return {'status': 'success', 'message': f'File {filename} leased for {LEASE_DURATION} seconds.',
+                'lease_id': lease_info['lease_id'], 'expires': lease_info['expires']}
+
+    async def renew_lease(self, filename, lease_id):
+        """Extend a live lease for the client holding lease_id."""
+        lease = self.state_machine.leases.get(filename)
+        if lease is None or lease['expires'] <= time.time() or lease['lease_id'] != lease_id:
+            return {'status': 'error', 'message': f'File {filename} is not leased under this lease ID.'}
+
+        lease_info = dict(lease, expires=time.time() + LEASE_DURATION)
+        await self.commit({'cmd': 'lease_file', 'filename': filename, 'lease_info': lease_info})
+        return {'status': 'success', 'message': f'Lease on {filename} extended for {LEASE_DURATION} seconds.',
+                'lease_id': lease_id, 'expires': lease_info['expires']}
 
     async def unlease_file(self, filename):
         """Release a lease on a file, allowing other clients to access it."""
         if filename in self.state_machine.leases:
-            await raftos.commit({'cmd': 'unlease_file', 'filename': filename})
+            await self.commit({'cmd': 'unlease_file', 'filename': filename})
             logging.info("Unleased file %s", filename)
             return {'status': 'success', 'message': f'File {filename} has been unleased.'}
         else:
             return {'status': 'error', 'message': f'File {filename} was not leased.'}
 
     def lease_expiration_checker(self):
-        """Periodically check and expire leases that have timed out."""
+        """Sleep until the earliest lease deadline and expire all due leases in one Raft commit.
+
+        Deadlines are pushed by the state machine as lease entries are applied, so a node that
+        becomes leader already knows every outstanding deadline: followers leave due deadlines
+        in the heap, and a failed commit puts them back. Heap entries left behind by renewals
+        or releases are dropped when they no longer match the applied lease.
+        """
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        sm = self.state_machine
         while True:
-            time.sleep(5)  # Check every 5 seconds
-            current_time = time.time()
-            expired_leases = [file for file, lease in self.state_machine.leases.items() if lease['expires'] < current_time]
-            for filename in expired_leases:
-                # Since this modifies state, it needs to be committed via Raft
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                loop.run_until_complete(raftos.commit({'cmd': 'unlease_file', 'filename': filename}))
-                loop.close()
+            with sm.lease_cond:
+                while not sm.lease_deadlines or sm.lease_deadlines[0][0] > time.time():
+                    sm.lease_cond.wait(sm.lease_deadlines[0][0] - time.time() if sm.lease_deadlines else None)
+                if not self.is_leader():
+                    sm.lease_cond.wait(LEASE_RETRY_INTERVAL)
+                    continue
+                now = time.time()
+                due = []
+                while sm.lease_deadlines and sm.lease_deadlines[0][0] <= now:
+                    due.append(heapq.heappop(sm.lease_deadlines))
+
+            expired = [(filename, expires) for expires, filename in due
+                       if sm.leases.get(filename, {}).get('expires') == expires]
+            if not expired:
+                continue
+            try:
+                loop.run_until_complete(self.commit({'cmd': 'expire_leases', 'leases': expired}))
+            except Exception as e:
+                logging.error("Failed to commit the expiry of %d leases, retrying: %s", len(expired), e)
+                with sm.lease_cond:
+                    for entry in due:
+                        heapq.heappush(sm.lease_deadlines, entry)
+                time.sleep(LEASE_RETRY_INTERVAL)
+                continue
+            for filename, _ in expired:
                 logging.info("Lease expired for file %s", filename)
 
     def allocate_chunks(self, chunk_ids):
@@ -255,32 +495,39 @@ class MasterServer:
 
         return selected_servers
 
-    def update_server_status(self, port):
-        """Update active server list based on heartbeat signals."""
-        if port not in self.active_servers:
-            self.active_servers.add(port)
-            logging.info("Server on port %d is now active", port)
+    def update_server_status(self, host, port, tags=()):
+        """Register a chunk server on its first heartbeat and refresh its liveness."""
+        server = f"{host}:{port}"
+        info = self.servers.get(server)
+        if info is None:
+            self.chunk_servers_info[server] = []
+            logging.info("Registered chunk server %s (tags %s)", server, list(tags))
+        self.servers[server] = {'host': host, 'port': port, 'tags': list(tags),
+                                'registered': info['registered'] if info else time.time(), 'last_seen': time.time()}
+        if server not in self.active_servers:
+            self.active_servers.add(server)
+            logging.info("Chunk server %s is now active", server)
 
     def heartbeat(self):
-        """Check active status of all chunk servers periodically."""
+        """Declare chunk servers failed once their last heartbeat is older than SERVER_TIMEOUT."""
         logging.info("Heartbeat check initiated.")
         while True:
             time.sleep(HEARTBEAT_INTERVAL)
-            inactive_servers = set(CHUNK_PORTS) - self.active_servers
-            for port in inactive_servers:
-                self.handle_server_failure(port)
-            self.active_servers.clear()  # Reset active status for next interval
+            deadline = time.time() - SERVER_TIMEOUT
+            for server in [s for s in list(self.active_servers) if self.servers[s]['last_seen'] < deadline]:
+                self.active_servers.discard(server)
+                self.handle_server_failure(server)
 
-    def handle_server_failure(self, port):
+    def handle_server_failure(self, server):
         """Handle chunk server failure by reallocating chunks."""
-        logging.warning("Chunk server on port %d has failed", port)
-        if port in self.chunk_servers_info:
-            for chunk_id in self.chunk_servers_info[port]:
+        logging.warning("Chunk server %s has failed", server)
+        if server in self.chunk_servers_info:
+            for chunk_id in self.chunk_servers_info[server]:
                 # Reallocate the failed chunk to another active server
-                self.reallocate_chunk(chunk_id, port)
+                self.reallocate_chunk(chunk_id, server)
 
             # Clear failed server's data
-            self.chunk_servers_info[port] = []
+            self.chunk_servers_info[server] = []
 
     def reallocate_chunk(self, chunk_id, failed_server):
         """Reallocate chunk replicas when a server goes down."""
@@ -296,7 +543,7 @@ class MasterServer:
                     new_server = new_servers[0]
                     self.state_machine.chunk_locations[chunk_id].append(new_server)
                     self.chunk_servers_info[new_server].append(chunk_id)
-                    logging.info("Reallocated chunk %s to server on port %d", chunk_id, new_server)
+                    logging.info("Reallocated chunk %s to server %s", chunk_id, new_server)
                 else:
                     logging.warning("No available servers to reallocate chunk %s", chunk_id)
 
@@ -0,0 +1,539 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import pickle
+import hashlib
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+import importlib.util
+import tracing
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+READY_TIMEOUT = 60  # Seconds to wait for every chunk server to register with the master
+RPC_TIMEOUT = 30  # Socket timeout of the benchmark clients
+WORKLOADS = ['sequential', 'small_files', 'small_files_batched', 'zipf_reads', 'metadata', 'writes', 'compression', 'failure', 'stress']
+CLK_TCK = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+def free_port():
+    """Return a loopback TCP port that is currently unused."""
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of a list of samples (0 for an empty list)."""
+    if not samples:
+        return 0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def process_cpu_seconds(pid):
+    """User plus system CPU seconds consumed so far by a process, from /proc (0 where unavailable)."""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / CLK_TCK
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+class Cluster:
+    """A master (or three-node Raft master group) and chunk servers run as subprocesses in a temp directory."""
+
+    def __init__(self, num_servers=4, raft=False, workdir=None):
+        self.num_servers = num_servers
+        self.raft = raft
+        self.workdir = workdir or tempfile.mkdtemp(prefix='gfs-bench-')
+        self.masters = []  # (host, port) of every master
+        self.chunk_servers = {}  # port -> Popen
+        self.processes = []
+        self.retired_cpu = 0  # CPU seconds of chunk servers killed by failure injection
+        self.client_class = None
+        self.client_module = None  # The client module client_class comes from
+
+    def spawn(self, script, *args):
+        """Start one of the server scripts with the temp directory as its working directory."""
+        env = dict(os.environ, GFS_METRICS_PORT='0')  # Fixed metrics ports would clash between concurrent runs
+        process = subprocess.Popen([sys.executable, script, *map(str, args)], cwd=self.workdir, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.processes.append(process)
+        return process
+
+    def start(self):
+        """Launch the masters and chunk servers and wait until every chunk server is registered."""
+        if self.raft:
+            root = os.path.join(HERE, 'GFS_2')
+            self.masters = [('localhost', free_port()) for _ in range(3)]
+            for host, port in self.masters:
+                peers = [str(p) for peer in self.masters if peer != (host, port) for p in peer]
+                self.spawn(os.path.join(root, 'master_server.py'), port, *peers)
+            for _ in range(self.num_servers):
+                self.start_chunk_server(free_port())
+            spec = importlib.util.spec_from_file_location('raft_client', os.path.join(root, 'client.py'))
+        else:
+            self.masters = [('localhost', free_port())]
+            self.spawn(os.path.join(HERE, 'master_server.py'), self.masters[0][1])
+            for _ in range(self.num_servers):
+                self.start_chunk_server(free_port())
+            spec = importlib.util.spec_from_file_location('client', os.path.join(HERE, 'client.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        self.client_module = module
+        self.client_class = module.Client
+        self.wait_ready()
+
+    def start_chunk_server(self, port):
+        """Start a chunk server on port, or restart a killed one with the chunks it had stored."""
+        if self.raft:
+            master_args = [str(p) for master in self.masters for p in master]
+            self.chunk_servers[port] = self.spawn(os.path.join(HERE, 'GFS_2', 'chunk_server.py'), port, *master_args)
+        else:
+            self.chunk_servers[port] = self.spawn(os.path.join(HERE, 'chunk_server.py'), port, '--master', '%s:%d' % self.masters[0],
+                                                  '--metrics-port', 0, '--dir', os.path.join(self.workdir, 'chunks', str(port)))
+
+    def master_request(self, request):
+        """Send a request to the master (following Raft leader redirects) and return its response."""
+        masters = list(self.masters)
+        while masters:
+            host, port = masters.pop(0)
+            try:
+                with socket.create_connection((host, port), timeout=RPC_TIMEOUT) as s:
+                    s.sendall(pickle.dumps(request))
+                    response = pickle.load(s.makefile('rb'))
+            except (OSError, EOFError):
+                continue
+            if response.get('status') != 'redirect':
+                return response
+            masters.insert(0, (response['leader_host'], response['leader_port']))
+        return {'status': 'error', 'message': 'No master reachable'}
+
+    def wait_ready(self):
+        """Block until every chunk server is registered and active."""
+        deadline = time.time() + READY_TIMEOUT
+        while time.time() < deadline:
+            servers = self.master_request({'command': 'list_servers'}).get('servers', {})
+            if sum(info['active'] for info in servers.values()) >= self.num_servers:
+                return
+            time.sleep(0.2)
+        raise RuntimeError(f"Chunk servers did not register within {READY_TIMEOUT} seconds (see logs in {self.workdir})")
+
+    def client(self):
+        """Return a new client of this cluster."""
+        if self.raft:
+            return self.client_class(list(self.masters))
+        host, port = self.masters[0]
+        return self.client_class(host, port, timeout=RPC_TIMEOUT)
+
+    def kill_chunk_server(self):
+        """Kill one chunk server without warning; returns its port."""
+        port, process = self.chunk_servers.popitem()
+        self.retired_cpu += process_cpu_seconds(process.pid)
+        process.kill()
+        process.wait()
+        return port
+
+    def cpu_seconds(self):
+        """CPU seconds consumed by all cluster processes so far."""
+        return self.retired_cpu + sum(process_cpu_seconds(p.pid) for p in self.processes if p.poll() is None)
+
+    def stop(self, keep=False):
+        """Terminate every process and remove the temp directory unless keep is set."""
+        for process in self.processes:
+            process.kill()
+        for process in self.processes:
+            process.wait()
+        if not keep:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class Workload:
+    """Collects per-operation latencies, bytes moved and CPU time of one benchmark workload."""
+
+    def __init__(self, cluster, name):
+        self.cluster = cluster
+        self.name = name
+        self.latencies = []
+        self.bytes = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.cpu_start = self.cluster.cpu_seconds() + time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start
+        self.cpu = self.cluster.cpu_seconds() + time.process_time() - self.cpu_start
+
+    def timed(self, operation, num_bytes=0):
+        """Run operation(), recording its latency; it returns False (or raises) on failure."""
+        start = time.perf_counter()
+        with tracing.start_trace(f'bench.{self.name}') as trace_span:
+            try:
+                ok = operation() is not False
+            except Exception as e:
+                logging.warning("%s operation failed: %s", self.name, e)
+                ok = False
+            trace_span.set(ok=ok)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.latencies.append(elapsed)
+            self.bytes += num_bytes if ok else 0
+            self.errors += not ok
+
+    def run_parallel(self, tasks, clients):
+        """Run callables spread over `clients` threads, each thread driving its own client."""
+        def worker(index):
+            client = self.cluster.client()
+            for task in tasks[index::clients]:
+                task(client)
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def result(self):
+        """Summary of the workload as a JSON-serializable dict."""
+        gigabytes = self.bytes / 1e9
+        return {
+            'ops': len(self.latencies),
+            'errors': self.errors,
+            'bytes': self.bytes,
+            'seconds': round(self.seconds, 4),
+            'ops_per_second': round(len(self.latencies) / self.seconds, 2) if self.seconds else 0,
+            'throughput_mb_s': round(self.bytes / 1e6 / self.seconds, 3) if self.seconds else 0,
+            'p50_ms': round(percentile(self.latencies, 0.5) * 1000, 3),
+            'p99_ms': round(percentile(self.latencies, 0.99) * 1000, 3),
+            'cpu_seconds': round(self.cpu, 3),
+            'cpu_seconds_per_gb': round(self.cpu / gigabytes, 2) if gigabytes else None,
+        }
+
+
+def write_file(name, data):
+    """Create a local input file for uploads."""
+    with open(name, 'wb') as f:
+        f.write(data)
+
+
+def verified_download(client, name, expected):
+    """Download name and report whether the result matches the expected bytes."""
+    output = f"downloaded_{threading.get_ident()}_{name}"  # Concurrent readers of one file must not share the output
+    if os.path.exists(output):
+        os.remove(output)  # A failed download must not be judged by an earlier copy
+    client.download_file(name, output)
+    with open(output, 'rb') as f:
+        return f.read() == expected
+
+
+def uploaded(response):
+    """Whether an upload_file return value means success (the Raft client returns nothing)."""
+    return response is None or response.get('status') == 'success'
+
+
+def bench_sequential(cluster, args):
+    """Upload one large file, then download it args.rounds times."""
+    data = os.urandom(args.size_mb * 1024 * 1024)
+    write_file('sequential.bin', data)
+    client = cluster.client()
+    with Workload(cluster, 'sequential_upload') as upload:
+        upload.timed(lambda: uploaded(client.upload_file('sequential.bin')), len(data))
+    with Workload(cluster, 'sequential_download') as download:
+        for _ in range(args.rounds):
+            download.timed(lambda: verified_download(client, 'sequential.bin', data), len(data))
+    return {'upload': upload.result(), 'download': download.result()}
+
+
+def bench_small_files(cluster, args):
+    """Upload args.files small files from args.clients concurrent clients."""
+    names = []
+    for i in range(args.files):
+        names.append(f'small_{i}.bin')
+        write_file(names[-1], os.urandom(args.small_size))
+    with Workload(cluster, 'small_files') as work:
+        work.run_parallel([lambda client, name=name: work.timed(lambda: uploaded(client.upload_file(name)), args.small_size)
+                           for name in names], args.clients)
+    return dict(work.result(), files_per_second=round(args.files / work.seconds, 2))
+
+
+def bench_small_files_batched(cluster, args):
+    """Upload args.files small files like small_files, but args.batch_files at a time with Client.upload_files."""
+    if not hasattr(cluster.client(), 'upload_files'):
+        return {'skipped': 'the client has no batched upload'}
+    names = []
+    for i in range(args.files):
+        names.append(f'small_batched_{i}.bin')
+        write_file(names[-1], os.urandom(args.small_size))
+    batches = [names[start:start + args.batch_files] for start in range(0, len(names), args.batch_files)]
+    with Workload(cluster, 'small_files_batched') as work:
+        work.run_parallel([lambda client, batch=batch: work.timed(
+            lambda: client.upload_files(batch)['status'] == 'success', args.small_size * len(batch)) for batch in batches],
+            args.clients)
+    return dict(work.result(), files_per_second=round(args.files / work.seconds, 2))
+
+
+def bench_zipf_reads(cluster, args):
+    """Read args.reads small files picked with Zipf(args.zipf) popularity from concurrent clients."""
+    names = [f'small_{i}.bin' for i in range(args.files)]
+    if not os.path.exists(names[-1]):
+        bench_small_files(cluster, args)
+    contents = {}
+    for name in names:
+        with open(name, 'rb') as f:
+            contents[name] = f.read()
+    rng = random.Random(args.seed)
+    picks = rng.choices(names, weights=[1 / (rank + 1) ** args.zipf for rank in range(len(names))], k=args.reads)
+    with Workload(cluster, 'zipf_reads') as work:
+        work.run_parallel([lambda client, name=name: work.timed(
+            lambda: verified_download(client, name, contents[name]), len(contents[name])) for name in picks], args.clients)
+    return work.result()
+
+
+def bench_metadata(cluster, args):
+    """Issue args.metadata_ops namespace listings without touching any chunk data."""
+    with Workload(cluster, 'metadata') as work:
+        work.run_parallel([lambda client: work.timed(lambda: list(client.iter_files('small_')))
+                           for _ in range(args.metadata_ops)], args.clients)
+    return work.result()
+
+
+def bench_writes(cluster, args):
+    """Store args.writes single chunks straight on the chunk servers; every operation is one acknowledged write."""
+    data = os.urandom(2048)
+    checksum = hashlib.sha256(data).hexdigest()
+    ports = sorted(cluster.chunk_servers)
+
+    def store(i):
+        request = {'command': 'store', 'filename': 'bench_writes', 'chunk_id': f'write_{i}', 'data': data, 'checksum': checksum}
+        with socket.create_connection(('localhost', ports[i % len(ports)]), timeout=RPC_TIMEOUT) as s:
+            s.sendall(pickle.dumps(request))
+            return pickle.load(s.makefile('rb')).get('status') == 'success'
+
+    with Workload(cluster, 'writes') as work:
+        work.run_parallel([lambda client, i=i: work.timed(lambda: store(i), len(data)) for i in range(args.writes)],
+                          args.clients)
+    return work.result()
+
+
+def stored_chunk_bytes(cluster, name):
+    """Bytes of name's chunk files on every chunk server's disk: (all replicas, one copy of each chunk)."""
+    sizes = {}
+    for root, _, files in os.walk(os.path.join(cluster.workdir, 'chunks')):
+        for chunk_file in files:
+            if chunk_file.startswith(f'{name}_{name}_chunk_') and not chunk_file.endswith(('.tmp', '.version')):
+                sizes.setdefault(chunk_file, []).append(os.path.getsize(os.path.join(root, chunk_file)))
+    return sum(map(sum, sizes.values())), sum(copies[0] for copies in sizes.values())
+
+
+def bench_compression(cluster, args):
+    """Upload and download compressible and incompressible data with every codec and without one.
+
+    Reports MB/s of the raw data each way, the bytes stored over all replicas and the bytes
+    a download moves, so the effect of each codec on throughput and traffic can be compared.
+    """
+    if cluster.raft:
+        return {'skipped': 'the Raft client has no codecs'}
+    codecs = [None] + sorted(cluster.client_module.CODECS)
+    size = args.compression_mb * 1024 * 1024
+    rng = random.Random(args.seed)
+    words = [os.urandom(rng.randint(2, 6)).hex().encode() for _ in range(1000)]
+    text = b' '.join(rng.choice(words) for _ in range(size // 8))[:size]  # Log-like data with a small vocabulary
+    results = {}
+    for kind, data in (('compressible', text), ('incompressible', os.urandom(size))):
+        for codec in codecs:
+            name = f'compression_{kind}_{codec or "none"}.bin'
+            write_file(name, data)
+            client = cluster.client()
+            with Workload(cluster, f'compression_upload_{kind}_{codec}') as upload:
+                upload.timed(lambda: uploaded(client.upload_file(name, codec=codec)), len(data))
+            with Workload(cluster, f'compression_download_{kind}_{codec}') as download:
+                for _ in range(args.rounds):
+                    download.timed(lambda: verified_download(client, name, data), len(data))
+            stored, wire = stored_chunk_bytes(cluster, name)
+            results[f'{kind}_{codec or "none"}'] = {
+                'errors': upload.errors + download.errors,
+                'upload_mb_s': upload.result()['throughput_mb_s'],
+                'download_mb_s': download.result()['throughput_mb_s'],
+                'raw_bytes': len(data),
+                'stored_bytes': stored,
+                'download_wire_bytes': wire,
+                'ratio': round(wire / len(data), 3) if wire else None,
+            }
+    return results
+
+
+def bench_failure(cluster, args):
+    """Download a file repeatedly and kill a chunk server half way through."""
+    data = os.urandom(args.failure_size_kb * 1024)
+    write_file('failure.bin', data)
+    client = cluster.client()
+    if not uploaded(client.upload_file('failure.bin')):
+        raise RuntimeError("Could not upload the failure-injection file")
+    with Workload(cluster, 'failure') as work:
+        for i in range(args.rounds * 2):
+            if i == args.rounds:
+                logging.warning("Killed chunk server on port %d", cluster.kill_chunk_server())
+            work.timed(lambda: verified_download(client, 'failure.bin', data), len(data))
+    return work.result()
+
+
+def bench_stress(cluster, args):
+    """Upload and download concurrently while a chunk server is killed and later restarted, then check consistency.
+
+    The server is down for half of --stress-seconds, long enough for the master to declare
+    it failed and reallocate its chunks under load. Afterwards every uploaded file must
+    download byte for byte and the master's check_metadata must report no violation.
+    """
+    if cluster.raft:
+        raise RuntimeError("The stress workload needs the single master's check_metadata command")
+    expected = {}  # Name -> content of every file whose upload succeeded
+    corrupt = []  # Downloads that completed with the wrong content
+    stop = threading.Event()
+    rng = random.Random(args.seed)
+    sizes = [rng.randint(1, 8 * 2048) for _ in range(1024)]
+
+    def check(client, name):
+        output = f"downloaded_{threading.get_ident()}_{name}"
+        if os.path.exists(output):
+            os.remove(output)
+        client.download_file(name, output)
+        if not os.path.exists(output):
+            return False  # A failed download; only wrong bytes count as corruption
+        with open(output, 'rb') as f:
+            if f.read() != expected[name]:
+                corrupt.append(name)
+                return False
+        return True
+
+    def uploader(index):
+        client = cluster.client()
+        for n in range(sys.maxsize):
+            if stop.is_set():
+                return
+            name = f'stress_{index}_{n}.bin'
+            data = os.urandom(sizes[n % len(sizes)])
+            write_file(name, data)
+
+            def upload():
+                if not uploaded(client.upload_file(name)):
+                    return False
+                expected[name] = data
+            work.timed(upload, len(data))
+
+    def downloader(index):
+        client = cluster.client()
+        reader = random.Random(args.seed + index)
+        while not stop.is_set():
+            if not expected:
+                time.sleep(0.05)
+                continue
+            name = reader.choice(list(expected))
+            work.timed(lambda: check(client, name), len(expected[name]))
+
+    with Workload(cluster, 'stress') as work:
+        threads = [threading.Thread(target=uploader, args=(i,)) for i in range(args.clients // 2 or 1)]
+        threads += [threading.Thread(target=downloader, args=(i,)) for i in range(args.clients - len(threads) or 1)]
+        for thread in threads:
+            thread.start()
+        time.sleep(args.stress_seconds / 4)
+        port = cluster.kill_chunk_server()
+        logging.warning("Killed chunk server on port %d", port)
+        time.sleep(args.stress_seconds / 2)
+        cluster.start_chunk_server(port)
+        logging.warning("Restarted chunk server on port %d", port)
+        time.sleep(args.stress_seconds / 4)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    client = cluster.client()
+    unreadable = [name for name in list(expected) if not check(client, name)]
+    result = work.result()
+    result.update(files=len(expected), unreadable=len(unreadable), corrupt=sorted(set(corrupt)),
+                  violations=cluster.master_request({'command': 'check_metadata'}).get('violations'))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Launch a local cluster, run workloads and print the results as JSON.")
+    parser.add_argument('--servers', type=int, default=4, help="chunk servers to start")
+    parser.add_argument('--raft', action='store_true', help="use the three-node Raft master group from GFS_2")
+    parser.add_argument('--workloads', default=','.join(w for w in WORKLOADS if w != 'stress'),
+                        help="comma-separated subset of " + ', '.join(WORKLOADS) + " (all but stress by default)")
+    parser.add_argument('--size-mb', type=int, default=8, help="size of the sequential file")
+    parser.add_argument('--rounds', type=int, default=3, help="sequential downloads, and downloads before/after the failure")
+    parser.add_argument('--files', type=int, default=200, help="small files to upload")
+    parser.add_argument('--small-size', type=int, default=4096, help="bytes per small file")
+    parser.add_argument('--batch-files', type=int, default=50, help="files per upload_files call in small_files_batched")
+    parser.add_argument('--reads', type=int, default=1000, help="Zipf-distributed small-file reads")
+    parser.add_argument('--zipf', type=float, default=1.1, help="Zipf exponent of the read popularity")
+    parser.add_argument('--metadata-ops', type=int, default=500, help="namespace listings in the metadata storm")
+    parser.add_argument('--writes', type=int, default=2000, help="single-chunk stores in the acked-writes workload")
+    parser.add_argument('--durability', choices=['none', 'chunk', 'group'], help="chunk server durability mode (default: theirs)")
+    parser.add_argument('--compression-mb', type=int, default=4, help="size of each file of the compression workload")
+    parser.add_argument('--failure-size-kb', type=int, default=512, help="size of the failure-injection file")
+    parser.add_argument('--stress-seconds', type=float, default=40, help="duration of the stress workload (a chunk server is down for half of it)")
+    parser.add_argument('--clients', type=int, default=8, help="concurrent clients for the parallel workloads")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the JSON report here instead of stdout")
+    parser.add_argument('--keep', action='store_true', help="keep the temp directory (logs, chunks) afterwards")
+    parser.add_argument('--trace', help="record spans of every operation to this JSON lines file")
+    parser.add_argument('--slowest', type=int, default=5, help="with --trace, print a waterfall of this many slowest operations")
+    args = parser.parse_args()
+
+    workloads = [w for w in args.workloads.split(',') if w]
+    unknown = set(workloads) - set(WORKLOADS)
+    if unknown:
+        parser.error(f"unknown workloads: {', '.join(sorted(unknown))}")
+    workloads.sort(key=lambda w: w == 'failure')  # Failure injection permanently shrinks the cluster
+    if args.durability:
+        os.environ['GFS_DURABILITY'] = args.durability  # Inherited by the chunk servers
+    if args.trace:
+        if args.raft:
+            parser.error("--trace is only supported by the single-master cluster")
+        args.trace = os.path.abspath(args.trace)
+        open(args.trace, 'w').close()
+        os.environ['GFS_TRACE'] = args.trace  # Inherited by the master and chunk servers
+        tracing.configure(export=args.trace, service='bench')
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    cluster = Cluster(args.servers, args.raft)
+    cwd = os.getcwd()
+    try:
+        cluster.start()
+        client_dir = os.path.join(cluster.workdir, 'client')
+        os.makedirs(client_dir)
+        os.chdir(client_dir)  # Uploads read and downloads write files in the working directory
+        logging.getLogger().setLevel(logging.WARNING)  # Per-chunk client logging would dominate the timings
+        results = {name: globals()[f'bench_{name}'](cluster, args) for name in workloads}
+    finally:
+        os.chdir(cwd)
+        cluster.stop(args.keep)
+
+    report = {'timestamp': time.time(), 'config': vars(args), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.trace:
+        tracing.flush()
+        tracing.waterfall(args.trace, args.slowest, out=sys.stderr)
+    stress = results.get('stress')
+    if stress and (stress['unreadable'] or stress['corrupt'] or stress['violations']):
+        sys.exit("Stress workload found lost or corrupt files or inconsistent metadata")
+
+
+if __name__ == "__main__":
+    main()
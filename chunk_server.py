@@ -6,22 +6,267 @@ import pickle
 import hashlib
 import logging
 import time
+import shutil
+import ctypes
+import argparse
 import traceback
+import metrics
+import logsetup
+import profiling
+import tracing
+from logsetup import log_sampled
 
-logging.basicConfig(filename='chunk_server.log', level=logging.INFO, 
-                    format='%(asctime)s - %(levelname)s - %(message)s')
+logsetup.setup('chunk_server.log')
 
-MASTER_PORT = 7082  # Primary Master Port
+MASTER_ADDRESS = 'localhost:7082'  # Default master, overridable with --master
 HEARTBEAT_INTERVAL = 5
+CHUNK_SIZE = 2048  # Consistent with the chunk size used in Master and Client
+CAPACITY_BYTES = int(os.environ.get('GFS_CHUNK_CAPACITY', 0))  # Capacity reported to the master; 0 means the disk's size
+METRICS_PORT_OFFSET = 1000  # Default metrics endpoint: http://<host>:<port + offset>/metrics
+DURABILITY = os.environ.get('GFS_DURABILITY', 'group')  # When writes are acked: 'none', 'chunk' (own fsync) or 'group' (shared fsync)
+GROUP_COMMIT_MS = float(os.environ.get('GFS_GROUP_COMMIT_MS', 0))  # Extra wait for more writes to join a group; 0 commits when the last one is done
+GROUP_COMMIT_BYTES = 1024 * 1024  # A group is committed at once when this many bytes are waiting
+TEMP_SUFFIX = '.tmp'  # Chunk files being written; renamed into place once complete, removed on restart
+VERSION_SUFFIX = '.version'  # Next to a chunk file, holds the version of a chunk mutated in place by record appends
+
+# Commands handle_request serves; metrics label any other command 'unknown'
+COMMANDS = frozenset(['store', 'download', 'store_batch', 'append', 'append_at', 'download_batch', 'delete_batch',
+                      'inventory', 'set_version', 'lease_update', 'replicate', 'copy_chunk', 'replicate_to', 'metrics',
+                      'profile', 'stacks'])
+REQUESTS = metrics.REGISTRY.counter('gfs_chunk_requests_total', "Requests handled, by command", ['command'])
+REQUEST_ERRORS = metrics.REGISTRY.counter('gfs_chunk_request_errors_total', "Requests that failed with an exception, by command", ['command'])
+REQUEST_SECONDS = metrics.REGISTRY.histogram('gfs_chunk_request_seconds', "Request handling time, by command", ['command'])
+BYTES_IN = metrics.REGISTRY.counter('gfs_chunk_bytes_in_total', "Chunk data bytes written to disk")
+BYTES_OUT = metrics.REGISTRY.counter('gfs_chunk_bytes_out_total', "Chunk data bytes read and served")
+LEASE_CACHE = metrics.REGISTRY.counter('gfs_chunk_lease_cache_lookups_total', "Lease cache lookups on writes, by result", ['result'])
+FSYNCS = metrics.REGISTRY.counter('gfs_chunk_fsyncs_total', "fsync calls on chunk files and directories")
+COMMIT_GROUP_SIZE = metrics.REGISTRY.histogram('gfs_chunk_commit_group_writes', "Writes made durable per group commit",
+                                               buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+
+
+def server_address(server):
+    """Split a chunk server or master ID ('host:port') into a (host, port) address."""
+    host, port = server.rsplit(':', 1)
+    return host, int(port)
+
+
+def chunk_id_from_path(path):
+    """Return the ID of the chunk stored at path (relative to the chunk directory), or None for other files.
+
+    A chunk is stored as '<filename>_<chunk_id>' and its ID is '<filename>_chunk_<suffix>',
+    so the filename appears twice and the ID can be recovered from the path alone.
+    """
+    path = path.replace(os.sep, '/')
+    doubled = path.rsplit('_chunk_', 1)[0]  # '<filename>_<filename>'
+    half = len(doubled) // 2
+    if '_chunk_' in path and doubled[:half] == doubled[half + 1:] and doubled[half:half + 1] == '_':
+        return path[half + 1:]
+    return None
+
+
+try:
+    _syncfs = ctypes.CDLL(None, use_errno=True).syncfs  # Linux: flush a whole file system in one call
+except (OSError, AttributeError):
+    _syncfs = None  # Group commits fall back to one fsync per file
+
+
+def syncfs(path):
+    """Flush every dirty file of the file system holding path, or return False where syncfs is unavailable."""
+    if _syncfs is None:
+        return False
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if _syncfs(fd) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+    finally:
+        os.close(fd)
+    FSYNCS.inc()
+    return True
+
+
+def fsync_path(path):
+    """fsync a file or directory by name."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    FSYNCS.inc()
+
+
+class Commit:
+    """A write waiting for its durability point; wait() returns None once durable or the OSError that prevented it."""
+    __slots__ = ('done', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        return self.error
+
+
+DURABLE = Commit()  # Returned for writes that need no waiting
+DURABLE.done.set()
+
+
+def publish(tmp, path, replace=False):
+    """Move tmp to path; unless replace is set, raise FileExistsError rather than replace a file already there."""
+    if replace:
+        os.replace(tmp, path)
+        return
+    try:
+        os.link(tmp, path)
+    finally:
+        os.remove(tmp)
+
+
+class DurableWriter:
+    """Write chunk files so that an acked write survives a crash as the chosen durability mode promises.
+
+    New chunks are written to a temp file and moved into place, so a crash never leaves
+    a partial chunk under its real name. Both names are created exclusively, so of two
+    concurrent stores of one chunk the second fails with FileExistsError instead of
+    replacing the first. 'none' leaves flushing to the OS, 'chunk' fsyncs every file and
+    its directory before returning, and 'group' hands written files to a committer thread. The committer flushes the whole group with one syncfs (one fsync per
+    file where that is unavailable), renames the files and then fsyncs each directory once.
+    """
+
+    def __init__(self, root, mode=DURABILITY, interval=GROUP_COMMIT_MS / 1000, max_bytes=GROUP_COMMIT_BYTES):
+        if mode not in ('none', 'chunk', 'group'):
+            raise ValueError(f"Unknown durability mode {mode}")
+        self.root = root  # Chunk directory; syncfs flushes its file system
+        self.mode = mode
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.cond = threading.Condition()
+        self.pending = []  # (temp path or None, path, replace, Commit) waiting for the next group commit
+        self.pending_bytes = 0
+        self.first_pending = 0  # Monotonic time the oldest pending write arrived
+        if mode == 'group':
+            threading.Thread(target=self.run, name='group-commit', daemon=True).start()
+
+    def write(self, path, data, replace=False):
+        """Create the file path holding data, or overwrite it if replace is set; returns a Commit to wait on before acking."""
+        tmp = path + TEMP_SUFFIX
+        with open(tmp, 'xb') as f:
+            try:
+                f.write(data)
+                if self.mode == 'chunk':
+                    f.flush()
+                    os.fsync(f.fileno())
+                    FSYNCS.inc()
+            except BaseException:
+                os.remove(tmp)
+                raise
+        if self.mode == 'group':
+            return self.enqueue(tmp, path, len(data), replace)
+        publish(tmp, path, replace)
+        if self.mode == 'chunk':
+            fsync_path(os.path.dirname(path))
+        return DURABLE
+
+    def written(self, path, num_bytes):
+        """Make an in-place write to an existing file durable; returns a Commit to wait on before acking."""
+        if self.mode == 'chunk':
+            fsync_path(path)
+        elif self.mode == 'group':
+            return self.enqueue(None, path, num_bytes)
+        return DURABLE
+
+    def enqueue(self, tmp, path, num_bytes, replace=False):
+        """Add a write to the next group; tmp, if given, is moved to path once flushed."""
+        commit = Commit()
+        with self.cond:
+            if not self.pending:
+                self.first_pending = time.monotonic()
+            self.pending.append((tmp, path, replace, commit))
+            self.pending_bytes += num_bytes
+            self.cond.notify()
+        return commit
+
+    def run(self):
+        """Commit pending writes in groups, forever."""
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                deadline = self.first_pending + self.interval
+                while self.pending_bytes < self.max_bytes and time.monotonic() < deadline:
+                    self.cond.wait(deadline - time.monotonic())
+                group, self.pending, self.pending_bytes = self.pending, [], 0
+            self.commit(group)
+
+    def commit(self, group):
+        """Make a group of writes durable and wake their writers."""
+        directories = {}
+        try:
+            flushed = syncfs(self.root)
+        except OSError as e:
+            for *_, commit in group:
+                commit.error = e
+            flushed = True
+        for tmp, path, replace, commit in group:
+            try:
+                if commit.error is not None:
+                    if tmp is not None:
+                        os.remove(tmp)  # Would refuse the next write of path
+                    continue
+                if not flushed:
+                    fsync_path(tmp or path)
+                if tmp is not None:
+                    publish(tmp, path, replace)
+                    directories.setdefault(os.path.dirname(path), []).append(commit)
+            except OSError as e:
+                commit.error = commit.error or e
+        for directory, commits in directories.items():
+            try:
+                fsync_path(directory)
+            except OSError as e:
+                for commit in commits:
+                    commit.error = e
+        COMMIT_GROUP_SIZE.observe(len(group))
+        for *_, commit in group:
+            commit.done.set()
+
 
 class ChunkServer:
-    def __init__(self, host, port, myChunkDir, filesystem):
+    def __init__(self, host, port, myChunkDir, filesystem, master=MASTER_ADDRESS, tags=(), capacity=CAPACITY_BYTES,
+                 metrics_port=None, durability=DURABILITY):
         self.filesystem = filesystem
         self.myChunkDir = myChunkDir
         self.host = host
         self.port = port
+        self.server_id = f"{host}:{port}"  # The ID the master registers this server under
+        self.master = server_address(master)
+        self.tags = list(tags)  # Free-form labels (rack, disk type, ...) reported at registration
+        self.capacity = capacity
+        self.metrics_port = port + METRICS_PORT_OFFSET if metrics_port is None else metrics_port  # 0 disables the endpoint
         self.chunkserver_info = []  # List of stored chunks
-        self.lease_info = {}  # Lease info for tracking active leases
+        self.lease_info = {}  # Lease cache pushed by the master: {filename: <expiry time>}
+        self.append_locks = {}  # Per-chunk locks serializing record appends on the primary
+        self.versions = {}  # Versions of the chunks mutated in place: {chunk_id: version}; other chunks are at 0
+        self.primaries = {}  # Record-append leases the master granted this server: {chunk_id: (version, expires)}
+        self.unreported_versions = {}  # Versions not yet acknowledged by the master in a heartbeat
+        self.version_lock = threading.Lock()
+        os.makedirs(myChunkDir, exist_ok=True)
+        self.writer = DurableWriter(myChunkDir, durability)
+        for root, _, names in os.walk(myChunkDir):
+            for name in names:
+                path = os.path.join(root, name)
+                if name.endswith(TEMP_SUFFIX):
+                    os.remove(path)  # Never acked: the write was cut short by a crash
+                elif name.endswith(VERSION_SUFFIX):
+                    chunk_id = chunk_id_from_path(os.path.relpath(path[:-len(VERSION_SUFFIX)], myChunkDir))
+                    with open(path) as f:
+                        self.versions[chunk_id] = int(f.read())
+        self.unreported_versions = dict(self.versions)  # The master learns every version after a restart
+        self.usage_lock = threading.Lock()
+        self.active_requests = 0  # Requests being served, reported in heartbeats for replica ordering
+        self.used_bytes = sum(os.path.getsize(os.path.join(root, name))  # Bytes of stored chunks, reported in heartbeats
+                              for root, _, names in os.walk(myChunkDir) for name in names)
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind((self.host, self.port))
@@ -29,12 +274,19 @@ class ChunkServer:
 
     def start(self):
         """Start the chunk server, begin listening and send periodic heartbeats."""
+        metrics.REGISTRY.gauge('gfs_chunk_active_requests', "Requests being served", lambda: self.active_requests)
+        metrics.REGISTRY.gauge('gfs_chunk_used_bytes', "Bytes of stored chunks", lambda: self.used_bytes)
+        metrics.REGISTRY.gauge('gfs_chunk_capacity_bytes', "Capacity reported to the master",
+                               lambda: self.capacity or shutil.disk_usage(self.myChunkDir).total)
+        metrics.REGISTRY.gauge('gfs_chunk_leases_cached', "Leases in the local cache", lambda: len(self.lease_info))
+        if self.metrics_port:
+            metrics.start_http_server(self.metrics_port, self.host)
         threading.Thread(target=self.send_heartbeat).start()
         self.listen()
 
     def listen(self):
         """Listen for incoming connections and handle each in a separate thread."""
-        self.sock.listen(5)
+        self.sock.listen(socket.SOMAXCONN)  # A short backlog drops SYNs under concurrent clients, costing a 1 s retransmit
         logging.info("Chunk Server started, listening on port %d", self.port)
         while True:
             client, address = self.sock.accept()
@@ -42,100 +294,358 @@ class ChunkServer:
             threading.Thread(target=self.handle_request, args=(client, address)).start()
 
     def send_heartbeat(self):
-        """Send periodic heartbeat messages to the MasterServer to indicate server activity."""
+        """Send periodic heartbeat messages to the MasterServer; the first one registers this server."""
         while True:
-            time.sleep(HEARTBEAT_INTERVAL)
             try:
                 with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    s.connect((socket.gethostbyname('localhost'), MASTER_PORT))
-                    heartbeat_message = {'command': 'heartbeat', 'port': self.port}
-                    s.send(pickle.dumps(heartbeat_message))
-                logging.info("Heartbeat sent to MasterServer from port %d", self.port)
+                    s.connect(self.master)
+                    versions = dict(self.unreported_versions)
+                    heartbeat_message = {'command': 'heartbeat', 'host': self.host, 'port': self.port, 'tags': self.tags,
+                                         'used_bytes': self.used_bytes, 'active_requests': self.active_requests,
+                                         'capacity': self.capacity or shutil.disk_usage(self.myChunkDir).total,
+                                         'versions': versions}
+                    s.sendall(pickle.dumps(heartbeat_message))
+                    response = pickle.load(s.makefile('rb'))
+                if 'leases' in response:
+                    self.lease_info = response['leases']  # Resync the cache with the master's lease table
+                with self.version_lock:
+                    for chunk_id, version in versions.items():
+                        if self.unreported_versions.get(chunk_id) == version:
+                            del self.unreported_versions[chunk_id]
+                log_sampled(logging.DEBUG, 'heartbeat_sent', server=self.server_id, used_bytes=self.used_bytes)
             except Exception as e:
                 logging.error("Failed to send heartbeat: %s", e)
+            time.sleep(HEARTBEAT_INTERVAL)
 
     def calculate_checksum(self, data):
         """Calculate the checksum of data for integrity checks."""
         return hashlib.sha256(data).hexdigest()
 
-    def connect_to_master(self, filename, chunk_id):
-        """Notify the MasterServer of stored chunk and get replication info."""
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((socket.gethostbyname('localhost'), MASTER_PORT))
-                message = {'command': 'chunk_info', 'filename': filename, 'chunk_id': chunk_id, 'port': self.port}
-                s.send(pickle.dumps(message))
-                response = pickle.loads(s.recv(4096))
-                
-                if response.get('status') == 'replicate':
-                    target_port = response.get('target_port')
-                    self.replicate_chunk(filename, chunk_id, target_port)
-        except Exception as e:
-            logging.error("Failed to communicate with master server: %s", e)
+    def replicate_chunk(self, filename, chunk_id, target):
+        """Replicate the chunk to another chunk server as per MasterServer's instruction.
 
-    def replicate_chunk(self, filename, chunk_id, target_port):
-        """Replicate the chunk to another chunk server as per MasterServer's instruction."""
+        Returns the target's response, so the master can confirm the copy before acting on it.
+        """
         try:
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((socket.gethostbyname('localhost'), target_port))
+                s.connect(server_address(target))
                 path = os.path.join(self.myChunkDir, f"{filename}_{chunk_id}")
-                with open(path, 'rb') as f:
-                    data = f.read()
-                    checksum = self.calculate_checksum(data)
-                    s.send(pickle.dumps({'command': 'replicate', 'data': data, 'checksum': checksum, 'chunk_id': chunk_id, 'filename': filename}))
-                logging.info("Replicated chunk %s to server on port %d", chunk_id, target_port)
+                with self.append_lock(chunk_id):  # The data and its version must match
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                    version = self.versions.get(chunk_id, 0)
+                checksum = self.calculate_checksum(data)
+                with tracing.span('replicate', target=target, chunk_id=chunk_id):
+                    s.sendall(pickle.dumps(tracing.inject({'command': 'replicate', 'data': data, 'checksum': checksum,
+                                                           'chunk_id': chunk_id, 'filename': filename,
+                                                           'version': version})))
+                    response = pickle.load(s.makefile('rb'))
+            if response.get('status') == 'success':
+                log_sampled(logging.INFO, 'chunk_replicated', chunk_id=chunk_id, target=target)
+            else:
+                logging.error("Server %s refused replica of chunk %s: %s", target, chunk_id, response.get('message'))
+            return response
         except Exception as e:
             logging.error("Failed to replicate chunk %s: %s", chunk_id, e)
+            return {'status': 'error', 'message': str(e)}
 
     def check_lease(self, filename):
-        """Check with the Master Server if the file is currently leased."""
+        """Check the locally cached lease grant; the master pushes grants and releases."""
+        leased = self.lease_info.get(filename, 0) > time.time()
+        LEASE_CACHE.labels('leased' if leased else 'free').inc()
+        return leased
+
+    def update_lease(self, filename, expires):
+        """Cache a lease grant (expiry time) or drop it on release (None)."""
+        if expires is None:
+            self.lease_info.pop(filename, None)
+        else:
+            self.lease_info[filename] = expires
+        return {'status': 'success'}
+
+    def set_version(self, filename, chunk_id, version):
+        """Durably raise the version of a chunk to version; returns False if the chunk already has a newer one.
+
+        The master raises a chunk's version with every primary lease it grants for record
+        appends, so a replica that missed the new lease (and the appends under it) keeps an
+        older version and is recognised as stale.
+        """
+        with self.version_lock:
+            current = self.versions.get(chunk_id, 0)
+            if version > current:
+                path = os.path.join(self.myChunkDir, f"{filename}_{chunk_id}{VERSION_SUFFIX}")
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                error = self.writer.write(path, str(version).encode(), replace=True).wait()
+                if error is not None:
+                    raise error
+                self.versions[chunk_id] = version
+                self.unreported_versions[chunk_id] = version
+        return version >= current
+
+    def set_primary(self, chunk_id, version, expires):
+        """Record the master's grant of the primary lease of chunk_id at version, or forget it when expires is None."""
+        with self.version_lock:
+            if expires is None or version != self.versions.get(chunk_id, 0):
+                self.primaries.pop(chunk_id, None)
+            else:
+                self.primaries[chunk_id] = (version, expires)
+
+    def holds_copy(self, filename, chunk_id, checksum, version):
+        """Whether the chunk is already stored here with this checksum and version."""
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((socket.gethostbyname('localhost'), MASTER_PORT))
-                lease_message = {'command': 'check_lease', 'filename': filename}
-                s.send(pickle.dumps(lease_message))
-                response = pickle.loads(s.recv(4096))
-                return response.get('leased', False)  # Return True if leased, else False
-        except Exception as e:
-            logging.error("Failed to check lease status with master: %s", e)
-            return False  # Assume not leased on failure to contact master
+            with open(os.path.join(self.myChunkDir, f"{filename}_{chunk_id}"), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return False
+        return self.versions.get(chunk_id, 0) == version and self.calculate_checksum(data) == checksum
+
+    def store_chunk(self, client, chunk_id, filename, data, checksum, version=0):
+        """Store chunk data from client, ensuring data integrity and lease status; returns once it is durable."""
+        error, commit = self.start_store(chunk_id, filename, data, checksum)
+        return error or self.finish_store(commit, chunk_id, filename, len(data), version)
 
-    def store_chunk(self, client, chunk_id, filename, data, checksum):
-        """Store chunk data from client, ensuring data integrity and lease status."""
+    def start_store(self, chunk_id, filename, data, checksum):
+        """Validate and write a chunk; returns (error response, None) or (None, Commit to wait on)."""
         try:
             # Check lease before storing
             if self.check_lease(filename):
                 logging.warning("Cannot store chunk %s for file %s because it is currently leased.", chunk_id, filename)
-                return {'status': 'error', 'message': 'File is currently leased'}
+                return {'status': 'error', 'message': 'File is currently leased'}, None
 
-            os.makedirs(self.myChunkDir, exist_ok=True)
             path = os.path.join(self.myChunkDir, f"{filename}_{chunk_id}")
+            os.makedirs(os.path.dirname(path), exist_ok=True)  # Filenames may contain directories
             
             if os.path.exists(path):
-                logging.warning("Chunk %s already exists. Skipping storage.", chunk_id)
-                return {'status': 'error', 'message': 'Chunk already exists'}
+                return self.already_stored(chunk_id), None
 
             # Verify checksum
-            if self.calculate_checksum(data) != checksum:
+            with tracing.span('checksum', chunk_id=chunk_id):
+                valid = self.calculate_checksum(data) == checksum
+            if not valid:
                 logging.error("Checksum mismatch for chunk %s, possible data corruption.", chunk_id)
-                return {'status': 'error', 'message': 'Checksum mismatch'}
+                return {'status': 'error', 'message': 'Checksum mismatch'}, None
 
-            with open(path, 'wb') as f:
-                f.write(data)
-            logging.info("Stored chunk %s successfully.", chunk_id)
+            with tracing.span('disk_write', chunk_id=chunk_id, bytes=len(data)):
+                return None, self.writer.write(path, data)
+        except FileExistsError:  # A concurrent store of the same chunk got there first
+            return self.already_stored(chunk_id), None
+        except Exception as e:
+            logging.error("Failed to store chunk %s: %s", chunk_id, e)
+            return {'status': 'error', 'message': str(e)}, None
+
+    def already_stored(self, chunk_id):
+        """The response refusing to overwrite a stored chunk."""
+        logging.warning("Chunk %s already exists. Skipping storage.", chunk_id)
+        return {'status': 'error', 'message': 'Chunk already exists'}
+
+    def finish_store(self, commit, chunk_id, filename, size, version=0):
+        """Wait until a chunk written by start_store is durable, then record its version and account for it."""
+        with tracing.span('fsync', chunk_id=chunk_id, mode=self.writer.mode):
+            error = commit.wait()
+        if isinstance(error, FileExistsError):
+            return self.already_stored(chunk_id)
+        try:
+            if error is None and version:
+                self.set_version(filename, chunk_id, version)  # A copy of a chunk that took record appends
+        except OSError as e:
+            error = e
+        if error is not None:
+            logging.error("Failed to make chunk %s durable: %s", chunk_id, error)
+            return {'status': 'error', 'message': str(error)}
+        with self.usage_lock:
+            self.used_bytes += size
+        BYTES_IN.inc(size)
+        log_sampled(logging.INFO, 'chunk_stored', chunk_id=chunk_id, bytes=size)
+
+        self.chunkserver_info.append((filename, chunk_id))
+        return {'status': 'success'}
+
+    def append_lock(self, chunk_id):
+        """Return the lock serializing appends to chunk_id, creating it on first use; delete_batch discards it."""
+        lock = self.append_locks.get(chunk_id)
+        if lock is None:
+            lock = self.append_locks.setdefault(chunk_id, threading.Lock())
+        return lock
+
+    def append_record(self, chunk_id, filename, data, checksum, secondaries, version=0):
+        """Append a record as the chunk's primary: pick the offset, write it and mirror it to the secondaries.
+
+        Appends to the same chunk are serialized by a per-chunk lock, so every replica applies
+        records at the offsets chosen here. A record that does not fit is refused with
+        'chunk_full' and the chunk's final length, so the client can seal it and move on.
+        Appends are only taken under the primary lease the master granted this server, and
+        appends under a lease older than the chunk's version are refused.
+        """
+        grant = self.primaries.get(chunk_id)
+        if grant is None or grant[0] != version or time.time() > grant[1]:
+            return {'status': 'error', 'message': 'Not the primary of this chunk', 'lease_refused': True}
+        if self.check_lease(filename):
+            logging.warning("Cannot append to chunk %s for file %s because it is currently leased.", chunk_id, filename)
+            return {'status': 'error', 'message': 'File is currently leased'}
+        with tracing.span('checksum', chunk_id=chunk_id):
+            valid = self.calculate_checksum(data) == checksum
+        if not valid:
+            logging.error("Checksum mismatch for record appended to chunk %s.", chunk_id)
+            return {'status': 'error', 'message': 'Checksum mismatch'}
 
-            self.chunkserver_info.append((filename, chunk_id))
-            self.connect_to_master(filename, chunk_id)
+        path = os.path.join(self.myChunkDir, f"{filename}_{chunk_id}")
+        with self.append_lock(chunk_id):
+            if version < self.versions.get(chunk_id, 0):
+                return {'status': 'error', 'message': 'Primary lease superseded by a newer version'}
+            try:
+                offset = os.path.getsize(path)
+            except FileNotFoundError:
+                offset = 0
+            if offset + len(data) > CHUNK_SIZE:
+                return {'status': 'chunk_full', 'length': offset}
+
+            result = self.write_at(chunk_id, filename, offset, data, version)
+            if result['status'] != 'success':
+                return result
+            for server in secondaries:
+                try:
+                    with tracing.span('replicate', target=server, chunk_id=chunk_id), \
+                            socket.create_connection(server_address(server), timeout=10) as s:
+                        s.sendall(pickle.dumps(tracing.inject({'command': 'append_at', 'filename': filename, 'chunk_id': chunk_id,
+                                                               'offset': offset, 'data': data, 'checksum': checksum,
+                                                               'version': version})))
+                        response = pickle.loads(s.recv(4096))
+                except Exception as e:
+                    response = {'status': 'error', 'message': str(e)}
+                if response.get('status') != 'success':
+                    # The record stays at this offset on some replicas; the client retries it (at-least-once)
+                    logging.error("Secondary %s failed to apply append to chunk %s: %s", server, chunk_id, response.get('message'))
+                    return {'status': 'error', 'message': f'Secondary {server} failed: {response.get("message")}'}
+        return {'status': 'success', 'offset': offset}
+
+    def write_at(self, chunk_id, filename, offset, data, version=0):
+        """Write data at offset in a chunk file under lease version, zero-filling any gap left by a missed record."""
+        try:
+            if not self.set_version(filename, chunk_id, version):
+                return {'status': 'error', 'message': 'Lease superseded by a newer version'}
+            path = os.path.join(self.myChunkDir, f"{filename}_{chunk_id}")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if not os.path.exists(path):
+                try:
+                    error = self.writer.write(path, b'').wait()
+                except FileExistsError as e:
+                    error = e
+                if isinstance(error, FileExistsError):
+                    pass  # Created by a concurrent store of the chunk
+                elif error is not None:
+                    raise error
+                else:
+                    self.chunkserver_info.append((filename, chunk_id))
+            size = os.path.getsize(path)
+            with tracing.span('disk_write', chunk_id=chunk_id, bytes=len(data)), open(path, 'r+b') as f:
+                f.seek(offset)
+                f.write(data)
+            with tracing.span('fsync', chunk_id=chunk_id, mode=self.writer.mode):
+                error = self.writer.written(path, len(data)).wait()
+            if error is not None:
+                raise error
+            with self.usage_lock:
+                self.used_bytes += max(0, offset + len(data) - size)
+            BYTES_IN.inc(len(data))
             return {'status': 'success'}
         except Exception as e:
-            logging.error("Failed to store chunk %s: %s", chunk_id, e)
+            logging.error("Failed to append to chunk %s: %s", chunk_id, e)
             return {'status': 'error', 'message': str(e)}
 
+    def copy_chunk(self, filename, chunk_id, copy_filename, copy_id):
+        """Copy a stored chunk to copy_id of copy_filename, keeping its version; used for copy-on-write after a snapshot.
+
+        The copy is made under the chunk's append lock, so it never catches a record half written.
+        """
+        path = os.path.join(self.myChunkDir, f"{filename}_{chunk_id}")
+        with self.append_lock(chunk_id):
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                if chunk_id not in self.versions:
+                    return {'status': 'error', 'message': 'Chunk not found'}
+                data = b''  # Leased, but no record was appended here yet
+            version = self.versions.get(chunk_id, 0)
+        response = self.store_chunk(None, copy_id, copy_filename, data, self.calculate_checksum(data), version)
+        if response['status'] == 'success':
+            log_sampled(logging.INFO, 'chunk_copied', chunk_id=chunk_id, copy=copy_id, bytes=len(data))
+        return response
+
+    def store_batch(self, client, chunks):
+        """Store many small chunks sent in one message, returning a status per chunk ID.
+
+        Every chunk is written before waiting for any to become durable, so the batch shares group commits.
+        """
+        started = [(chunk, *self.start_store(chunk['chunk_id'], chunk['filename'], chunk['data'], chunk['checksum']))
+                   for chunk in chunks]
+        results = {}
+        for chunk, error, commit in started:
+            results[chunk['chunk_id']] = error or self.finish_store(commit, chunk['chunk_id'], chunk['filename'],
+                                                                    len(chunk['data']), chunk.get('version', 0))
+        log_sampled(logging.INFO, 'batch_stored', chunks=len(chunks))
+        return {'status': 'success', 'results': results}
+
+    def delete_batch(self, chunks):
+        """Delete the stored (filename, chunk_id) pairs the master no longer places here."""
+        freed = 0
+        for filename, chunk_id in chunks:
+            path = os.path.join(self.myChunkDir, f"{filename}_{chunk_id}")
+            self.append_locks.pop(chunk_id, None)
+            with self.version_lock:
+                self.primaries.pop(chunk_id, None)
+                if self.versions.pop(chunk_id, None) is not None:
+                    self.unreported_versions.pop(chunk_id, None)
+                    try:
+                        os.remove(path + VERSION_SUFFIX)
+                    except FileNotFoundError:
+                        pass
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            freed += size
+        with self.usage_lock:
+            self.used_bytes -= freed
+        deleted = {tuple(chunk) for chunk in chunks}
+        self.chunkserver_info = [chunk for chunk in self.chunkserver_info if chunk not in deleted]
+        logging.info("Deleted %d chunks, freeing %d bytes.", len(chunks), freed)
+        return {'status': 'success', 'freed': freed}
+
+    def inventory(self):
+        """List the IDs of the chunks stored here and the versions of those mutated in place.
+
+        The master diffs the inventory against its metadata. A chunk whose version is recorded
+        counts as stored even before its first record is appended.
+        """
+        chunk_ids = set()
+        for root, _, names in os.walk(self.myChunkDir):
+            for name in names:
+                if name.endswith(TEMP_SUFFIX):
+                    continue
+                if name.endswith(VERSION_SUFFIX):
+                    name = name[:-len(VERSION_SUFFIX)]
+                chunk_id = chunk_id_from_path(os.path.relpath(os.path.join(root, name), self.myChunkDir))
+                if chunk_id is not None:
+                    chunk_ids.add(chunk_id)
+        return {'status': 'success', 'chunk_ids': list(chunk_ids), 'versions': dict(self.versions)}
+
     def handle_request(self, client, address):
         """Handle client and chunk server requests."""
+        with self.usage_lock:
+            self.active_requests += 1
+        start = time.perf_counter()
+        command = None
+        label = 'unknown'  # The command as a metric label: clients must not create unbounded label values
+        trace_span = tracing.NOOP
+        profile = profiling.PROFILER.begin()
         try:
-            request = pickle.loads(client.recv(4096))
+            request = pickle.load(client.makefile('rb'))  # Reads exactly one request, however large
             command = request.get('command')
+            if command in COMMANDS:
+                label = command
+            trace_span = tracing.span(f'chunk.{command}', parent=request.get('trace'), server=self.server_id).start()
 
             if command == 'store':
                 filename = request['filename']
@@ -148,7 +658,48 @@ class ChunkServer:
             elif command == 'download':
                 filename = request['filename']
                 chunk_id = request['chunk_id']
-                response = self.send_chunk(client, chunk_id, filename)
+                response = self.send_chunk(client, chunk_id, filename, request.get('version', 0))
+                client.send(pickle.dumps(response))
+
+            elif command == 'store_batch':
+                response = self.store_batch(client, request['chunks'])
+                client.sendall(pickle.dumps(response))
+
+            elif command == 'append':
+                response = self.append_record(request['chunk_id'], request['filename'], request['data'],
+                                              request['checksum'], request['secondaries'], request.get('version', 0))
+                client.send(pickle.dumps(response))
+
+            elif command == 'append_at':
+                with tracing.span('checksum', chunk_id=request['chunk_id']):
+                    valid = self.calculate_checksum(request['data']) == request['checksum']
+                if not valid:
+                    response = {'status': 'error', 'message': 'Checksum mismatch'}
+                else:
+                    response = self.write_at(request['chunk_id'], request['filename'], request['offset'], request['data'],
+                                             request.get('version', 0))
+                client.send(pickle.dumps(response))
+
+            elif command == 'download_batch':
+                self.send_chunk_batch(client, request['chunks'], request.get('versions', {}))
+
+            elif command == 'delete_batch':
+                response = self.delete_batch(request['chunks'])
+                client.sendall(pickle.dumps(response))
+
+            elif command == 'inventory':
+                client.sendall(pickle.dumps(self.inventory()))
+
+            elif command == 'set_version':
+                if self.set_version(request['filename'], request['chunk_id'], request['version']):
+                    self.set_primary(request['chunk_id'], request['version'], request.get('expires'))
+                    response = {'status': 'success'}
+                else:
+                    response = {'status': 'error', 'message': 'Chunk has a newer version'}
+                client.sendall(pickle.dumps(response))
+
+            elif command == 'lease_update':
+                response = self.update_lease(request['filename'], request['expires'])
                 client.send(pickle.dumps(response))
 
             elif command == 'replicate':
@@ -156,23 +707,76 @@ class ChunkServer:
                 chunk_id = request['chunk_id']
                 data = request['data']
                 checksum = request['checksum']
-                response = self.store_chunk(client, chunk_id, filename, data, checksum)
+                # Replicas are placed by the master, which records them once the copy is confirmed
+                if self.holds_copy(filename, chunk_id, checksum, request.get('version', 0)):
+                    response = {'status': 'success'}  # Kept from before this server was declared failed
+                else:
+                    response = self.store_chunk(client, chunk_id, filename, data, checksum, request.get('version', 0))
+                client.send(pickle.dumps(response))
+
+            elif command == 'copy_chunk':
+                response = self.copy_chunk(request['filename'], request['chunk_id'], request['copy_filename'],
+                                           request['copy_id'])
+                client.sendall(pickle.dumps(response))
+
+            elif command == 'replicate_to':
+                response = self.replicate_chunk(request['filename'], request['chunk_id'], request['target'])
                 client.send(pickle.dumps(response))
 
+            elif command == 'metrics':
+                client.sendall(pickle.dumps({'status': 'success', 'metrics': metrics.REGISTRY.render()}))
+
+            elif command == 'profile':
+                client.sendall(pickle.dumps(profiling.PROFILER.handle(request)))
+
+            elif command == 'stacks':
+                client.sendall(pickle.dumps(profiling.thread_stacks()))
+
             client.close()
         except Exception as e:
+            REQUEST_ERRORS.labels(label).inc()
+            trace_span.set(error=str(e))
             logging.error("Error handling request from %s: %s", address, e)
         finally:
+            trace_span.finish()
+            profiling.PROFILER.end(profile)
             client.close()
+            with self.usage_lock:
+                self.active_requests -= 1
+            if command is not None:
+                REQUESTS.labels(label).inc()
+                REQUEST_SECONDS.labels(label).observe(time.perf_counter() - start)
+
+    def send_chunk_batch(self, client, chunks, versions):
+        """Stream the requested (filename, chunk_id) pairs back in order, one pickled response per chunk.
+
+        versions holds the version the reader expects of each chunk mutated in place.
+        """
+        stream = client.makefile('wb')
+        for filename, chunk_id in chunks:
+            response = self.send_chunk(client, chunk_id, filename, versions.get(chunk_id, 0))
+            response['chunk_id'] = chunk_id
+            pickle.dump(response, stream)
+        stream.flush()
+        log_sampled(logging.INFO, 'batch_sent', chunks=len(chunks))
+
+    def send_chunk(self, client, chunk_id, filename, version=0):
+        """Send the requested chunk to client, including checksum for verification.
 
-    def send_chunk(self, client, chunk_id, filename):
-        """Send the requested chunk to client, including checksum for verification."""
+        A replica older than the version the reader expects is refused without being read.
+        """
+        if self.versions.get(chunk_id, 0) < version:
+            log_sampled(logging.WARNING, 'stale_replica_read', chunk_id=chunk_id, version=self.versions.get(chunk_id, 0),
+                        expected=version)
+            return {'status': 'error', 'message': 'Stale replica', 'stale': True, 'version': self.versions.get(chunk_id, 0)}
         try:
             path = os.path.join(self.myChunkDir, f"{filename}_{chunk_id}")
-            with open(path, 'rb') as f:
+            with tracing.span('disk_read', chunk_id=chunk_id), open(path, 'rb') as f:
                 data = f.read()
+            with tracing.span('checksum', chunk_id=chunk_id):
                 checksum = self.calculate_checksum(data)
-                return {'status': 'success', 'data': data, 'checksum': checksum}
+            BYTES_OUT.inc(len(data))
+            return {'status': 'success', 'data': data, 'checksum': checksum}
         except FileNotFoundError:
             logging.error("Requested chunk %s not found", chunk_id)
             return {'status': 'error', 'message': 'Chunk not found'}
@@ -181,11 +785,24 @@ class ChunkServer:
             return {'status': 'error', 'message': str(e)}
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a chunk server that registers itself with the master.")
+    parser.add_argument('port', type=int)
+    parser.add_argument('--host', default='localhost', help="address the server binds to and registers under")
+    parser.add_argument('--dir', help="chunk directory (default: ./chunks/<port>)")
+    parser.add_argument('--master', default=MASTER_ADDRESS, help="master address as host:port")
+    parser.add_argument('--tags', default='', help="comma-separated labels reported to the master")
+    parser.add_argument('--capacity', type=int, default=CAPACITY_BYTES, help="bytes offered to the master (0: disk size)")
+    parser.add_argument('--metrics-port', type=int, help=f"metrics HTTP port (default: port + {METRICS_PORT_OFFSET}, 0 disables)")
+    parser.add_argument('--durability', choices=['none', 'chunk', 'group'], default=DURABILITY,
+                        help="when writes are acked: after the OS has them, after their own fsync, or after a shared one")
+    args = parser.parse_args()
     try:
-        port_num = int(sys.argv[1])
-        filesystem = os.path.join(os.getcwd(), str(port_num - 6466))  # Generates unique directory for each server
-        chunk_server = ChunkServer('localhost', port_num, filesystem, filesystem)
-        logging.info("Starting Chunk Server on port %d", port_num)
+        filesystem = args.dir or os.path.join(os.getcwd(), 'chunks', str(args.port))
+        chunk_server = ChunkServer(args.host, args.port, filesystem, filesystem, args.master,
+                                   [tag for tag in args.tags.split(',') if tag], args.capacity, args.metrics_port,
+                                   args.durability)
+        logging.info("Starting Chunk Server %s with master %s, durability %s", chunk_server.server_id, args.master,
+                     args.durability)
         chunk_server.start()
     except Exception as e:
         logging.critical("Failed to start chunk server: %s", e)
@@ -3,75 +3,339 @@ import os
 import pickle
 import hashlib
 import logging
+import time
+import struct
+import zlib
+import lzma
+import threading
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import erasure
+import logsetup
+import tracing
+from logsetup import log_sampled
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logsetup.setup()
 
 MASTER_SERVER_PORT = 7082
 CHUNK_SIZE = 2048  # Consistent with the chunk size used in Master and ChunkServer
+LIST_PAGE_SIZE = 1000  # Entries fetched per list_files round-trip
+APPEND_RETRIES = 5  # Attempts per record before record_append gives up
+BATCH_UPLOAD_FILES = 1000  # Files allocated per batch_upload master request
+BATCH_STORE_BYTES = 1024 * 1024  # Maximum chunk payload packed into one store_batch message
+DOWNLOAD_WINDOW = 512  # Chunks fetched (and held in memory) per round of batched downloads
+EC_ENCODE_STRIPES = 256  # Erasure-coded stripes read and encoded per encode call on upload
+READ_WORKERS = 16  # Threads reading chunk batches in parallel, hedged requests included
+LATENCY_EWMA_ALPHA = 0.2  # Weight of the newest sample in each server's average per-chunk read latency
+LATENCY_SAMPLES = 256  # Recent per-chunk read latencies kept for the hedging percentile
+FAILED_READ_LATENCY = 1.0  # Seconds counted into a server's average when a read from it fails
+HEDGE_PERCENTILE = 0.95  # Reads still running past this latency percentile are re-issued to another replica
+HEDGE_MIN_SAMPLES = 32  # Latency samples needed before reads are hedged
+
+CODECS = {  # Compression codecs usable with upload_file(codec=...): name -> (compress, decompress)
+    'zlib': (zlib.compress, zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+}
+
+def register_codec(name, compress, decompress):
+    """Make a compression codec available for uploads and downloads under name."""
+    if name == 'none':
+        raise ValueError("'none' is reserved for chunks stored uncompressed")
+    CODECS[name] = (compress, decompress)
+
+def encode_chunk(data, codec):
+    """Compress a chunk and prefix its header: codec name and uncompressed length.
+
+    Chunks that do not shrink are stored as-is under the 'none' codec.
+    """
+    payload = CODECS[codec][0](data)
+    if len(payload) >= len(data):
+        codec, payload = 'none', data
+    name = codec.encode()
+    return struct.pack('>B', len(name)) + name + struct.pack('>I', len(data)) + payload
+
+def decode_chunk(chunk):
+    """Strip the header written by encode_chunk and decompress the payload."""
+    name_length = chunk[0]
+    codec = chunk[1:1 + name_length].decode()
+    raw_length, = struct.unpack_from('>I', chunk, 1 + name_length)
+    payload = chunk[5 + name_length:]
+    data = payload if codec == 'none' else CODECS[codec][1](payload)
+    if len(data) != raw_length:
+        raise ValueError(f"Chunk decoded to {len(data)} bytes, header says {raw_length}")
+    return data
+
+def server_address(server):
+    """Split a chunk server ID ('host:port', as registered with the master) into a (host, port) address."""
+    host, port = server.rsplit(':', 1)
+    return host, int(port)
+
+def chunk_owner(chunk_id):
+    """Return the filename a chunk is stored under on the chunk servers.
+
+    Chunk IDs are '<filename>_chunk_<n>' for the file that first wrote them; deduplicated
+    chunks keep that name when they are linked into other files.
+    """
+    return chunk_id.rsplit('_chunk_', 1)[0]
 
 class Client:
-    def __init__(self, master_host='localhost', master_port=MASTER_SERVER_PORT):
+    def __init__(self, master_host='localhost', master_port=MASTER_SERVER_PORT, timeout=None, tags=(), hedge=True,
+                 read_pool=None):
         self.master_host = master_host
         self.master_port = master_port
+        self.timeout = timeout  # Socket timeout in seconds for master and chunk server calls (None blocks)
+        self.tags = list(tags)  # Proximity labels (rack, zone, ...) the master orders replicas by
+        self.hedge = hedge  # Re-issue reads that exceed HEDGE_PERCENTILE to another replica
+        self.lease_ids = {}  # Lease IDs of files this client holds, used to renew them
+        self.append_targets = {}  # Cached primary/secondaries of the last chunk of files we append to
+        self.stats_lock = threading.Lock()  # Guards the read statistics below
+        self.latency = {}  # EWMA of the per-chunk read latency of each server, in seconds
+        self.in_flight = {}  # Outstanding read requests per server
+        self.latency_samples = deque(maxlen=LATENCY_SAMPLES)
+        # Executor for chunk reads, created on first read unless shared by the caller; hedged stragglers finish on it
+        self.read_pool = read_pool
+
+    def connect(self, host, port):
+        """Open a connection to a master or chunk server honouring the client timeout."""
+        return socket.create_connection((host, port), timeout=self.timeout)
 
     def calculate_checksum(self, data):
         """Calculate the checksum of data for integrity checks."""
         return hashlib.sha256(data).hexdigest()
 
-    def upload_file(self, filename):
-        """Upload a file to the distributed file system."""
+    @tracing.traced('client.upload')
+    def upload_file(self, filename, dedup=False, codec=None, ec=None):
+        """Upload a file to the distributed file system.
+
+        With dedup, the SHA-256 of every chunk is sent to the master first and only chunks
+        whose content is not stored anywhere in the cluster are transferred. With a codec
+        from CODECS, every chunk is compressed before it is sent; the master records the
+        codec so downloads know to decompress. With ec=(k, m) the file is stored once in
+        Reed-Solomon stripes of k data and m parity chunks instead of being replicated.
+        """
+        if codec is not None and codec not in CODECS:
+            return {'status': 'error', 'message': f'Unknown codec {codec}'}
         if not os.path.isfile(filename):
             logging.error("File %s does not exist", filename)
-            return
+            return {'status': 'error', 'message': f'File {filename} does not exist'}
 
         file_size = os.path.getsize(filename)
         num_chunks = (file_size + CHUNK_SIZE - 1) // CHUNK_SIZE  # Calculate number of chunks
+        tracing.annotate(filename=filename, bytes=file_size)
         logging.info("Uploading file %s, size %d bytes, %d chunks", filename, file_size, num_chunks)
 
         # Notify MasterServer about the upload
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as master_sock:
-            master_sock.connect((self.master_host, self.master_port))
-            upload_request = {'command': 'upload', 'filename': filename, 'file_size': file_size}
-            master_sock.send(pickle.dumps(upload_request))
-            response = pickle.loads(master_sock.recv(4096))
+        upload_request = {'command': 'upload', 'filename': filename, 'file_size': file_size, 'codec': codec, 'ec': ec}
+        if dedup:
+            with open(filename, 'rb') as f:
+                upload_request['checksums'] = [self.calculate_checksum(self.encode(f.read(CHUNK_SIZE), codec))
+                                               for _ in range(num_chunks)]
+        response = self.master_request(upload_request)
 
         if response.get('status') != 'success':
             logging.error("Failed to upload file: %s", response.get('message'))
-            return
+            return response
 
         chunk_allocation = response.get('chunks')
-        # Send each chunk to its designated server
+        if ec is not None:
+            failed = self.send_stripes(filename, response['stripes'], ec, chunk_allocation, codec)
+            if failed:
+                logging.error("Failed to store %d chunks of %s", len(failed), filename)
+                self.delete_file(filename)  # Leave no file behind whose chunks were never stored
+                return {'status': 'error', 'message': f'Failed to store {len(failed)} chunks'}
+            return {'status': 'success', 'filename': filename, 'file_size': file_size, 'num_chunks': num_chunks,
+                    'deduplicated': 0}
+
+        # Send each newly allocated chunk to its designated servers; linked chunks are already stored
+        failed = 0
         with open(filename, 'rb') as f:
-            for chunk_id, servers in chunk_allocation.items():
+            for chunk_id in response['chunk_ids']:
                 data = f.read(CHUNK_SIZE)
-                checksum = self.calculate_checksum(data)
+                servers = chunk_allocation.pop(chunk_id, [])
+                if not servers:
+                    continue
+                data = self.encode(data, codec)
+                with tracing.span('checksum', chunk_id=chunk_id):
+                    checksum = self.calculate_checksum(data)
+
+                stored = [self.send_chunk(server, filename, chunk_id, data, checksum) for server in servers]
+                failed += not any(stored)
+
+        if failed:
+            logging.error("Failed to store %d chunks of %s on any server", failed, filename)
+            self.delete_file(filename)
+            return {'status': 'error', 'message': f'Failed to store {failed} chunks'}
+
+        if dedup:
+            # Only now is the content stored, so other uploads may link to it
+            self.master_request({'command': 'index_chunks', 'filename': filename, 'checksums': upload_request['checksums']})
+        if response['deduplicated']:
+            logging.info("Skipped %d of %d chunks of %s already stored in the cluster", response['deduplicated'], num_chunks, filename)
+        return {'status': 'success', 'filename': filename, 'file_size': file_size, 'num_chunks': num_chunks,
+                'deduplicated': response['deduplicated']}
+
+    def send_stripes(self, filename, stripes, ec, chunk_allocation, codec):
+        """Compute parity for every stripe and send all members; returns the chunk IDs that failed."""
+        k, m = ec
+        failed = set()
+        with open(filename, 'rb') as f:
+            for start in range(0, len(stripes), EC_ENCODE_STRIPES):
+                batch = stripes[start:start + EC_ENCODE_STRIPES]
+                data = [[self.encode(f.read(CHUNK_SIZE), codec) for _ in stripe[:-m]] for stripe in batch]
+                per_server = {}
+                for stripe, chunks, parity in zip(batch, data, erasure.parity_chunks(data, k, m)):
+                    for chunk_id, chunk in zip(stripe, chunks + parity):
+                        for server in chunk_allocation.get(chunk_id, []):
+                            per_server.setdefault(server, []).append(
+                                {'filename': filename, 'chunk_id': chunk_id, 'data': chunk,
+                                 'checksum': self.calculate_checksum(chunk)})
+                        if not chunk_allocation.get(chunk_id):
+                            failed.add(chunk_id)
+                with ThreadPoolExecutor(max_workers=max(1, len(per_server))) as pool:
+                    failed.update(*pool.map(tracing.wrap(lambda item: self.send_chunk_batch(*item)), per_server.items()))
+        return failed
+
+    def encode(self, data, codec):
+        """Return chunk data as stored: compressed with a header, or raw when codec is None."""
+        return data if codec is None else encode_chunk(data, codec)
+
+    @tracing.traced('client.upload_files')
+    def upload_files(self, filenames):
+        """Upload many (typically small) files with one master request per batch of files.
+
+        Chunks headed for the same chunk server are packed into store_batch messages of up
+        to BATCH_STORE_BYTES, and the servers of a batch are written to in parallel.
+        """
+        uploaded, errors = 0, {}
+        tracing.annotate(files=len(filenames))
+        for start in range(0, len(filenames), BATCH_UPLOAD_FILES):
+            batch = [f for f in filenames[start:start + BATCH_UPLOAD_FILES] if os.path.isfile(f)]
+            errors.update({f: 'File does not exist' for f in filenames[start:start + BATCH_UPLOAD_FILES] if f not in batch})
+            response = self.master_request({'command': 'batch_upload',
+                                            'files': [(f, os.path.getsize(f)) for f in batch]})
+            if response.get('status') != 'success':
+                logging.error("Batch upload failed: %s", response.get('message'))
+                errors.update({f: response.get('message') for f in batch})
+                continue
+            errors.update(response['errors'])
+
+            # Group every replica of every chunk by destination server
+            per_server = {}
+            for filename, chunk_allocation in response['allocations'].items():
+                with open(filename, 'rb') as f:
+                    for chunk_id, servers in chunk_allocation.items():
+                        data = f.read(CHUNK_SIZE)
+                        chunk = {'filename': filename, 'chunk_id': chunk_id, 'data': data,
+                                 'checksum': self.calculate_checksum(data)}
+                        for server in servers:
+                            per_server.setdefault(server, []).append(chunk)
+
+            with ThreadPoolExecutor(max_workers=max(1, len(per_server))) as pool:
+                failed = pool.map(tracing.wrap(lambda item: self.send_chunk_batch(*item)), per_server.items())
+                failed_chunks = set().union(*failed)
+            for filename, chunk_allocation in response['allocations'].items():
+                if failed_chunks.intersection(chunk_allocation):
+                    errors[filename] = 'Failed to store some chunks'
+                    self.delete_file(filename)
+                else:
+                    uploaded += 1
+
+        logging.info("Uploaded %d files in batches, %d failed", uploaded, len(errors))
+        return {'status': 'success' if not errors else 'error', 'uploaded': uploaded, 'errors': errors}
 
-                for server_port in servers:
-                    self.send_chunk(server_port, filename, chunk_id, data, checksum)
+    def send_chunk_batch(self, server, chunks):
+        """Send chunks to one ChunkServer in store_batch messages; returns the IDs that failed."""
+        batches, batch, batch_bytes = [], [], 0
+        for chunk in chunks:
+            if batch and batch_bytes + len(chunk['data']) > BATCH_STORE_BYTES:
+                batches.append(batch)
+                batch, batch_bytes = [], 0
+            batch.append(chunk)
+            batch_bytes += len(chunk['data'])
+        if batch:
+            batches.append(batch)
 
-    def send_chunk(self, server_port, filename, chunk_id, data, checksum):
-        """Send a single chunk to a ChunkServer."""
+        failed = set()
+        for batch in batches:
+            try:
+                with tracing.span('replica.send', server=server, chunks=len(batch)), self.connect(*server_address(server)) as s:
+                    s.sendall(pickle.dumps(tracing.inject({'command': 'store_batch', 'chunks': batch})))
+                    results = pickle.load(s.makefile('rb'))['results']
+                failed.update(chunk_id for chunk_id, result in results.items() if result.get('status') != 'success')
+            except Exception as e:
+                logging.error("Error sending chunk batch to server %s: %s", server, e)
+                failed.update(chunk['chunk_id'] for chunk in batch)
+        return failed
+
+    def send_chunk(self, server, filename, chunk_id, data, checksum):
+        """Send a single chunk to a ChunkServer; returns whether it was stored."""
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect(('localhost', server_port))
+            with tracing.span('replica.send', server=server, chunk_id=chunk_id), self.connect(*server_address(server)) as s:
                 chunk_request = {'command': 'store', 'filename': filename, 'chunk_id': chunk_id, 'data': data, 'checksum': checksum}
-                s.send(pickle.dumps(chunk_request))
+                s.send(pickle.dumps(tracing.inject(chunk_request)))
                 response = pickle.loads(s.recv(4096))
 
                 if response.get('status') == 'success':
-                    logging.info("Successfully stored chunk %s on server %d", chunk_id, server_port)
-                else:
-                    logging.error("Failed to store chunk %s on server %d: %s", chunk_id, server_port, response.get('message'))
+                    log_sampled(logging.INFO, 'chunk_stored', chunk_id=chunk_id, server=server)
+                    return True
+                logging.error("Failed to store chunk %s on server %s: %s", chunk_id, server, response.get('message'))
         except Exception as e:
-            logging.error("Error sending chunk %s to server %d: %s", chunk_id, server_port, e)
-
-    def download_file(self, filename):
-        """Download a file from the distributed file system."""
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as master_sock:
-            master_sock.connect((self.master_host, self.master_port))
-            download_request = {'command': 'download', 'filename': filename}
-            master_sock.send(pickle.dumps(download_request))
-            response = pickle.loads(master_sock.recv(4096))
+            logging.error("Error sending chunk %s to server %s: %s", chunk_id, server, e)
+        return False
+
+    @tracing.traced('client.record_append')
+    def record_append(self, filename, data):
+        """Atomically append a record to filename; returns (chunk_id, offset) or None.
+
+        The primary replica of the file's last chunk picks the offset, so any number of
+        producers can append to the same file concurrently. Retries can duplicate a record
+        (at-least-once), but a record is never split or interleaved with another.
+        """
+        checksum = self.calculate_checksum(data)
+        request = {'command': 'record_append', 'filename': filename, 'size': len(data)}
+        for _ in range(APPEND_RETRIES):
+            target = self.append_targets.get(filename)
+            if target is None or target['expires'] < time.time():
+                target = self.master_request(request)
+                if target.get('status') != 'success':
+                    logging.error("Failed to append to %s: %s", filename, target.get('message'))
+                    return None
+                self.append_targets[filename] = target
+                request = {'command': 'record_append', 'filename': filename, 'size': len(data)}
+
+            # A snapshot's inherited chunks are stored under the name of the file that created them
+            append_request = {'command': 'append', 'filename': chunk_owner(target['chunk_id']),
+                              'chunk_id': target['chunk_id'], 'data': data, 'checksum': checksum, 'secondaries': target['secondaries'],
+                              'version': target.get('version', 0)}
+            try:
+                with tracing.span('replica.append', server=target['primary']), \
+                        self.connect(*server_address(target['primary'])) as s:
+                    s.sendall(pickle.dumps(tracing.inject(append_request)))
+                    response = pickle.loads(s.recv(4096))
+            except Exception as e:
+                response = {'status': 'error', 'message': str(e)}
+
+            if response.get('status') == 'success':
+                return target['chunk_id'], response['offset']
+            self.append_targets.pop(filename, None)
+            if response.get('status') == 'chunk_full':
+                # Ask the master to seal this chunk and move appends to a fresh one
+                request['full_chunk_id'] = target['chunk_id']
+                request['sealed_size'] = response['length']
+            else:
+                if response.get('lease_refused'):
+                    request['refused_chunk_id'] = target['chunk_id']  # Have the master grant a new lease
+                logging.warning("Append to %s via server %s failed: %s", filename, target['primary'], response.get('message'))
+
+        logging.error("Giving up appending to %s after %d attempts", filename, APPEND_RETRIES)
+        return None
+
+    @tracing.traced('client.download')
+    def download_file(self, filename, output=None):
+        """Download a file from the distributed file system into output (default downloaded_<filename>)."""
+        tracing.annotate(filename=filename)
+        response = self.master_request({'command': 'download', 'filename': filename, 'tags': self.tags})
 
         if response.get('status') != 'success':
             logging.error("Failed to download file: %s", response.get('message'))
@@ -82,81 +346,396 @@ class Client:
             logging.error("No chunks found for file %s", filename)
             return
 
-        # Reconstruct the file by downloading each chunk
-        with open(f"downloaded_{filename}", 'wb') as f:
-            for chunk_id, servers in chunk_locations.items():
-                data = self.retrieve_chunk(servers, filename, chunk_id)
-                if data:
-                    f.write(data)
-                else:
-                    logging.error("Failed to retrieve chunk %s for file %s", chunk_id, filename)
+        # Reconstruct the file window by window, fetching each window with batched requests.
+        # Compressed windows are decoded on a worker thread while the next window is fetched.
+        codec = response.get('codec')
+        versions = response.get('versions') or {}
+        recover = None
+        if response.get('ec'):
+            # Chunks lost from an erasure-coded file are rebuilt from the rest of their stripe
+            stripe_of = {chunk_id: stripe for stripe in response['stripes'] for chunk_id in stripe}
+            recovered = {}
+
+            def recover(chunk_id):
+                if chunk_id not in recovered:
+                    recovered.update(self.recover_stripe(stripe_of[chunk_id], response['ec'], chunk_locations, versions))
+                return recovered.pop(chunk_id, None)
+
+        chunks = [(chunk_id, chunk_locations[chunk_id]) for chunk_id in response['chunk_ids']]
+        output = output or f"downloaded_{filename}"
+        with open(output, 'wb') as f, ThreadPoolExecutor(max_workers=1) as decoder:
+            pending = None
+            for start in range(0, len(chunks), DOWNLOAD_WINDOW):
+                window = self.fetch_window(chunks[start:start + DOWNLOAD_WINDOW], recover, versions)
+                if window is None:
+                    logging.error("Failed to retrieve file %s", filename)
                     return
+                if pending is not None:
+                    f.write(b''.join(pending.result()))
+                pending = decoder.submit(lambda w: [decode_chunk(c) for c in w] if codec else w, window)
+            if pending is not None:
+                f.write(b''.join(pending.result()))
 
-        logging.info("File %s downloaded successfully as downloaded_%s", filename, filename)
+        logging.info("File %s downloaded successfully as %s", filename, output)
+
+    def fetch_window(self, window, recover=None, versions=None):
+        """Fetch a window of (chunk_id, servers) pairs in order; returns the chunk data list or None.
+
+        recover, if given, is called with the ID of a chunk no replica could serve. versions
+        maps chunks mutated in place to the version a replica must hold to be read.
+        """
+        versions = versions or {}
+        fetched = self.fetch_chunks(window, versions)
+        for chunk_id, servers in window:
+            if fetched.get(chunk_id) is None:
+                # Fall back to trying every replica of the chunk one by one
+                fetched[chunk_id] = self.retrieve_chunk(servers, chunk_owner(chunk_id), chunk_id, versions.get(chunk_id, 0))
+            if fetched[chunk_id] is None and recover is not None:
+                logging.warning("Reconstructing chunk %s from its stripe", chunk_id)
+                fetched[chunk_id] = recover(chunk_id)
+            if fetched[chunk_id] is None:
+                logging.error("Failed to retrieve chunk %s", chunk_id)
+                return None
+        return [fetched[chunk_id] for chunk_id, _ in window]
+
+    def recover_stripe(self, stripe, ec, chunk_locations, versions=None):
+        """Decode the missing data chunks of an erasure-coded stripe; returns {chunk_id: data}."""
+        k, m = ec
+        data_ids, parity_ids = stripe[:-m], stripe[-m:]
+        fetched = self.fetch_chunks([(chunk_id, chunk_locations.get(chunk_id, [])) for chunk_id in stripe], versions)
+        try:
+            data = erasure.recover_chunks([fetched.get(chunk_id) for chunk_id in data_ids],
+                                          [fetched.get(chunk_id) for chunk_id in parity_ids], k, m)
+        except ValueError as e:
+            logging.error("Cannot reconstruct stripe %s: %s", stripe[-1], e)
+            return {}
+        return {chunk_id: chunk for chunk_id, chunk in zip(data_ids, data) if chunk_id not in fetched}
+
+    @contextmanager
+    def track_read(self, server, num_chunks=1):
+        """Count a read against the server's in-flight requests and fold its latency into the averages."""
+        with self.stats_lock:
+            self.in_flight[server] = self.in_flight.get(server, 0) + 1
+        start = time.perf_counter()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            per_chunk = FAILED_READ_LATENCY if failed else (time.perf_counter() - start) / max(1, num_chunks)
+            with self.stats_lock:
+                self.in_flight[server] -= 1
+                previous = self.latency.get(server)
+                self.latency[server] = per_chunk if previous is None else previous + LATENCY_EWMA_ALPHA * (per_chunk - previous)
+                if not failed:
+                    self.latency_samples.append(per_chunk)
 
-    def retrieve_chunk(self, servers, filename, chunk_id):
-        """Retrieve a chunk from available servers and verify its checksum."""
-        for server_port in servers:
+    def replica_cost(self, server, queued=0):
+        """Expected seconds until a read from server completes: its latency times the reads ahead of it.
+
+        Servers not read from yet are assumed as fast as the fastest known one, so they get tried.
+        """
+        with self.stats_lock:
+            latency = self.latency.get(server)
+            if latency is None:
+                latency = min(self.latency.values(), default=1.0)
+            return latency * (self.in_flight.get(server, 0) + queued + 1)
+
+    def assign_replicas(self, chunks):
+        """Group (chunk_id, servers) pairs by the cheapest replica of each chunk; returns {server: [chunk_id]}.
+
+        Ties keep the master's replica order, so its placement policy decides until latencies are known.
+        """
+        per_server = {}
+        for chunk_id, servers in chunks:
+            if servers:
+                server = min(servers, key=lambda s: self.replica_cost(s, len(per_server.get(s, ()))))
+                per_server.setdefault(server, []).append(chunk_id)
+        return per_server
+
+    def hedge_delay(self, num_chunks):
+        """Return how long a read of num_chunks may run before it is hedged, or None if hedging is off."""
+        with self.stats_lock:
+            if not self.hedge or len(self.latency_samples) < HEDGE_MIN_SAMPLES:
+                return None
+            samples = sorted(self.latency_samples)
+        return samples[int(len(samples) * HEDGE_PERCENTILE)] * num_chunks
+
+    def fetch_chunks(self, chunks, versions=None):
+        """Fetch (chunk_id, servers) pairs with one download_batch request per chosen replica.
+
+        Each chunk is read from the replica with the lowest expected completion time and the
+        servers are read in parallel. Batches still running past the hedge delay are re-issued
+        to the chunks' other replicas and whichever copy arrives first is used. Returns
+        {chunk_id: data} for the chunks that arrived intact.
+        """
+        with self.stats_lock:
+            if self.read_pool is None:
+                self.read_pool = ThreadPoolExecutor(max_workers=READ_WORKERS)
+        per_server = self.assign_replicas(chunks)
+        retrieve = tracing.wrap(self.retrieve_chunk_batch)
+        requests = {self.read_pool.submit(retrieve, server, chunk_ids, versions): (server, chunk_ids)
+                    for server, chunk_ids in per_server.items()}
+        delay = self.hedge_delay(max((len(chunk_ids) for chunk_ids in per_server.values()), default=0))
+        done, pending = wait(requests, timeout=delay)
+        fetched = {}
+        for request in done:
+            fetched.update(request.result())
+        if not pending:
+            return fetched
+
+        slow = {requests[request][0] for request in pending}
+        outstanding = {chunk_id for request in pending for chunk_id in requests[request][1]}
+        hedges = self.assign_replicas([(chunk_id, [s for s in servers if s not in slow])
+                                       for chunk_id, servers in chunks if chunk_id in outstanding])
+        log_sampled(logging.INFO, 'reads_hedged', chunks=len(outstanding), slow_servers=','.join(sorted(slow)))
+        pending |= {self.read_pool.submit(retrieve, server, chunk_ids, versions) for server, chunk_ids in hedges.items()}
+        while pending and not outstanding <= fetched.keys():
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for request in done:
+                fetched.update(request.result())
+        return fetched
+
+    def retrieve_chunk_batch(self, server, chunk_ids, versions=None):
+        """Stream several chunks from one ChunkServer over a single connection, verifying each checksum.
+
+        Replicas older than their chunk's entry in versions are refused by the server and reported to the master.
+        """
+        fetched = {}
+        try:
+            with tracing.span('replica.fetch', server=server, chunks=len(chunk_ids)), \
+                    self.track_read(server, len(chunk_ids)), self.connect(*server_address(server)) as s:
+                chunks = [(chunk_owner(chunk_id), chunk_id) for chunk_id in chunk_ids]
+                versions = {chunk_id: versions[chunk_id] for chunk_id in chunk_ids if chunk_id in versions} if versions else {}
+                s.sendall(pickle.dumps(tracing.inject({'command': 'download_batch', 'chunks': chunks, 'versions': versions})))
+                stream = s.makefile('rb')
+                for _ in chunk_ids:
+                    response = pickle.load(stream)
+                    chunk_id = response['chunk_id']
+                    if response.get('stale'):
+                        self.report_stale(server, chunk_id, response['version'])
+                    elif response.get('status') != 'success':
+                        logging.warning("Failed to retrieve chunk %s from server %s: %s", chunk_id, server, response.get('message'))
+                    elif self.calculate_checksum(response['data']) != response['checksum']:
+                        logging.warning("Checksum mismatch for chunk %s from server %s", chunk_id, server)
+                    else:
+                        fetched[chunk_id] = response['data']
+        except Exception as e:
+            logging.error("Failed to retrieve chunk batch from server %s: %s", server, e)
+        return fetched
+
+    def retrieve_chunk(self, servers, filename, chunk_id, version=0):
+        """Retrieve a chunk from available servers, cheapest first, and verify its checksum."""
+        for server in sorted(servers, key=self.replica_cost):
             try:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    s.connect(('localhost', server_port))
-                    download_request = {'command': 'download', 'filename': filename, 'chunk_id': chunk_id}
-                    s.send(pickle.dumps(download_request))
+                with tracing.span('replica.fetch', server=server, chunk_id=chunk_id), \
+                        self.track_read(server), self.connect(*server_address(server)) as s:
+                    download_request = {'command': 'download', 'filename': filename, 'chunk_id': chunk_id,
+                                        'version': version}
+                    s.send(pickle.dumps(tracing.inject(download_request)))
                     response = pickle.loads(s.recv(4096))
 
-                if response.get('status') == 'success':
+                if response.get('stale'):
+                    self.report_stale(server, chunk_id, response['version'])
+                elif response.get('status') == 'success':
                     data = response['data']
                     checksum = response['checksum']
                     if self.calculate_checksum(data) == checksum:
-                        logging.info("Successfully retrieved and verified chunk %s from server %d", chunk_id, server_port)
+                        log_sampled(logging.INFO, 'chunk_retrieved', chunk_id=chunk_id, server=server)
                         return data
                     else:
-                        logging.warning("Checksum mismatch for chunk %s from server %d, trying next server", chunk_id, server_port)
+                        logging.warning("Checksum mismatch for chunk %s from server %s, trying next server", chunk_id, server)
             except Exception as e:
-                logging.error("Failed to retrieve chunk %s from server %d: %s", chunk_id, server_port, e)
+                logging.error("Failed to retrieve chunk %s from server %s: %s", chunk_id, server, e)
 
         return None
 
-    def list_files(self):
-        """Request a list of files from the MasterServer."""
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as master_sock:
-            master_sock.connect((self.master_host, self.master_port))
-            list_request = {'command': 'list_files'}
-            master_sock.send(pickle.dumps(list_request))
-            response = pickle.loads(master_sock.recv(4096))
+    def report_stale(self, server, chunk_id, version):
+        """Tell the MasterServer that server holds chunk_id at an outdated version, so it drops the replica."""
+        logging.warning("Skipping stale replica of chunk %s on server %s (version %d)", chunk_id, server, version)
+        try:
+            self.master_request({'command': 'stale_replica', 'server': server, 'chunk_id': chunk_id, 'version': version})
+        except Exception as e:
+            logging.warning("Failed to report stale replica of chunk %s on server %s: %s", chunk_id, server, e)
+
+    def iter_files(self, prefix='', delimiter=None, page_size=LIST_PAGE_SIZE):
+        """Yield file and directory entries under prefix, fetching one page at a time."""
+        cursor = None
+        while True:
+            list_request = {'command': 'list_files', 'prefix': prefix, 'delimiter': delimiter,
+                            'cursor': cursor, 'limit': page_size}
+            response = self.master_request(list_request)
+            if response.get('status') != 'success':
+                logging.error("Failed to retrieve file list: %s", response.get('message'))
+                return
+            for directory in response['dirs']:
+                yield {'name': directory, 'dir': True}
+            yield from response['files']
+            cursor = response['next_cursor']
+            if cursor is None:
+                return
+
+    def list_files(self, prefix='', delimiter=None):
+        """Print the files (and, with a delimiter, sub-directories) stored under prefix."""
+        logging.info("Files available on the server:")
+        for entry in self.iter_files(prefix, delimiter):
+            if entry.get('dir'):
+                print(entry['name'])
+            else:
+                print(f"{entry['name']}\t{entry['size']} bytes")
+
+    def master_request(self, request):
+        """Send a request to the MasterServer and read the complete pickled response."""
+        with tracing.span('master_rpc', command=request.get('command')), \
+                self.connect(self.master_host, self.master_port) as master_sock:
+            master_sock.sendall(pickle.dumps(tracing.inject(request)))
+            return pickle.load(master_sock.makefile('rb'))
+
+    def list_servers(self):
+        """Fetch the master's chunk server membership table."""
+        response = self.master_request({'command': 'list_servers'})
+        if response.get('status') != 'success':
+            logging.error("Failed to list chunk servers: %s", response.get('message'))
+        return response
+
+    def admin_request(self, request, server=None):
+        """Send an admin request to the master, or to the chunk server 'host:port', and return the response."""
+        if server is None:
+            return self.master_request(request)
+        with self.connect(*server_address(server)) as s:
+            s.sendall(pickle.dumps(request))
+            return pickle.load(s.makefile('rb'))
 
-        if isinstance(response, list):
-            logging.info("Files available on the server:")
-            for file in response:
-                print(file)
+    def metrics(self, server=None):
+        """Fetch the Prometheus text metrics of the master, or of the chunk server 'host:port'."""
+        response = self.admin_request({'command': 'metrics'}, server)
+        if response.get('status') != 'success':
+            logging.error("Failed to retrieve metrics: %s", response.get('message'))
+        return response.get('metrics')
+
+    def profile(self, action='status', server=None, mode='sampling', seconds=60):
+        """Start, stop or query a profile of the master or a chunk server without restarting it.
+
+        start runs a 'sampling' or 'cprofile' profile for at most seconds; stop (or the time
+        running out) writes it on the server and returns the path and a summary of the hotspots.
+        """
+        response = self.admin_request({'command': 'profile', 'action': action, 'mode': mode, 'seconds': seconds}, server)
+        if response.get('status') != 'success':
+            logging.error("Profile %s failed: %s", action, response.get('message'))
+        return response
+
+    def thread_stacks(self, server=None):
+        """Fetch the thread count and the current stack of every thread of the master or a chunk server."""
+        response = self.admin_request({'command': 'stacks'}, server)
+        if response.get('status') != 'success':
+            logging.error("Failed to retrieve thread stacks: %s", response.get('message'))
+        return response
+
+    def storage_usage(self):
+        """Fetch cluster and per-server storage counters from the MasterServer."""
+        response = self.master_request({'command': 'storage_usage'})
+        if response.get('status') != 'success':
+            logging.error("Failed to retrieve storage usage: %s", response.get('message'))
+        return response
+
+    def run_tiering(self, idle_seconds=None):
+        """Have the MasterServer erasure code cold files now instead of on its next scan."""
+        request = {'command': 'run_tiering'}
+        if idle_seconds is not None:
+            request['idle_seconds'] = idle_seconds
+        response = self.master_request(request)
+        if response.get('status') != 'success':
+            logging.error("Tiering pass failed: %s", response.get('message'))
+        return response
+
+    def delete_file(self, filename):
+        """Delete a file; the master hides it and reclaims its chunks after a grace period."""
+        response = self.master_request({'command': 'delete', 'filename': filename})
+        if response.get('status') == 'success':
+            logging.info("Deleted file %s", filename)
         else:
-            logging.error("Failed to retrieve file list: %s", response.get('message'))
+            logging.error("Failed to delete file %s: %s", filename, response.get('message'))
+        return response
+
+    def snapshot(self, src, dst):
+        """Copy src to dst on the MasterServer; only metadata is copied, chunks are shared until one file is appended to."""
+        response = self.master_request({'command': 'snapshot', 'src': src, 'dst': dst})
+        if response.get('status') == 'success':
+            logging.info("Snapshot of %s taken as %s", src, dst)
+        else:
+            logging.error("Failed to snapshot %s as %s: %s", src, dst, response.get('message'))
+        return response
+
+    def collect_garbage(self, grace_seconds=None):
+        """Have the MasterServer reclaim deleted files and remove orphaned chunk files now.
+
+        grace_seconds overrides how long ago a file must have been deleted to be reclaimed.
+        """
+        request = {'command': 'gc'}
+        if grace_seconds is not None:
+            request['grace_seconds'] = grace_seconds
+        response = self.master_request(request)
+        if response.get('status') != 'success':
+            logging.error("Garbage collection failed: %s", response.get('message'))
+        return response
+
+    def checkpoint(self):
+        """Have the MasterServer fold its metadata journal into a checkpoint now."""
+        response = self.master_request({'command': 'checkpoint'})
+        if response.get('status') != 'success':
+            logging.error("Checkpoint failed: %s", response.get('message'))
+        return response
+
+    def file_stats(self, prefix='', cursor=None, limit=None):
+        """Fetch one page of file sizes, modification times and replica counts under prefix."""
+        request = {'command': 'file_stats', 'prefix': prefix, 'cursor': cursor}
+        if limit is not None:
+            request['limit'] = limit
+        response = self.master_request(request)
+        if response.get('status') != 'success':
+            logging.error("Failed to retrieve file stats: %s", response.get('message'))
+        return response
 
     def lease_file(self, filename):
         """Request an exclusive lease on a file."""
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as master_sock:
-            master_sock.connect((self.master_host, self.master_port))
+        with self.connect(self.master_host, self.master_port) as master_sock:
             lease_request = {'command': 'lease', 'filename': filename}
             master_sock.send(pickle.dumps(lease_request))
             response = pickle.loads(master_sock.recv(4096))
 
         if response.get('status') == 'success':
+            self.lease_ids[filename] = response.get('lease_id')
             logging.info("Lease granted for file %s", filename)
         else:
             logging.warning("Lease request failed for file %s: %s", filename, response.get('message'))
+        return response
+
+    def renew_lease(self, filename):
+        """Extend a lease previously granted to this client."""
+        if filename not in self.lease_ids:
+            return {'status': 'error', 'message': f'No lease held on {filename}'}
+        response = self.master_request({'command': 'renew_lease', 'filename': filename,
+                                        'lease_id': self.lease_ids[filename]})
+        if response.get('status') == 'success':
+            logging.info("Lease renewed for file %s", filename)
+        else:
+            self.lease_ids.pop(filename, None)
+            logging.warning("Lease renewal failed for file %s: %s", filename, response.get('message'))
+        return response
 
     def unlease_file(self, filename):
         """Release the exclusive lease on a file."""
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as master_sock:
-            master_sock.connect((self.master_host, self.master_port))
+        with self.connect(self.master_host, self.master_port) as master_sock:
             unlease_request = {'command': 'unlease', 'filename': filename}
             master_sock.send(pickle.dumps(unlease_request))
             response = pickle.loads(master_sock.recv(4096))
 
+        self.lease_ids.pop(filename, None)
         if response.get('status') == 'success':
             logging.info("Lease released for file %s", filename)
         else:
             logging.warning("Failed to release lease for file %s: %s", filename, response.get('message'))
+        return response
 
     def run(self):
         """Run the client interaction loop."""
@@ -167,9 +746,11 @@ class Client:
             print("3. List Files")
             print("4. Lease File")
             print("5. Unlease File")
-            print("6. Exit")
+            print("6. Delete File")
+            print("7. Snapshot File")
+            print("8. Exit")
 
-            choice = input("Enter your choice (1-6): ").strip()
+            choice = input("Enter your choice (1-8): ").strip()
             if choice == '1':
                 filename = input("Enter the filename to upload: ").strip()
                 self.upload_file(filename)
@@ -177,7 +758,8 @@ class Client:
                 filename = input("Enter the filename to download: ").strip()
                 self.download_file(filename)
             elif choice == '3':
-                self.list_files()
+                prefix = input("Enter a directory prefix (blank for all files): ").strip()
+                self.list_files(prefix, '/' if prefix.endswith('/') else None)
             elif choice == '4':
                 filename = input("Enter the filename to lease: ").strip()
                 self.lease_file(filename)
@@ -185,6 +767,13 @@ class Client:
                 filename = input("Enter the filename to unlease: ").strip()
                 self.unlease_file(filename)
             elif choice == '6':
+                filename = input("Enter the filename to delete: ").strip()
+                self.delete_file(filename)
+            elif choice == '7':
+                src = input("Enter the filename to snapshot: ").strip()
+                dst = input("Enter the name of the snapshot: ").strip()
+                self.snapshot(src, dst)
+            elif choice == '8':
                 print("Exiting client.")
                 break
             else:
@@ -0,0 +1,219 @@
+import sys
+import os
+import time
+import struct
+
+try:
+    import numpy as np
+except ImportError:  # Optional: only the vectorized arithmetic needs NumPy
+    np = None
+
+GF_POLYNOMIAL = 0x11d  # x^8 + x^4 + x^3 + x^2 + 1, the usual Reed-Solomon field polynomial
+VECTORIZE_MIN_BYTES = 8192  # Below this shard length NumPy's per-call overhead outweighs its speed
+
+# Log/antilog tables for GF(256); EXP is doubled so products of logs never need a modulo
+EXP = [0] * 512
+LOG = [0] * 256
+_x = 1
+for _i in range(255):
+    EXP[_i] = _x
+    LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= GF_POLYNOMIAL
+for _i in range(255, 512):
+    EXP[_i] = EXP[_i - 255]
+
+
+def gf_mul(a, b):
+    """Multiply two elements of GF(256)."""
+    if a == 0 or b == 0:
+        return 0
+    return EXP[LOG[a] + LOG[b]]
+
+
+def gf_inv(a):
+    """Return the multiplicative inverse of a non-zero element of GF(256)."""
+    if a == 0:
+        raise ZeroDivisionError("0 has no inverse in GF(256)")
+    return EXP[255 - LOG[a]]
+
+
+# MUL_TABLES[c] maps every byte x to c*x, usable with bytes.translate and as a NumPy lookup table
+MUL_TABLES = [bytes(gf_mul(c, x) for x in range(256)) for c in range(256)]
+MUL_ARRAY = np.frombuffer(b''.join(MUL_TABLES), dtype=np.uint8).reshape(256, 256) if np is not None else None
+
+
+def parity_matrix(k, m):
+    """Return the m x k Cauchy matrix generating parity; [I; C] has every k x k minor invertible."""
+    if k < 1 or m < 0 or k + m > 256:
+        raise ValueError(f"Unsupported Reed-Solomon parameters k={k}, m={m}")
+    return [[gf_inv((k + i) ^ j) for j in range(k)] for i in range(m)]
+
+
+def invert_matrix(matrix):
+    """Invert a square matrix over GF(256) by Gauss-Jordan elimination."""
+    n = len(matrix)
+    rows = [list(row) + [int(i == j) for j in range(n)] for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = next((r for r in range(col, n) if rows[r][col]), None)
+        if pivot is None:
+            raise ValueError("Matrix is singular")
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        scale = gf_inv(rows[col][col])
+        rows[col] = [gf_mul(scale, v) for v in rows[col]]
+        for r in range(n):
+            factor = rows[r][col]
+            if r != col and factor:
+                rows[r] = [v ^ gf_mul(factor, p) for v, p in zip(rows[r], rows[col])]
+    return [row[n:] for row in rows]
+
+
+def _combine_python(coefficients, shards):
+    """Return sum(c * shard) over GF(256): translate does the multiply, big-int XOR does the add."""
+    length = len(shards[0])
+    acc = 0
+    for c, shard in zip(coefficients, shards):
+        if c:
+            acc ^= int.from_bytes(shard if c == 1 else shard.translate(MUL_TABLES[c]), 'little')
+    return acc.to_bytes(length, 'little')
+
+
+_WIDE_TABLES = {}  # Coefficient -> 65536-entry uint16 table multiplying two bytes per lookup
+
+
+def _wide_table(c):
+    """Return the table mapping a uint16 holding two bytes to the uint16 holding both products."""
+    table = _WIDE_TABLES.get(c)
+    if table is None:
+        narrow = MUL_ARRAY[c].astype(np.uint16)
+        table = _WIDE_TABLES[c] = (narrow[:, None] << 8 | narrow[None, :]).ravel()
+    return table
+
+
+def _combine_numpy(coefficients, shards):
+    """Vectorized sum(c * shard) over GF(256), multiplying two bytes per table lookup."""
+    length = len(shards[0])
+    even = length & ~1
+    acc = np.zeros(even // 2, dtype=np.uint16)
+    tail = 0
+    for c, shard in zip(coefficients, shards):
+        if c:
+            data = np.frombuffer(shard, dtype=np.uint16, count=even // 2)
+            acc ^= data if c == 1 else np.take(_wide_table(c), data)
+            if length & 1:
+                tail ^= MUL_TABLES[c][shard[-1]]
+    return acc.tobytes() + (bytes([tail]) if length & 1 else b'')
+
+
+def _combiner(vectorized, length):
+    if vectorized is None:
+        vectorized = np is not None and length >= VECTORIZE_MIN_BYTES
+    if vectorized and np is None:
+        raise RuntimeError("Vectorized erasure coding requires NumPy")
+    return _combine_numpy if vectorized else _combine_python
+
+
+def encode(shards, m, vectorized=None):
+    """Return the m parity shards of k equal-length data shards.
+
+    vectorized selects the NumPy arithmetic (by default used for long shards when NumPy is
+    installed); the pure-Python path produces identical output.
+    """
+    if len({len(shard) for shard in shards}) > 1:
+        raise ValueError("Data shards must have equal length")
+    combine = _combiner(vectorized, len(shards[0]))
+    return [combine(row, shards) for row in parity_matrix(len(shards), m)]
+
+
+def decode(shards, k, m, vectorized=None):
+    """Recover the k data shards from k + m shards where missing ones are None.
+
+    Any k present shards (data or parity) are enough.
+    """
+    if len(shards) != k + m:
+        raise ValueError(f"Expected {k + m} shards, got {len(shards)}")
+    if all(shard is not None for shard in shards[:k]):
+        return list(shards[:k])
+    present = [i for i, shard in enumerate(shards) if shard is not None][:k]
+    if len(present) < k:
+        raise ValueError(f"Need {k} shards to decode, only {len(present)} available")
+
+    generator = [[int(i == j) for j in range(k)] for i in range(k)] + parity_matrix(k, m)
+    decoder = invert_matrix([generator[i] for i in present])
+    combine = _combiner(vectorized, len(shards[present[0]]))
+    available = [shards[i] for i in present]
+    return [shards[i] if shards[i] is not None else combine(decoder[i], available) for i in range(k)]
+
+
+def encode_stripes(stripes, k, m, vectorized=None):
+    """Return the m parity shards of each of many stripes, computed in a single encode call.
+
+    A stripe is a list of up to k data shards of any length; shards are zero-padded to the
+    longest one in their stripe and absent shards count as all zeros. The code works byte
+    by byte, so stripes are concatenated column-wise and share one pass of the arithmetic.
+    """
+    widths = [max(len(shard) for shard in stripe) for stripe in stripes]
+    columns = [b''.join(stripe[j].ljust(width, b'\0') if j < len(stripe) else bytes(width)
+                        for stripe, width in zip(stripes, widths)) for j in range(k)]
+    parity = encode(columns, m, vectorized)
+    result, offset = [], 0
+    for width in widths:
+        result.append([shard[offset:offset + width] for shard in parity])
+        offset += width
+    return result
+
+
+def parity_chunks(stripes, k, m, vectorized=None):
+    """Return the parity chunks to store for each stripe of data chunks.
+
+    Each parity chunk starts with the lengths of its stripe's k data chunks, so a rebuilt
+    chunk can be trimmed back to its real length.
+    """
+    result = []
+    for stripe, parity in zip(stripes, encode_stripes(stripes, k, m, vectorized)):
+        header = struct.pack(f'>{k}I', *[len(chunk) for chunk in stripe], *[0] * (k - len(stripe)))
+        result.append([header + shard for shard in parity])
+    return result
+
+
+def recover_chunks(data_chunks, parity_chunks, k, m, vectorized=None):
+    """Rebuild the missing (None) data chunks of a stripe from its stored parity chunks.
+
+    data_chunks may be shorter than k for the last stripe of a file; lost parity chunks are
+    None as well. Returns the complete list of data chunks.
+    """
+    header = next((chunk for chunk in parity_chunks if chunk is not None), None)
+    if header is None:
+        raise ValueError("No parity chunk of the stripe is available")
+    lengths = struct.unpack_from(f'>{k}I', header)
+    width = len(header) - 4 * k
+    shards = [chunk.ljust(width, b'\0') if chunk is not None else None for chunk in data_chunks]
+    shards += [bytes(width)] * (k - len(data_chunks))
+    shards += [chunk[4 * k:] if chunk is not None else None for chunk in parity_chunks]
+    decoded = decode(shards, k, m, vectorized)
+    return [chunk if chunk is not None else decoded[i][:lengths[i]] for i, chunk in enumerate(data_chunks)]
+
+
+def benchmark(k=6, m=3, shard_size=1 << 20, rounds=5):
+    """Print encode and degraded-decode throughput (MB/s of data) for each available implementation."""
+    shards = [os.urandom(shard_size) for _ in range(k)]
+    implementations = [('python', False)] + ([('numpy', True)] if np is not None else [])
+    for name, vectorized in implementations:
+        start = time.perf_counter()
+        for _ in range(rounds):
+            parity = encode(shards, m, vectorized)
+        encode_rate = k * shard_size * rounds / (time.perf_counter() - start) / 1e6
+
+        degraded = [None] * m + shards[m:] + parity  # Lose the first m data shards
+        start = time.perf_counter()
+        for _ in range(rounds):
+            recovered = decode(degraded, k, m, vectorized)
+        decode_rate = k * shard_size * rounds / (time.perf_counter() - start) / 1e6
+        assert recovered == shards
+        print(f"RS({k},{m}) {name:>6}: encode {encode_rate:8.1f} MB/s, decode with {m} lost {decode_rate:8.1f} MB/s")
+
+
+if __name__ == "__main__":
+    # Usage: python erasure.py [k] [m] [shard_size]
+    benchmark(*(int(arg) for arg in sys.argv[1:4]))
@@ -0,0 +1,211 @@
+import os
+import time
+import zlib
+import pickle
+import struct
+import logging
+import threading
+import metrics
+
+METADATA_DIR = os.environ.get('GFS_METADATA_DIR', 'metadata')  # Journal and checkpoints of the master; '' keeps metadata in memory only
+JOURNAL_COMMIT_MS = float(os.environ.get('GFS_JOURNAL_COMMIT_MS', 0))  # Extra wait for more records to join an fsync; 0 syncs when the last one is done
+CHECKPOINT_JOURNAL_BYTES = int(os.environ.get('GFS_CHECKPOINT_JOURNAL_BYTES', 64 * 1024 * 1024))  # Journal growth that triggers a checkpoint
+CHECKPOINT_INTERVAL = 3600  # Seconds after which a checkpoint is taken anyway if anything was journaled
+JOURNAL_PREFIX = 'journal.'
+CHECKPOINT_PREFIX = 'checkpoint.'
+TEMP_SUFFIX = '.tmp'
+FRAME = struct.Struct('<II')  # Header of a batch of records: payload length and CRC-32
+
+RECORDS = metrics.REGISTRY.counter('gfs_journal_records_total', "Metadata operations journaled")
+FSYNCS = metrics.REGISTRY.counter('gfs_journal_fsyncs_total', "Journal fsyncs, each covering one batch of records")
+BATCH_SIZE = metrics.REGISTRY.histogram('gfs_journal_batch_records', "Records made durable by one journal fsync",
+                                        buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+
+
+def segment_path(directory, number):
+    return os.path.join(directory, f'{JOURNAL_PREFIX}{number:08d}')
+
+
+def checkpoint_path(directory, number):
+    return os.path.join(directory, f'{CHECKPOINT_PREFIX}{number:08d}')
+
+
+def numbered(directory, prefix):
+    """Return the sorted numbers of the files in directory named prefix<number>."""
+    return sorted(int(name[len(prefix):]) for name in os.listdir(directory)
+                  if name.startswith(prefix) and name[len(prefix):].isdigit())
+
+
+def fsync_path(path):
+    """fsync a file or directory by path."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Journal:
+    """Append-only log of metadata operations, made durable in batches (group commit).
+
+    log() queues a record; its arguments are pickled later and must not be mutated after
+    logging. A request handler calls sync() before replying: the first handler to do so
+    pickles everything queued into one CRC-checked frame, writes it and fsyncs once, while handlers arriving meanwhile wait for it and then commit the next batch
+    together, so concurrent mutations share the cost of a sync without a handoff to another
+    thread. Segments are numbered: rotate() starts the next one so the closed segments can
+    be folded into a checkpoint while logging continues.
+    """
+
+    def __init__(self, directory, segment, interval=JOURNAL_COMMIT_MS / 1000):
+        self.directory = directory
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.synced = threading.Condition(self.lock)  # Signalled when a batch was written
+        self.local = threading.local()  # The last record each thread logged, as local.lsn
+        self.pending = []  # (op, args) records waiting for the next batch
+        self.logged = 0  # Sequence number of the last record logged
+        self.durable = 0  # Sequence number of the last record fsynced
+        self.writing = False  # Whether a thread is writing a batch
+        self.error = None  # The OSError that stopped the journal; no record is durable after it
+        self.segment = segment
+        self.fd = self.open(segment)
+        self.segment_bytes = 0
+
+    def open(self, segment):
+        fd = os.open(segment_path(self.directory, segment), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        fsync_path(self.directory)
+        return fd
+
+    def log(self, op, *args):
+        """Queue the record (op, args); replaying it calls the method op with args."""
+        with self.lock:
+            self.pending.append((op, args))
+            self.logged += 1
+            self.local.lsn = self.logged
+
+    def unsynced(self):
+        """Whether records the calling thread logged are not durable yet."""
+        return getattr(self.local, 'lsn', 0) > self.durable
+
+    def sync(self):
+        """Wait until every record the calling thread logged is durable; raises OSError if it cannot be."""
+        if self.unsynced():
+            with self.lock:
+                self.commit(self.local.lsn)
+
+    def commit(self, lsn):
+        """Make the records up to lsn durable, writing the pending batch unless another thread is (lock held)."""
+        while self.durable < lsn:
+            if self.error is not None:
+                raise self.error
+            if self.writing:
+                self.synced.wait()
+                continue
+            self.writing = True
+            if self.interval:
+                self.lock.release()
+                time.sleep(self.interval)  # Let more records join the batch
+                self.lock.acquire()
+            batch, self.pending = self.pending, []
+            last, fd = self.logged, self.fd
+            self.lock.release()
+            try:
+                payload = pickle.dumps(batch, pickle.HIGHEST_PROTOCOL)
+                os.write(fd, FRAME.pack(len(payload), zlib.crc32(payload)) + payload)
+                os.fsync(fd)
+                error = None
+            except OSError as e:
+                logging.critical("Journal write failed, metadata changes are no longer durable: %s", e)
+                error = e
+            finally:
+                self.lock.acquire()
+                self.writing = False
+                self.synced.notify_all()
+            if error is not None:
+                self.error = error
+                continue
+            self.durable = last
+            self.segment_bytes += FRAME.size + len(payload)
+            FSYNCS.inc()
+            RECORDS.inc(len(batch))
+            BATCH_SIZE.observe(len(batch))
+
+    def rotate(self):
+        """Write out the current segment and continue in a new one; returns the number of the closed segment."""
+        with self.lock:
+            self.commit(self.logged)
+            closed, fd = self.segment, self.fd
+            self.segment += 1
+            self.fd = self.open(self.segment)
+            self.segment_bytes = 0
+        os.close(fd)
+        return closed
+
+
+class NullJournal:
+    """Stands in for the journal when metadata is kept in memory only, and while replaying."""
+    segment = 0
+    segment_bytes = 0
+
+    def log(self, op, *args):
+        pass
+
+    def unsynced(self):
+        return False
+
+    def sync(self):
+        pass
+
+
+NULL = NullJournal()
+
+
+def read_segment(path):
+    """Yield the (op, args) records of a journal segment, stopping at a frame cut short by a crash."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    offset = 0
+    while offset + FRAME.size <= len(data):
+        length, crc = FRAME.unpack_from(data, offset)
+        payload = data[offset + FRAME.size:offset + FRAME.size + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break
+        yield from pickle.loads(payload)
+        offset += FRAME.size + length
+    if offset < len(data):
+        logging.warning("Ignoring %d bytes of a torn or corrupt frame at offset %d of %s", len(data) - offset, offset, path)
+
+
+def write_checkpoint(directory, number, state):
+    """Durably write state as checkpoint number: a pickle written to a temp file and renamed into place."""
+    path = checkpoint_path(directory, number)
+    with open(path + TEMP_SUFFIX, 'wb') as f:
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + TEMP_SUFFIX, path)
+    fsync_path(directory)
+    return path
+
+
+def load_checkpoint(directory):
+    """Return (number, state) of the newest readable checkpoint in directory, or (0, None) if there is none.
+
+    Checkpoint number n holds the state after every segment numbered below n.
+    """
+    for number in reversed(numbered(directory, CHECKPOINT_PREFIX)):
+        try:
+            with open(checkpoint_path(directory, number), 'rb') as f:
+                return number, pickle.load(f)
+        except Exception as e:
+            logging.error("Skipping unreadable checkpoint %d in %s: %s", number, directory, e)
+    return 0, None
+
+
+def prune(directory, number):
+    """Delete the checkpoints and segments that checkpoint number supersedes, and stray temp files."""
+    for name in os.listdir(directory):
+        for prefix in (JOURNAL_PREFIX, CHECKPOINT_PREFIX):
+            suffix = name[len(prefix):]
+            if name.startswith(prefix) and (suffix.endswith(TEMP_SUFFIX) or suffix.isdigit() and int(suffix) < number):
+                os.remove(os.path.join(directory, name))
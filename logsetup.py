@@ -0,0 +1,119 @@
+import os
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+import metrics
+
+LOG_LEVEL = os.environ.get('GFS_LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('GFS_LOG_FORMAT', 'text')  # 'text' for classic lines, 'kv' for key=value records
+LOG_SAMPLE_RATE = float(os.environ.get('GFS_LOG_SAMPLE_RATE', 5))  # Hot-path records written per event per second; 0 writes all
+LOG_QUEUE_SIZE = 10000  # Records buffered for the writer thread; further records are dropped, never waited on
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+DROPPED = metrics.REGISTRY.counter('gfs_log_records_dropped_total', "Log records dropped because the log queue was full")
+SAMPLED_OUT = metrics.REGISTRY.counter('gfs_log_records_sampled_out_total', "Hot-path log records skipped by sampling, by event", ['event'])
+
+
+class Event:
+    """A structured log message: an event name and key=value fields, formatted only when written."""
+    __slots__ = ('name', 'fields')
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def __str__(self):
+        return ' '.join([self.name] + [f'{key}={quote(value)}' for key, value in self.fields.items()])
+
+
+def quote(value):
+    """Render a value for a key=value record, quoting it if it contains spaces, quotes or '='."""
+    text = str(value)
+    if text and not any(c in text for c in ' "=\n\t'):
+        return text
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\t', '\\t') + '"'
+
+
+class KeyValueFormatter(logging.Formatter):
+    """Format every record as ts=... level=... followed by its event fields or msg=..."""
+
+    def format(self, record):
+        fields = {'ts': f"{self.formatTime(record, '%Y-%m-%dT%H:%M:%S')}.{int(record.msecs):03d}",
+                  'level': record.levelname, 'thread': record.threadName}
+        if isinstance(record.msg, Event) and not record.args:
+            fields['event'] = record.msg.name
+            fields.update(record.msg.fields)
+        else:
+            fields['msg'] = record.getMessage()
+        if record.exc_info:
+            fields['exc'] = self.formatException(record.exc_info)
+        return ' '.join(f'{key}={quote(value)}' for key, value in fields.items())
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Hand records to the writer thread without formatting them in the caller or ever blocking.
+
+    Records stay in-process, so they are queued as-is and formatted by the listener; a full
+    queue drops the record and counts it in gfs_log_records_dropped_total.
+    """
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED.inc()
+
+
+def setup(filename=None, level=LOG_LEVEL, fmt=LOG_FORMAT):
+    """Route the root logger through a queue to a writer thread logging to filename (stderr if None).
+
+    Like logging.basicConfig this does nothing when the root logger already has handlers.
+    Returns the started QueueListener, or None.
+    """
+    root = logging.getLogger()
+    if root.handlers:
+        return None
+    handler = logging.FileHandler(filename) if filename else logging.StreamHandler()
+    handler.setFormatter(KeyValueFormatter() if fmt == 'kv' else logging.Formatter(TEXT_FORMAT))
+    records = queue.Queue(LOG_QUEUE_SIZE)
+    root.addHandler(NonBlockingQueueHandler(records))
+    root.setLevel(level)
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    atexit.register(listener.stop)  # Flush what is still queued on exit
+    return listener
+
+
+_buckets = {}  # Event name -> [tokens, last refill (monotonic seconds), records suppressed since the last write]
+
+
+def log_sampled(level, event, **fields):
+    """Log a hot-path event as a structured record, rate-limited to LOG_SAMPLE_RATE per second per event.
+
+    The first record written after some were skipped carries suppressed=<count>. Races
+    between threads may let a record more or less through, which sampling tolerates.
+    """
+    if not logging.root.isEnabledFor(level):
+        return
+    if LOG_SAMPLE_RATE > 0:
+        now = time.monotonic()
+        bucket = _buckets.get(event)
+        if bucket is None:
+            bucket = _buckets[event] = [LOG_SAMPLE_RATE, now, 0]
+        tokens = min(LOG_SAMPLE_RATE, bucket[0] + (now - bucket[1]) * LOG_SAMPLE_RATE)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            bucket[2] += 1
+            SAMPLED_OUT.labels(event).inc()
+            return
+        bucket[0] = tokens - 1
+        if bucket[2]:
+            fields['suppressed'] = bucket[2]
+            bucket[2] = 0
+    logging.log(level, Event(event, fields))
@@ -1,226 +1,2012 @@
 import socket
 import threading
 import os
+import sys
 import math
 import pickle
 import time
 import logging
+import bisect
+import zlib
+import heapq
+import uuid
+import hashlib
+import random
+import gc
+import multiprocessing
+from array import array
+from itertools import repeat
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor, wait
+import erasure
+import journal
+import metrics
+import logsetup
+import profiling
+import tracing
+from logsetup import log_sampled
 
-logging.basicConfig(filename='master_server.log', level=logging.INFO, 
-                    format='%(asctime)s - %(levelname)s - %(message)s')
+logsetup.setup('master_server.log')
 
-CHUNK_PORTS = [6467, 6468, 6469, 6470]
 REPLICATION_FACTOR = 2
 HEARTBEAT_INTERVAL = 5
+SERVER_TIMEOUT = 3 * HEARTBEAT_INTERVAL  # Seconds without a heartbeat before a chunk server is declared failed
 LEASE_DURATION = 30  # Lease duration in seconds
+PRIMARY_LEASE_DURATION = 60  # Seconds a chunk replica stays primary for record appends
+LEASE_PUSH_TIMEOUT = 1  # Seconds a lease request waits for chunk servers to acknowledge the lease change
+LEASE_PUSH_WORKERS = 16  # Threads pushing lease changes to chunk servers in parallel
+LIST_PAGE_SIZE = 1000  # Default and maximum entries per list_files/file_stats page
+FILE_LOCK_STRIPES = 64  # Number of striped locks serializing mutations of the same filename
+TIERING_IDLE_SECONDS = int(os.environ.get('GFS_TIERING_IDLE_SECONDS', 7 * 24 * 3600))  # Files not downloaded for this long are cold
+TIERING_EC = tuple(int(n) for n in os.environ.get('GFS_TIERING_EC', '3,1').split(','))  # (k, m) layout cold files are rewritten into
+TIERING_INTERVAL = 60  # Seconds between scans for cold files
+TIERING_BYTES_PER_SECOND = 4 * 1024 * 1024  # Chunk bytes the tiering job may read per second, sparing foreground traffic
+TIERING_STRIPES = 256  # Stripes read, encoded and written per step of a conversion
+REBALANCE_INTERVAL = 30  # Seconds between rebalancing rounds
+REBALANCE_TOLERANCE = 0.1  # Servers within this fraction of the mean utilization count as balanced
+REBALANCE_MAX_MOVES = 1000  # Chunk moves planned per rebalancing round
+REBALANCE_BYTES_PER_SECOND = 4 * 1024 * 1024  # Chunk bytes the rebalancer may copy per second
+REPLICA_POLICY = os.environ.get('GFS_REPLICA_POLICY', 'locality')  # Name in REPLICA_POLICIES ordering replicas for reads
+METRICS_PORT = int(os.environ.get('GFS_METRICS_PORT', 9082))  # Metrics endpoint http://<host>:<port>/metrics; 0 disables it
+ATIME_PRECISION = 60  # Seconds a file's access time may lag, so repeated downloads journal it at most this often
+DELETE_GRACE_SECONDS = int(os.environ.get('GFS_DELETE_GRACE_SECONDS', 3 * 24 * 3600))  # Deleted files stay hidden, and readable, this long before they are reclaimed
+DELETED_PREFIX = '.deleted/'  # Deleted files are renamed to <prefix><deletion number>/<filename> until reclaimed
+GC_INTERVAL = 300  # Seconds between garbage collection passes
+GC_RECLAIM_BATCH = 1000  # Deleted files reclaimed per journal record
+GC_DELETE_BATCH = 500  # Orphaned chunk files deleted per delete_batch message
+GC_DELETES_PER_SECOND = 2000  # Chunk files garbage collection may delete per second on each chunk server
+
+# Commands handle_client serves; metrics label any other command 'unknown'
+COMMANDS = frozenset(['upload', 'index_chunks', 'batch_upload', 'record_append', 'download', 'list_files',
+                      'check_metadata', 'storage_usage', 'list_servers', 'rebalance', 'run_tiering', 'delete', 'gc',
+                      'snapshot', 'file_stats', 'lease', 'renew_lease', 'unlease', 'check_lease', 'heartbeat',
+                      'stale_replica', 'metrics', 'profile', 'stacks', 'checkpoint'])
+REQUESTS = metrics.REGISTRY.counter('gfs_master_requests_total', "Requests handled, by command", ['command'])
+REQUEST_ERRORS = metrics.REGISTRY.counter('gfs_master_request_errors_total', "Requests that failed with an exception, by command", ['command'])
+REQUEST_SECONDS = metrics.REGISTRY.histogram('gfs_master_request_seconds', "Request handling time, by command", ['command'])
+DEDUP_HITS = metrics.REGISTRY.counter('gfs_master_dedup_hits_total', "Uploaded chunks linked to already stored content")
+
+
+def server_address(server):
+    """Split a registered chunk server ID ('host:port') into a (host, port) address."""
+    host, port = server.rsplit(':', 1)
+    return host, int(port)
+
+
+def new_chunk_id(filename, suffix, generation=0):
+    """Return the ID of a new chunk of filename: '<filename>_chunk_<suffix>'.
+
+    Files created after a deletion carry the deletion count as their generation, so a
+    re-created file never reuses the ID of a chunk whose file may still linger on disk.
+    """
+    return f"{filename}_chunk_{suffix}.{generation}" if generation else f"{filename}_chunk_{suffix}"
+
+
+def chunk_owner(chunk_id):
+    """Return the filename a chunk is stored under on the chunk servers (that of the file that first wrote it)."""
+    return chunk_id.rsplit('_chunk_', 1)[0]
+
+
+def order_random(servers, membership, client_tags):
+    """Shuffle the replicas so no replica is always read first."""
+    return random.sample(servers, len(servers))
+
+
+def order_least_loaded(servers, membership, client_tags):
+    """Order replicas by the requests they were serving at their last heartbeat, then by utilization."""
+    def load(server):
+        info = membership.get(server, {})
+        return info.get('active_requests') or 0, (info.get('used_bytes') or 0) / (info.get('capacity') or 1)
+    return sorted(order_random(servers, membership, client_tags), key=load)
+
+
+def order_locality(servers, membership, client_tags):
+    """Put replicas sharing a tag (rack, zone, ...) with the client first, shuffled within each group."""
+    tags = set(client_tags)
+    return sorted(order_random(servers, membership, client_tags),
+                  key=lambda server: not tags.intersection(membership.get(server, {}).get('tags', ())))
+
+
+REPLICA_POLICIES = {  # Read replica orderings: name -> function(servers, membership, client_tags) -> ordered servers
+    'random': order_random,
+    'least_loaded': order_least_loaded,
+    'locality': order_locality,
+}
+
+
+def register_replica_policy(name, order):
+    """Make a replica ordering available under name, e.g. for GFS_REPLICA_POLICY."""
+    REPLICA_POLICIES[name] = order
+
+
+class RWLock:
+    """Readers-writer lock: any number of concurrent readers or a single writer.
+
+    Writers take priority over newly arriving readers so that a steady stream of
+    lookups cannot starve heartbeat and failure handling. The lock is not reentrant.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self.cond:
+            while self.writer or self.waiting_writers:
+                self.cond.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.readers -= 1
+                if not self.readers:
+                    self.cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self.cond:
+            self.waiting_writers += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.waiting_writers -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.writer = False
+                self.cond.notify_all()
+
+class NamespaceIndex:
+    """Sorted index of file paths supporting prefix, directory and cursor-paginated listing.
+
+    Paths are kept in a list of sorted buckets (the layout used by sortedcontainers), so
+    inserts and removals cost O(sqrt(n)) and a listing page costs O(log n + page size)
+    regardless of how many files the namespace holds.
+    """
+
+    BUCKET_SIZE = 1000
+
+    def __init__(self, paths=()):
+        paths = sorted(paths)  # Built in bulk when recovering a namespace
+        self.buckets = [paths[i:i + self.BUCKET_SIZE] for i in range(0, len(paths), self.BUCKET_SIZE)]  # Sorted, non-empty lists of paths
+        self.maxes = [bucket[-1] for bucket in self.buckets]  # Last path of each bucket, for bisecting to the right bucket
+        self.size = len(paths)
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, path):
+        pos = bisect.bisect_left(self.maxes, path)
+        if pos == len(self.maxes):
+            return False
+        bucket = self.buckets[pos]
+        i = bisect.bisect_left(bucket, path)
+        return i < len(bucket) and bucket[i] == path
+
+    def add(self, path):
+        """Insert path into the index; returns False if it was already present."""
+        if not self.maxes:
+            self.buckets.append([path])
+            self.maxes.append(path)
+            self.size += 1
+            return True
+
+        pos = bisect.bisect_left(self.maxes, path)
+        if pos == len(self.maxes):
+            pos -= 1
+            self.buckets[pos].append(path)
+            self.maxes[pos] = path
+        else:
+            bucket = self.buckets[pos]
+            i = bisect.bisect_left(bucket, path)
+            if bucket[i] == path:
+                return False
+            bucket.insert(i, path)
+
+        bucket = self.buckets[pos]
+        if len(bucket) > 2 * self.BUCKET_SIZE:
+            self.buckets[pos:pos + 1] = [bucket[:self.BUCKET_SIZE], bucket[self.BUCKET_SIZE:]]
+            self.maxes[pos:pos + 1] = [bucket[self.BUCKET_SIZE - 1], bucket[-1]]
+        self.size += 1
+        return True
+
+    def remove(self, path):
+        """Remove path from the index; returns False if it was not present."""
+        pos = bisect.bisect_left(self.maxes, path)
+        if pos == len(self.maxes):
+            return False
+        bucket = self.buckets[pos]
+        i = bisect.bisect_left(bucket, path)
+        if i == len(bucket) or bucket[i] != path:
+            return False
+        del bucket[i]
+        if bucket:
+            self.maxes[pos] = bucket[-1]
+        else:
+            del self.buckets[pos]
+            del self.maxes[pos]
+        self.size -= 1
+        return True
+
+    def iter_from(self, key):
+        """Yield indexed paths >= key in sorted order."""
+        pos = bisect.bisect_left(self.maxes, key)
+        if pos == len(self.maxes):
+            return
+        yield from self.buckets[pos][bisect.bisect_left(self.buckets[pos], key):]
+        for j in range(pos + 1, len(self.buckets)):
+            yield from self.buckets[j]
+
+    def list(self, prefix='', delimiter=None, cursor=None, limit=100):
+        """Return (files, dirs, next_cursor) for one page of paths under prefix.
+
+        With a delimiter, paths that continue past the next delimiter are rolled up into a
+        single "directory" entry (e.g. 'logs/2024/') and the whole subtree is skipped.
+        Pass the returned next_cursor back to continue; it is None on the last page. The cursor
+        is the last entry returned, tagged 'f' for a file or 'd' for a directory, since a file
+        name may end with the delimiter too.
+        """
+        files, dirs = [], []
+        start = prefix
+        if cursor and cursor[1:] >= prefix:
+            # Resume after the cursor; a directory cursor resumes after its whole subtree
+            after = cursor[1:]
+            start = after + '\0'
+            if cursor[0] == 'd' and delimiter and after.endswith(delimiter):
+                start = after[:-len(delimiter)] + chr(ord(delimiter[0]) + 1)
+
+        last = None
+        while True:
+            restart = None
+            for path in self.iter_from(start):
+                if not path.startswith(prefix):
+                    return files, dirs, None
+                if len(files) + len(dirs) >= limit:
+                    return files, dirs, last
+                if delimiter:
+                    cut = path.find(delimiter, len(prefix))
+                    if cut >= 0:
+                        directory = path[:cut + len(delimiter)]
+                        dirs.append(directory)
+                        last = 'd' + directory
+                        restart = path[:cut] + chr(ord(delimiter[0]) + 1)
+                        break
+                files.append(path)
+                last = 'f' + path
+            if restart is None:
+                return files, dirs, None
+            start = restart
+
+
+class LeaseManager:
+    """Lease table with a min-heap of deadlines, expired by one timer thread exactly on time.
+
+    Renewals push a new deadline and leave the old heap entry behind; stale entries are
+    recognised by their lease ID and expiry and skipped when they reach the top.
+    """
+
+    def __init__(self, on_expire=None, on_change=None):
+        self.leases = {}  # Tracks leases: {'filename': {'expires': <time>, 'client': <address>, 'lease_id': <id>}}
+        self.deadlines = []  # Heap of (expires, filename, lease_id)
+        self.cond = threading.Condition(threading.Lock())
+        self.on_expire = on_expire  # Called with the filename after a lease times out
+        self.on_change = on_change  # Called under the lock with (filename, copy of the lease or None) on grant, renewal and release
+
+    def _schedule(self, filename, lease):
+        heapq.heappush(self.deadlines, (lease['expires'], filename, lease['lease_id']))
+        if self.deadlines[0][1] == filename:
+            self.cond.notify()  # New earliest deadline, wake the timer thread
+
+    def get(self, filename):
+        """Return the live lease on filename, or None."""
+        lease = self.leases.get(filename)
+        if lease is not None and lease['expires'] > time.time():
+            return lease
+        return None
+
+    def grant(self, filename, client_address, duration):
+        """Grant a new lease, or return None if another live lease exists."""
+        with self.cond:
+            if self.get(filename) is not None:
+                return None
+            lease = {'expires': time.time() + duration, 'client': client_address, 'lease_id': uuid.uuid4().hex}
+            self.leases[filename] = lease
+            self._schedule(filename, lease)
+            if self.on_change:
+                self.on_change(filename, dict(lease))
+            return dict(lease)
+
+    def renew(self, filename, lease_id, duration):
+        """Extend a live lease held under lease_id; returns the updated lease or None."""
+        with self.cond:
+            lease = self.get(filename)
+            if lease is None or lease['lease_id'] != lease_id:
+                return None
+            lease['expires'] = time.time() + duration
+            self._schedule(filename, lease)
+            if self.on_change:
+                self.on_change(filename, dict(lease))
+            return dict(lease)
+
+    def release(self, filename):
+        """Drop the lease on filename; returns False if there was none."""
+        with self.cond:
+            if self.leases.pop(filename, None) is None:
+                return False
+            if self.on_change:
+                self.on_change(filename, None)
+            return True
+
+    def restore(self, filename, lease):
+        """Reinstate a lease recorded before a restart (None drops it); expired leases are not restored."""
+        with self.cond:
+            if lease is None or lease['expires'] <= time.time():
+                self.leases.pop(filename, None)
+            else:
+                self.leases[filename] = dict(lease)
+                self._schedule(filename, self.leases[filename])
+
+    def snapshot(self):
+        """Return {filename: expires} for all live leases."""
+        now = time.time()
+        with self.cond:
+            return {filename: lease['expires'] for filename, lease in self.leases.items() if lease['expires'] > now}
+
+    def run(self):
+        """Sleep until the earliest deadline and expire every lease that is due."""
+        while True:
+            expired = []
+            with self.cond:
+                while not self.deadlines or self.deadlines[0][0] > time.time():
+                    self.cond.wait(self.deadlines[0][0] - time.time() if self.deadlines else None)
+                now = time.time()
+                while self.deadlines and self.deadlines[0][0] <= now:
+                    expires, filename, lease_id = heapq.heappop(self.deadlines)
+                    lease = self.leases.get(filename)
+                    if lease is not None and lease['lease_id'] == lease_id and lease['expires'] == expires:
+                        del self.leases[filename]
+                        expired.append(filename)
+            for filename in expired:
+                logging.info("Lease expired for file %s", filename)
+                if self.on_expire:
+                    self.on_expire(filename)
+
 
 class MasterServer:
-    def __init__(self, host, port):
+    def __init__(self, host, port, metadata_dir=journal.METADATA_DIR):
+        if REPLICA_POLICY not in REPLICA_POLICIES:  # Checked here so policies registered after import count
+            raise ValueError(f"Unknown replica policy {REPLICA_POLICY}; GFS_REPLICA_POLICY must be one of "
+                             f"{', '.join(sorted(REPLICA_POLICIES))}")
         self.chunksize = 2048
         self.host = host
         self.port = port
+        self.metadata_dir = metadata_dir  # Journal and checkpoints; '' keeps the metadata in memory only
+        self.journal = journal.NULL  # Replaced by the real journal once recover() has replayed it
+        self.checkpoint_lock = threading.Lock()  # One checkpoint at a time
+        self.last_checkpoint = time.time()
         self.file_map = {}  # Maps filenames to their chunk information
         self.chunk_locations = {}  # Maps chunk IDs to their respective chunk servers
-        self.chunk_servers_info = {p: [] for p in CHUNK_PORTS}  # Tracks chunks held by each server
-        self.active_servers = set()  # Set of active chunk servers for quick access
-        self.leases = {}  # Tracks leases: {'filename': {'expires': <time>, 'client': <client_address>}}
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.bind((self.host, self.port))
+        self.servers = {}  # Membership table: {'host:port': {'host', 'port', 'capacity', 'used_bytes', 'tags', 'active_requests', 'registered', 'last_seen'}}
+        self.chunk_servers_info = {}  # Tracks chunks held by each registered server
+        self.active_servers = set()  # Registered servers whose heartbeats are current
+        # Tracks leases and expires them on their deadline; grants, renewals and releases are journaled
+        self.lease_manager = LeaseManager(on_change=lambda filename, lease: self.journal.log('restore_lease', filename, lease))
+        self.lease_pushes = ThreadPoolExecutor(max_workers=LEASE_PUSH_WORKERS)  # Fans lease changes out to chunk servers
+        self.namespace = NamespaceIndex()  # Sorted index of filenames for prefix/directory listing
+        self.file_info = {}  # Maps filenames to {'size': <bytes>, 'mtime': <time>}; hidden deleted files also have 'deleted': <time>
+        self.deletions = 0  # Files deleted so far: the generation of files created now, and the number in hidden names
+        self.snapshots = 0  # Snapshots taken so far, part of the IDs of chunks copied on write
+        self.chunk_sizes = {}  # Maps chunk IDs to their length in bytes
+        self.server_usage = {}  # Bytes of replicas placed on each registered server
+        self.logical_bytes = 0  # Sum of file sizes
+        self.replica_bytes = 0  # Sum of bytes over all placed replicas
+        self.chunk_hashes = {}  # Dedup index: {<sha256 of chunk data>: chunk_id}
+        self.chunk_checksums = {}  # Reverse of the dedup index: {chunk_id: <sha256>}, so dropping a chunk needs no scan
+        self.chunk_refs = {}  # Number of file references to each chunk ID
+        self.chunk_primaries = {}  # Record-append primaries: {chunk_id: {'primary': <server>, 'expires': <time>, 'version': <n>}}
+        self.chunk_stripes = {}  # Erasure-coded chunks: {chunk_id: [data chunk IDs..., parity chunk IDs...]}
+        self.chunk_versions = {}  # Chunks mutated in place: {chunk_id: version}, raised with every primary lease; others are at 0
+        self.pending_copies = set()  # Chunks being copied on write, not yet in chunk_locations; garbage collection spares them
+        self.data_movement_lock = threading.Lock()  # One background data-movement job (tiering or rebalancing) at a time
+        self.rebalance_stats = {'rounds': 0, 'chunks_moved': 0, 'bytes_moved': 0, 'failed_moves': 0, 'seconds': 0.0}
+        self.tiering_stats = {'passes': 0, 'files_converted': 0, 'bytes_read': 0, 'bytes_reclaimed': 0, 'seconds': 0.0}
+        self.gc_stats = {'passes': 0, 'files_reclaimed': 0, 'chunks_reclaimed': 0, 'orphans_deleted': 0, 'bytes_freed': 0,
+                         'seconds': 0.0}
+        self.under_replicated = 0  # Chunks below their replication target at the last integrity check
+        self.active_requests = 0  # Client and chunk server requests being handled
+        self.request_lock = threading.Lock()  # Guards active_requests
+
+        # Lock order: file stripe -> namespace_lock -> placement_lock; the lease manager locks independently.
+        self.file_locks = [threading.Lock() for _ in range(FILE_LOCK_STRIPES)]  # Per-file mutations
+        self.namespace_lock = RWLock()  # Guards file_map, namespace, file_info, logical_bytes
+        self.placement_lock = RWLock()  # Guards chunk_locations, chunk_servers_info, active_servers, membership, chunk_primaries, chunk_versions, chunk_stripes, pending_copies, dedup index and usage counters
         logging.info("Master Server initialized on host %s, port %d", host, port)
 
     def start(self):
-        """Start the master server and begin listening for clients and chunk servers."""
-        self.sock.listen(5)
+        """Recover the metadata, then start the master server and begin listening for clients and chunk servers."""
+        self.recover()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.register_metrics()
+        if METRICS_PORT:
+            metrics.start_http_server(METRICS_PORT, self.host)
+        self.sock.listen(socket.SOMAXCONN)  # A short backlog drops SYNs under concurrent clients, costing a 1 s retransmit
         threading.Thread(target=self.heartbeat).start()
         threading.Thread(target=self.check_replication_integrity).start()
-        threading.Thread(target=self.lease_expiration_checker).start()  # Check leases periodically
+        threading.Thread(target=self.lease_manager.run).start()  # Expire leases on their deadline
+        threading.Thread(target=self.tier_cold_files).start()
+        threading.Thread(target=self.rebalance_servers).start()
+        threading.Thread(target=self.collect_garbage).start()
+        if self.metadata_dir:
+            threading.Thread(target=self.checkpoint_metadata).start()
         logging.info("Master Server started, listening for connections.")
         while True:
             client, address = self.sock.accept()
             threading.Thread(target=self.handle_client, args=(client, address)).start()
 
+    def register_metrics(self):
+        """Expose the master's state as gauges read at scrape time."""
+        gauge = metrics.REGISTRY.gauge
+        gauge('gfs_master_active_requests', "Requests being handled", lambda: self.active_requests)
+        gauge('gfs_master_chunk_servers', "Registered chunk servers, by state",
+              lambda: {('active',): len(self.active_servers), ('failed',): len(self.servers) - len(self.active_servers)},
+              ['state'])
+        gauge('gfs_master_files', "Files in the namespace", lambda: len(self.namespace))
+        gauge('gfs_master_chunks', "Chunks with recorded locations", lambda: len(self.chunk_locations))
+        gauge('gfs_master_under_replicated_chunks', "Chunks below their replication target at the last check",
+              lambda: self.under_replicated)
+        gauge('gfs_master_leases', "File leases currently held", lambda: len(self.lease_manager.leases))
+        gauge('gfs_master_logical_bytes', "Sum of file sizes", lambda: self.logical_bytes)
+        gauge('gfs_master_replica_bytes', "Sum of bytes over all placed replicas", lambda: self.replica_bytes)
+
+    def recover(self):
+        """Rebuild the metadata from the newest checkpoint and the journal after it, then journal into a new segment.
+
+        Chunk servers holding replicas are taken as active until they miss SERVER_TIMEOUT of
+        heartbeats, so the replicas of a server that does not come back are re-replicated.
+        """
+        if not self.metadata_dir:
+            logging.warning("No metadata directory: the namespace is kept in memory only and lost on restart")
+            return
+        os.makedirs(self.metadata_dir, exist_ok=True)
+        started = time.time()
+        number, last, replayed = self.load_metadata(self.metadata_dir)
+        journal.prune(self.metadata_dir, number)  # Temp files of a checkpoint cut short
+        for server, chunk_ids in self.chunk_servers_info.items():
+            if chunk_ids and server not in self.servers:
+                host, port = server_address(server)
+                self.servers[server] = {'host': host, 'port': port, 'registered': started, 'last_seen': started,
+                                        'used_bytes': None, 'capacity': None, 'tags': [], 'active_requests': 0}
+                self.active_servers.add(server)
+        self.journal = journal.Journal(self.metadata_dir, last + 1)
+        logging.info("Recovered %d files and %d chunks from checkpoint %d and %d journal records in %.2f s",
+                     len(self.file_map), len(self.chunk_locations), number, replayed, time.time() - started)
+
+    def load_metadata(self, directory, until=None):
+        """Load the newest checkpoint in directory and replay the journal segments after it, stopping before segment until.
+
+        Returns (checkpoint number, last segment replayed, records replayed).
+        """
+        gc.disable()  # Millions of new objects would trigger collections that find nothing to free
+        try:
+            number, state = journal.load_checkpoint(directory)
+            if state is not None:
+                self.restore_state(state)
+            last, replayed = number - 1, 0
+            for segment in journal.numbered(directory, journal.JOURNAL_PREFIX):
+                if segment < number or (until is not None and segment >= until):
+                    continue
+                for op, args in journal.read_segment(journal.segment_path(directory, segment)):
+                    getattr(self, op)(*args)
+                    replayed += 1
+                last = segment
+        finally:
+            gc.enable()
+        return number, last, replayed
+
+    def checkpoint_state(self):
+        """Return the persistent metadata in the compact form restore_state() reads.
+
+        Chunks are grouped by the servers holding them, so each group's location lists, usage
+        and per-server chunk sets are rebuilt with a few bulk operations instead of one
+        Python-level step per replica; sizes are a flat array and references default to one.
+        Everything else derived from the metadata is rebuilt rather than stored.
+        """
+        groups = {}
+        for chunk_id, servers in self.chunk_locations.items():
+            groups.setdefault(tuple(servers), []).append(chunk_id)
+        chunk_ids, placements = [], []
+        for servers, members in groups.items():
+            chunk_ids += members
+            placements.append((servers, len(members)))
+        return {'chunk_ids': chunk_ids, 'placements': placements,
+                'chunk_sizes': array('q', [self.chunk_sizes.get(chunk_id, 0) for chunk_id in chunk_ids]),
+                'chunk_refs': {chunk_id: refs for chunk_id, refs in self.chunk_refs.items() if refs != 1},
+                'chunk_hashes': self.chunk_hashes, 'chunk_stripes': self.chunk_stripes,
+                'chunk_primaries': self.chunk_primaries, 'chunk_versions': self.chunk_versions,
+                'file_map': self.file_map, 'file_info': self.file_info, 'deletions': self.deletions,
+                'snapshots': self.snapshots, 'leases': self.lease_manager.leases}
+
+    def restore_state(self, state):
+        """Replace the metadata with a checkpoint_state() snapshot and rebuild what derives from it."""
+        chunk_ids, sizes = state['chunk_ids'], state['chunk_sizes'].tolist()
+        self.chunk_sizes = dict(zip(chunk_ids, sizes))
+        self.chunk_refs = dict.fromkeys(self.chunk_sizes, 1)  # Copying a dict's keys reuses their hashes
+        self.chunk_refs.update(state['chunk_refs'])
+        self.chunk_locations, self.chunk_servers_info, self.server_usage, self.replica_bytes = {}, {}, {}, 0
+        start = 0
+        for servers, count in state['placements']:
+            members = chunk_ids[start:start + count]
+            self.chunk_locations.update(zip(members, map(list, repeat(servers, count))))
+            placed = sum(sizes[start:start + count])
+            for server in servers:
+                self.chunk_servers_info.setdefault(server, set()).update(members)
+                self.server_usage[server] = self.server_usage.get(server, 0) + placed
+            self.replica_bytes += placed * len(servers)
+            start += count
+        self.chunk_hashes = state['chunk_hashes']
+        self.chunk_checksums = {chunk_id: checksum for checksum, chunk_id in self.chunk_hashes.items()}
+        self.chunk_stripes = state['chunk_stripes']
+        self.chunk_primaries = state['chunk_primaries']
+        self.chunk_versions = state.get('chunk_versions', {})
+        self.file_map = state['file_map']
+        self.file_info = state['file_info']
+        self.deletions = state.get('deletions', 0)
+        self.snapshots = state.get('snapshots', 0)
+        visible = [filename for filename, info in self.file_info.items() if 'deleted' not in info]
+        self.namespace = NamespaceIndex(visible)
+        self.logical_bytes = sum(self.file_info[filename]['size'] for filename in visible)
+        for filename, lease in state['leases'].items():
+            self.lease_manager.restore(filename, lease)
+
+    def take_checkpoint(self):
+        """Fold the journal written so far into a new checkpoint and drop the segments it covers.
+
+        The current segment is closed and a child process replays it onto the previous
+        checkpoint, so the master keeps serving (and journaling into the next segment)
+        while the checkpoint is built, and recovery runs the same code every time.
+        """
+        if not self.metadata_dir:
+            return {'status': 'error', 'message': 'Metadata is kept in memory only'}
+        with self.checkpoint_lock:
+            started = time.time()
+            number = self.journal.rotate() + 1
+            builder = multiprocessing.get_context('spawn').Process(target=build_checkpoint, name='checkpoint', daemon=True,
+                                                                   args=(self.metadata_dir, number))
+            builder.start()
+            builder.join()
+            if builder.exitcode != 0:
+                logging.error("Building checkpoint %d failed with exit code %s", number, builder.exitcode)
+                return {'status': 'error', 'message': f'Building checkpoint {number} failed'}
+            journal.prune(self.metadata_dir, number)
+            self.last_checkpoint = time.time()
+            size = os.path.getsize(journal.checkpoint_path(self.metadata_dir, number))
+        logging.info("Wrote checkpoint %d (%d bytes) in %.2f s", number, size, self.last_checkpoint - started)
+        return {'status': 'success', 'checkpoint': number, 'bytes': size, 'seconds': self.last_checkpoint - started}
+
+    def checkpoint_metadata(self):
+        """Periodically checkpoint once the journal grew CHECKPOINT_JOURNAL_BYTES or CHECKPOINT_INTERVAL passed."""
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            if self.journal.segment_bytes >= journal.CHECKPOINT_JOURNAL_BYTES or \
+                    (self.journal.segment_bytes and time.time() - self.last_checkpoint >= journal.CHECKPOINT_INTERVAL):
+                try:
+                    self.take_checkpoint()
+                except Exception as e:
+                    logging.error("Checkpoint failed: %s", e)
+
     def num_chunks(self, size):
         return math.ceil(size / self.chunksize)
 
+    def file_lock(self, filename):
+        """Return the striped lock serializing mutations of filename."""
+        return self.file_locks[zlib.crc32(filename.encode()) % FILE_LOCK_STRIPES]
+
+    def files_lock(self, *filenames):
+        """Hold the file locks of several files, taking their stripes in a fixed order so two holders cannot deadlock."""
+        stack = ExitStack()
+        for stripe in sorted({zlib.crc32(filename.encode()) % FILE_LOCK_STRIPES for filename in filenames}):
+            stack.enter_context(self.file_locks[stripe])
+        return stack
+
     def handle_client(self, client, address):
         """Handle incoming client requests."""
+        with self.request_lock:
+            self.active_requests += 1
+        start = time.perf_counter()
+        command = None
+        label = 'unknown'  # The command as a metric label: clients must not create unbounded label values
+        trace_span = tracing.NOOP
+        profile = profiling.PROFILER.begin()
         try:
-            request = pickle.loads(client.recv(4096))
+            request = pickle.load(client.makefile('rb'))  # Reads exactly one request, however large
             command = request.get('command')
+            if command in COMMANDS:
+                label = command
+            trace_span = tracing.span(f'master.{command}', parent=request.get('trace')).start()
 
             if command == 'upload':
                 filename = request['filename']
                 file_size = request['file_size']
-                response = self.handle_upload(filename, file_size)
-                client.send(pickle.dumps(response))
+                response = self.handle_upload(filename, file_size, request.get('checksums'), request.get('codec'),
+                                              request.get('ec'))
+                self.reply(client, response)
+
+            elif command == 'index_chunks':
+                response = self.index_uploaded_chunks(request['filename'], request['checksums'])
+                self.reply(client, response)
+
+            elif command == 'batch_upload':
+                response = self.handle_batch_upload(request['files'])
+                self.reply(client, response)
+
+            elif command == 'record_append':
+                response = self.handle_record_append(request['filename'], request['size'],
+                                                     request.get('full_chunk_id'), request.get('sealed_size'),
+                                                     request.get('refused_chunk_id'))
+                self.reply(client, response)
 
             elif command == 'download':
                 filename = request['filename']
-                response = self.get_chunk_locations(filename)
-                client.send(pickle.dumps(response))
+                response = self.get_chunk_locations(filename, request.get('tags', ()))
+                self.reply(client, response)
 
             elif command == 'list_files':
-                response = list(self.file_map.keys())
-                client.send(pickle.dumps(response))
+                response = self.list_files(request.get('prefix', ''), request.get('delimiter'),
+                                           request.get('cursor'), request.get('limit', LIST_PAGE_SIZE))
+                self.reply(client, response)
+
+            elif command == 'check_metadata':
+                response = {'status': 'success', 'violations': self.check_metadata()}
+                self.reply(client, response)
+
+            elif command == 'storage_usage':
+                response = self.get_storage_usage()
+                self.reply(client, response)
+
+            elif command == 'list_servers':
+                response = self.list_servers()
+                self.reply(client, response)
+
+            elif command == 'rebalance':
+                response = self.run_rebalance()
+                self.reply(client, response)
+
+            elif command == 'run_tiering':
+                response = self.run_tiering_pass(request.get('idle_seconds', TIERING_IDLE_SECONDS))
+                self.reply(client, response)
+
+            elif command == 'delete':
+                response = self.delete_file(request['filename'])
+                self.reply(client, response)
+
+            elif command == 'gc':
+                response = self.run_gc(request.get('grace_seconds', DELETE_GRACE_SECONDS))
+                self.reply(client, response)
+
+            elif command == 'snapshot':
+                response = self.snapshot(request['src'], request['dst'])
+                self.reply(client, response)
+
+            elif command == 'file_stats':
+                response = self.get_file_stats(request.get('prefix', ''), request.get('cursor'),
+                                               request.get('limit', LIST_PAGE_SIZE))
+                self.reply(client, response)
 
             elif command == 'lease':
                 filename = request['filename']
                 response = self.lease_file(filename, address)
-                client.send(pickle.dumps(response))
+                self.reply(client, response)
+
+            elif command == 'renew_lease':
+                response = self.renew_lease(request['filename'], request['lease_id'])
+                self.reply(client, response)
 
             elif command == 'unlease':
                 filename = request['filename']
                 response = self.unlease_file(filename)
-                client.send(pickle.dumps(response))
+                self.reply(client, response)
+
+            elif command == 'check_lease':
+                lease = self.lease_manager.get(request['filename'])
+                response = {'leased': lease is not None, 'expires': lease['expires'] if lease else None}
+                self.reply(client, response)
 
             elif command == 'heartbeat':
-                port = request['port']
-                self.update_server_status(port)
+                server = self.update_server_status(request['host'], request['port'], request.get('used_bytes'),
+                                                   request.get('capacity'), request.get('tags', ()),
+                                                   request.get('active_requests', 0))
+                if request.get('versions'):
+                    self.check_versions(server, request['versions'])
+                # Let the chunk server resync its lease cache in case it missed a push
+                self.reply(client, {'status': 'success', 'leases': self.lease_manager.snapshot()})
+
+            elif command == 'stale_replica':
+                self.check_versions(request['server'], {request['chunk_id']: request['version']})
+                self.reply(client, {'status': 'success'})
+
+            elif command == 'metrics':
+                client.sendall(pickle.dumps({'status': 'success', 'metrics': metrics.REGISTRY.render()}))
+
+            elif command == 'profile':
+                client.sendall(pickle.dumps(profiling.PROFILER.handle(request)))
+
+            elif command == 'stacks':
+                client.sendall(pickle.dumps(profiling.thread_stacks()))
+
+            elif command == 'checkpoint':
+                client.sendall(pickle.dumps(self.take_checkpoint()))
 
             client.close()
         except Exception as e:
+            REQUEST_ERRORS.labels(label).inc()
+            trace_span.set(error=str(e))
             logging.error("Error handling client request from %s: %s", address, e)
+        finally:
+            trace_span.finish()
+            profiling.PROFILER.end(profile)
+            with self.request_lock:
+                self.active_requests -= 1
+            if command is not None:
+                REQUESTS.labels(label).inc()
+                REQUEST_SECONDS.labels(label).observe(time.perf_counter() - start)
+
+    def reply(self, client, response):
+        """Send a response once the metadata changes made while handling the request are journaled durably."""
+        if self.journal.unsynced():  # Most heartbeats and reads journal nothing and skip the journal lock
+            self.journal.sync()
+        client.sendall(pickle.dumps(response))
+
+    def handle_upload(self, filename, file_size, checksums=None, codec=None, ec=None):
+        """Handle file upload requests by allocating chunks and assigning servers.
+
+        In dedup mode the client sends the SHA-256 of every chunk; chunks whose content is
+        already stored are linked into the file instead of being allocated, and only the
+        new chunks appear in the returned allocation. A codec name marks the file's chunks
+        as compressed by the client; file_size is always the uncompressed size.
+
+        With ec=(k, m) the file is Reed-Solomon coded instead of replicated: every k consecutive
+        chunks form a stripe with m parity chunks, and the k + m members of a stripe are each
+        stored once, on distinct chunk servers.
+        """
+        stripes = None
+        with self.file_lock(filename):
+            if filename in self.file_map:
+                return {'status': 'error', 'message': 'File already exists'}
+            if ec is not None:
+                k, m = ec
+                with self.placement_lock.read():
+                    num_servers = len(self.active_servers)
+                if checksums is not None:
+                    return {'status': 'error', 'message': 'Deduplication cannot be combined with erasure coding'}
+                if k < 1 or m < 1 or k + m > num_servers:
+                    return {'status': 'error', 'message': f'RS({k},{m}) needs {k + m} active chunk servers, {num_servers} available'}
+
+            num_chunks = self.num_chunks(file_size)
+            generation = self.deletions
+            chunk_ids = [new_chunk_id(filename, i, generation) for i in range(num_chunks)]
+            chunk_sizes = {chunk_id: min(self.chunksize, file_size - i * self.chunksize)
+                           for i, chunk_id in enumerate(chunk_ids)}
+            if checksums is not None:
+                if len(checksums) != num_chunks:
+                    return {'status': 'error', 'message': 'Expected one checksum per chunk'}
+                chunk_ids = self.link_duplicate_chunks(chunk_ids, chunk_sizes, checksums)
+            # Chunks linked from other files are not ours to allocate; a chunk repeated within the file is stored once
+            new_chunk_ids = [chunk_id for chunk_id in dict.fromkeys(chunk_ids) if chunk_id in chunk_sizes]
+
+            # Allocate chunks to servers before publishing the file so readers never see it half-placed
+            if ec is not None:
+                stripes = [chunk_ids[start:start + k] + [new_chunk_id(filename, f'parity_{start // k}_{j}', generation)
+                                                         for j in range(m)]
+                           for start in range(0, num_chunks, k)]
+                chunk_allocation = self.allocate_stripes(stripes, chunk_sizes, m)
+            else:
+                chunk_allocation = self.allocate_chunks(new_chunk_ids, {chunk_id: chunk_sizes[chunk_id] for chunk_id in new_chunk_ids})
+            with self.namespace_lock.write():
+                self.create_file(filename, chunk_ids, {'size': file_size, 'mtime': time.time(), 'atime': time.time(),
+                                                       'codec': codec, 'ec': tuple(ec) if ec is not None else None,
+                                                       'stripes': stripes, 'generation': generation})
+        DEDUP_HITS.inc(num_chunks - len(new_chunk_ids))
+        return {'status': 'success', 'chunks': chunk_allocation, 'chunk_ids': chunk_ids, 'stripes': stripes,
+                'deduplicated': num_chunks - len(new_chunk_ids)}
 
-    def handle_upload(self, filename, file_size):
-        """Handle file upload requests by allocating chunks and assigning servers."""
-        if filename in self.file_map:
-            return {'status': 'error', 'message': 'File already exists'}
+    def link_duplicate_chunks(self, chunk_ids, chunk_sizes, checksums):
+        """Replace chunk IDs whose content is already stored by the existing chunk and take a reference.
 
-        num_chunks = self.num_chunks(file_size)
-        chunk_ids = [f"{filename}_chunk_{i}" for i in range(num_chunks)]
-        self.file_map[filename] = chunk_ids
+        New chunks are not indexed here: their data is only stored after this upload request,
+        and index_uploaded_chunks enters them once the client reports that it was.
+        """
+        linked = []
+        seen = {}  # Content repeated within this file maps to its first occurrence
+        with self.placement_lock.write():
+            for chunk_id, checksum in zip(chunk_ids, checksums):
+                if checksum in seen:
+                    linked.append(seen[checksum])
+                    continue
+                existing = self.chunk_hashes.get(checksum)
+                if existing is not None and self.chunk_locations.get(existing) and existing not in self.chunk_stripes \
+                        and self.chunk_sizes.get(existing) == chunk_sizes[chunk_id]:
+                    self.ref_chunk(existing)
+                    linked.append(existing)
+                else:
+                    linked.append(chunk_id)
+                seen[checksum] = linked[-1]
+        return linked
 
-        # Allocate chunks to servers
-        chunk_allocation = self.allocate_chunks(chunk_ids)
-        return {'status': 'success', 'chunks': chunk_allocation}
+    def index_uploaded_chunks(self, filename, checksums):
+        """Enter the chunks of a deduplicated upload into the dedup index once the client has stored them all.
 
-    def get_chunk_locations(self, filename):
-        """Return chunk locations for a requested file."""
-        if filename not in self.file_map:
-            return {'status': 'error', 'message': 'File not found'}
+        Content already indexed keeps its entry, so later uploads link to the oldest copy.
+        """
+        with self.file_lock(filename):
+            with self.namespace_lock.read():
+                chunk_ids = self.file_map.get(filename)
+            if chunk_ids is None or len(chunk_ids) != len(checksums):
+                return {'status': 'error', 'message': 'Expected one checksum per chunk of an existing file'}
+            with self.placement_lock.write():
+                for chunk_id, checksum in zip(chunk_ids, checksums):
+                    if checksum not in self.chunk_hashes and self.chunk_locations.get(chunk_id) \
+                            and chunk_id not in self.chunk_stripes:
+                        self.index_chunk(checksum, chunk_id)
+        return {'status': 'success'}
 
-        chunk_locations = {chunk_id: self.chunk_locations.get(chunk_id, []) for chunk_id in self.file_map[filename]}
-        return {'status': 'success', 'chunk_locations': chunk_locations}
+    def handle_batch_upload(self, files):
+        """Allocate chunks for a batch of (filename, file_size) entries in one request."""
+        allocations, errors = {}, {}
+        for filename, file_size in files:
+            response = self.handle_upload(filename, file_size)
+            if response['status'] == 'success':
+                allocations[filename] = response['chunks']
+            else:
+                errors[filename] = response['message']
+        return {'status': 'success', 'allocations': allocations, 'errors': errors}
+
+    def handle_record_append(self, filename, size, full_chunk_id=None, sealed_size=None, refused_chunk_id=None):
+        """Return the primary and secondaries for appending to the last chunk of filename.
+
+        The file is created on the first append. When the client reports that full_chunk_id
+        had no room for its record, that chunk is sealed at sealed_size and a new last chunk
+        is allocated (once, even if several producers report the same full chunk). When the
+        primary of refused_chunk_id refused the client's lease, a new lease is granted.
+        """
+        if size > self.chunksize // 4:
+            return {'status': 'error', 'message': f'Records are limited to {self.chunksize // 4} bytes'}
+
+        # The file lock also covers the lease grant, so a snapshot cannot share a chunk that is being granted
+        with self.file_lock(filename):
+            with self.namespace_lock.read():
+                chunk_ids = list(self.file_map.get(filename, []))
+                new_file = filename not in self.file_map
+                generation = self.deletions if new_file else self.file_info[filename].get('generation', 0)
+                if not new_file and self.file_info[filename].get('ec'):
+                    return {'status': 'error', 'message': 'Erasure-coded files cannot be appended to'}
+                if not new_file and self.file_info[filename].get('codec'):
+                    return {'status': 'error', 'message': 'Compressed files cannot be appended to'}
+
+            if new_file or (full_chunk_id is not None and full_chunk_id == chunk_ids[-1]):
+                grown = 0  # Bytes the file gains: the sealed chunk may already be counted, e.g. the last chunk of an upload
+                if full_chunk_id is not None and not new_file:  # A full chunk of a since deleted file stays as it is
+                    with self.placement_lock.read():
+                        grown = sealed_size - self.chunk_sizes.get(full_chunk_id, 0)
+                    self.resize_chunk(full_chunk_id, sealed_size)
+                chunk_id = new_chunk_id(filename, len(chunk_ids), generation)
+                self.allocate_chunks([chunk_id], {chunk_id: 0})
+                chunk_ids.append(chunk_id)
+                with self.namespace_lock.write():
+                    if new_file:
+                        self.create_file(filename, [], {'size': 0, 'mtime': time.time(), 'generation': generation})
+                    self.append_file_chunk(filename, chunk_id, grown, time.time())
+            else:
+                with self.placement_lock.read():
+                    shared = self.chunk_refs.get(chunk_ids[-1], 1) > 1
+                if shared:
+                    # The last chunk is shared with a snapshot: this file gets its own copy before appending to it
+                    chunk_ids[-1] = self.copy_on_write(filename, chunk_ids[-1], len(chunk_ids) - 1, generation)
+                    if chunk_ids[-1] is None:
+                        return {'status': 'error', 'message': f'No replica could copy the last chunk of {filename}'}
+
+            chunk_id = chunk_ids[-1]
+            with self.placement_lock.write():
+                servers = self.chunk_locations.setdefault(chunk_id, [])
+                if not servers and not self.chunk_sizes.get(chunk_id):
+                    # An empty tail chunk that could not be placed yet can simply be placed now
+                    for server in self.select_chunk_servers(REPLICATION_FACTOR):
+                        self.add_replica(chunk_id, server)
+                if not servers:
+                    return {'status': 'error', 'message': f'No replicas available for chunk {chunk_id}'}
+                primary = self.chunk_primaries.get(chunk_id)
+                granted = (primary is None or primary['primary'] not in servers or primary['expires'] < time.time() + 1
+                           or refused_chunk_id == chunk_id)  # The primary lost its grant, e.g. in a restart
+                if granted:
+                    primary = {'primary': servers[0], 'expires': time.time() + PRIMARY_LEASE_DURATION,
+                               'version': self.chunk_versions.get(chunk_id, 0) + 1}
+                    self.set_primary(chunk_id, primary)
+                secondaries = [server for server in servers if server != primary['primary']]
+
+            if granted:
+                missed = self.push_version(chunk_id, [primary['primary']] + secondaries, primary['version'], primary)
+                if primary['primary'] in missed:
+                    with self.placement_lock.write():
+                        self.set_primary(chunk_id, dict(primary, expires=0))  # The next request grants a new lease
+                    return {'status': 'error', 'message': f"Primary {primary['primary']} of chunk {chunk_id} is unreachable"}
+                secondaries = [server for server in secondaries if server not in missed]
+        return {'status': 'success', 'chunk_id': chunk_id, 'primary': primary['primary'],
+                'secondaries': secondaries, 'expires': primary['expires'], 'version': primary['version']}
+
+    def get_chunk_locations(self, filename, client_tags=()):
+        """Return chunk locations for a requested file, each chunk's replicas ordered by REPLICA_POLICY."""
+        with self.namespace_lock.read():
+            chunk_ids = self.file_map.get(filename)
+            if chunk_ids is None:
+                return {'status': 'error', 'message': 'File not found'}
+            info = dict(self.file_info[filename])
+        if info.get('atime', 0) < time.time() - ATIME_PRECISION:
+            # Journaled like every metadata change, so it takes the write lock; tiering only needs an approximate last access
+            with self.namespace_lock.write():
+                if filename in self.file_info and self.file_info[filename].get('atime', 0) < time.time() - ATIME_PRECISION:
+                    self.update_file(filename, {'atime': time.time()})
+
+        stripes = info.get('stripes') or []
+        order = REPLICA_POLICIES[REPLICA_POLICY]
+        with self.placement_lock.read():
+            chunk_locations = {chunk_id: list(self.chunk_locations.get(chunk_id, []))
+                               for chunk_id in chunk_ids + [member for stripe in stripes for member in stripe]}
+            versions = {chunk_id: self.chunk_versions[chunk_id] for chunk_id in chunk_ids if chunk_id in self.chunk_versions}
+        membership = self.servers  # Entries are replaced whole, so a reference is a consistent view
+        chunk_locations = {chunk_id: order(servers, membership, client_tags) if len(servers) > 1 else servers
+                           for chunk_id, servers in chunk_locations.items()}
+        # chunk_ids keeps the file's order, including chunks that appear more than once
+        return {'status': 'success', 'chunk_locations': chunk_locations, 'chunk_ids': list(chunk_ids),
+                'codec': info.get('codec'), 'ec': info.get('ec'), 'stripes': info.get('stripes'), 'versions': versions}
+
+    def delete_file(self, filename):
+        """Delete a file lazily: it is renamed to a hidden name and reclaimed DELETE_GRACE_SECONDS later.
+
+        Until then the hidden file can still be downloaded under the returned name, and its
+        chunks keep their replicas; garbage collection drops them once the file is reclaimed.
+        """
+        with self.file_lock(filename):
+            if self.lease_manager.get(filename) is not None:
+                return {'status': 'error', 'message': f'File {filename} is currently leased'}
+            with self.namespace_lock.write():
+                info = self.file_info.get(filename)
+                if info is None or 'deleted' in info:
+                    return {'status': 'error', 'message': 'File not found'}
+                hidden = self.hide_file(filename, time.time())
+        logging.info("Deleted file %s, hidden as %s until it is reclaimed", filename, hidden)
+        return {'status': 'success', 'hidden': hidden}
+
+    def snapshot(self, src, dst):
+        """Make dst a copy of src by duplicating its metadata only; no chunk data is moved.
+
+        The two files share src's chunks, reference counted in chunk_refs, until one of them is
+        appended to: only its last chunk can change, and handle_record_append first has that
+        chunk copied (copy_on_write). The primary lease of src's last chunk is revoked, so no
+        append reaches the shared chunk without passing the master. src may be a hidden
+        deleted file, which restores its contents under dst.
+        """
+        if dst.startswith(DELETED_PREFIX):
+            return {'status': 'error', 'message': f'Names under {DELETED_PREFIX} are reserved for deleted files'}
+        with self.files_lock(src, dst):
+            with self.namespace_lock.read():
+                if src not in self.file_map:
+                    return {'status': 'error', 'message': 'File not found'}
+                if dst in self.file_map:
+                    return {'status': 'error', 'message': 'File already exists'}
+                last = self.file_map[src][-1] if self.file_map[src] else None
+            if last is not None:
+                self.revoke_primary(last)
+            with self.namespace_lock.write(), self.placement_lock.write():
+                self.copy_file(src, dst, time.time())
+        logging.info("Snapshot of %s taken as %s", src, dst)
+        return {'status': 'success'}
+
+    def revoke_primary(self, chunk_id):
+        """End the record-append lease of chunk_id by raising its version on the replicas, if a lease is current."""
+        with self.placement_lock.write():
+            primary = self.chunk_primaries.get(chunk_id)
+            if primary is None or primary['expires'] <= time.time():
+                return
+            revoked = dict(primary, expires=0, version=self.chunk_versions.get(chunk_id, 0) + 1)
+            self.set_primary(chunk_id, revoked)
+            servers = list(self.chunk_locations.get(chunk_id, []))
+        # Replicas refuse appends under the old version from now on; the appenders come back to the master
+        self.push_version(chunk_id, servers, revoked['version'])
+
+    def copy_on_write(self, filename, chunk_id, index, generation):
+        """Give filename its own copy of its shared last chunk; returns the copy's ID, or None if no replica made one.
+
+        Every replica copies the chunk file locally, so no data crosses the network. The caller
+        holds the file lock and snapshots revoke the lease of the chunks they share, so the
+        chunk takes no appends while it is copied.
+        """
+        copy_id = new_chunk_id(filename, f'{index}_{self.snapshots}', generation)
+        with self.placement_lock.write():
+            servers = list(self.chunk_locations.get(chunk_id, []))
+            size = self.chunk_sizes.get(chunk_id, 0)
+            written = size > 0 or chunk_id in self.chunk_versions  # Uploaded data, or leased for appends
+            self.pending_copies.add(copy_id)
+        # A chunk allocated empty that never took an append has no data: the copy starts out empty on the same servers
+        copied = self.push_copy(chunk_id, copy_id, servers) if written else servers
+        with self.namespace_lock.write(), self.placement_lock.write():
+            self.pending_copies.discard(copy_id)
+            if not copied:
+                return None
+            self.create_chunks({copy_id: size})
+            for server in copied:
+                self.add_replica(copy_id, server)
+            self.replace_chunk(filename, chunk_id, copy_id)
+        log_sampled(logging.INFO, 'chunk_copied_on_write', chunk_id=chunk_id, copy=copy_id, replicas=len(copied))
+        return copy_id
+
+    def check_metadata(self, limit=100):
+        """Cross-check the metadata indexes and counters; returns up to limit violations, none if consistent.
+
+        Checks that chunk_locations and chunk_servers_info mirror each other, that server_usage,
+        replica_bytes and logical_bytes match what they summarize, that the dedup index and its
+        reverse map agree, and that every chunk of a file is known. Used by the stress workload
+        of bench.py.
+        """
+        violations = []
+        with self.namespace_lock.read(), self.placement_lock.read():
+            usage = {}
+            for chunk_id, servers in self.chunk_locations.items():
+                if len(set(servers)) != len(servers):
+                    violations.append(f"chunk {chunk_id} lists a server twice: {servers}")
+                for server in servers:
+                    usage[server] = usage.get(server, 0) + self.chunk_sizes.get(chunk_id, 0)
+                    if chunk_id not in self.chunk_servers_info.get(server, ()):
+                        violations.append(f"chunk {chunk_id} is placed on {server}, which does not list it")
+            for server, chunk_ids in self.chunk_servers_info.items():
+                for chunk_id in chunk_ids:
+                    if server not in self.chunk_locations.get(chunk_id, ()):
+                        violations.append(f"server {server} lists chunk {chunk_id}, which is not placed there")
+            for server in set(usage) | set(self.server_usage):
+                if usage.get(server, 0) != self.server_usage.get(server, 0):
+                    violations.append(f"server {server} is accounted {self.server_usage.get(server, 0)} bytes, "
+                                      f"its replicas hold {usage.get(server, 0)}")
+            if sum(usage.values()) != self.replica_bytes:
+                violations.append(f"replica_bytes is {self.replica_bytes}, the replicas hold {sum(usage.values())}")
+            logical = sum(info['size'] for info in self.file_info.values() if 'deleted' not in info)
+            if logical != self.logical_bytes:
+                violations.append(f"logical_bytes is {self.logical_bytes}, the files hold {logical}")
+            for filename, chunk_ids in self.file_map.items():
+                missing = [chunk_id for chunk_id in chunk_ids if chunk_id not in self.chunk_sizes]
+                if missing:
+                    violations.append(f"file {filename} references unknown chunks {missing[:3]}")
+            for checksum, chunk_id in self.chunk_hashes.items():
+                if self.chunk_checksums.get(chunk_id) != checksum or chunk_id not in self.chunk_sizes:
+                    violations.append(f"dedup index maps {checksum[:12]} to {chunk_id}, which is unknown or mapped back differently")
+        return violations[:limit]
+
+    def get_storage_usage(self):
+        """Return cluster and per-server usage from the incrementally maintained counters."""
+        with self.placement_lock.read():
+            replica_bytes = self.replica_bytes
+            servers = dict(self.server_usage)
+        return {
+            'status': 'success',
+            'total_bytes': self.logical_bytes,
+            'replica_bytes': replica_bytes,
+            'num_files': len(self.namespace),
+            'servers': servers,
+            'tiering': dict(self.tiering_stats),
+            'gc': dict(self.gc_stats),
+            'rebalance': dict(self.rebalance_stats),
+            'reported': {server: {'used_bytes': info['used_bytes'], 'capacity': info['capacity']}
+                         for server, info in self.servers.items()},
+        }
+
+    def list_files(self, prefix, delimiter, cursor, limit):
+        """Return one page of files (with sizes) and sub-directories under prefix."""
+        limit = max(1, min(limit, LIST_PAGE_SIZE))
+        with self.namespace_lock.read():
+            names, dirs, next_cursor = self.namespace.list(prefix, delimiter, cursor, limit)
+            files = [{'name': name, 'size': self.file_info[name]['size']} for name in names]
+        return {'status': 'success', 'files': files, 'dirs': dirs, 'next_cursor': next_cursor}
+
+    def get_file_stats(self, prefix, cursor, limit):
+        """Return one page of per-file size, mtime and replica count under prefix."""
+        limit = max(1, min(limit, LIST_PAGE_SIZE))
+        files = []
+        with self.namespace_lock.read(), self.placement_lock.read():
+            names, _, next_cursor = self.namespace.list(prefix, None, cursor, limit)
+            for filename in names:
+                info = self.file_info[filename]
+                replicas = [len(self.chunk_locations.get(chunk_id, [])) for chunk_id in self.file_map.get(filename, [])]
+                files.append({
+                    'name': filename,
+                    'size': info['size'],
+                    'mtime': info['mtime'],
+                    'codec': info.get('codec'),
+                    'ec': info.get('ec'),
+                    'replicas': min(replicas) if replicas else 0,
+                })
+        return {'status': 'success', 'files': files, 'next_cursor': next_cursor}
+
+    def tier_cold_files(self):
+        """Periodically rewrite replicated files idle for TIERING_IDLE_SECONDS into erasure-coded stripes."""
+        while True:
+            time.sleep(TIERING_INTERVAL)
+            try:
+                self.run_tiering_pass(TIERING_IDLE_SECONDS)
+            except Exception as e:
+                logging.error("Tiering pass failed: %s", e)
+
+    def run_tiering_pass(self, idle_seconds):
+        """Convert every replicated file not downloaded for idle_seconds to TIERING_EC; returns the pass report."""
+        k, m = TIERING_EC
+        with self.data_movement_lock:
+            started = time.time()
+            with self.namespace_lock.read():
+                cold = [filename for filename, info in self.file_info.items()
+                        if not info.get('ec') and 'deleted' not in info and info.get('atime', info['mtime']) < started - idle_seconds]
+            report = {'files_converted': 0, 'bytes_read': 0, 'bytes_reclaimed': 0}
+            for filename in cold:
+                if self.lease_manager.get(filename) is not None:
+                    continue  # Leased files are being written
+                result = self.convert_to_ec(filename, k, m)
+                if result is not None:
+                    report['files_converted'] += 1
+                    report['bytes_read'] += result[0]
+                    report['bytes_reclaimed'] += result[1]
+            report['seconds'] = time.time() - started
+            self.tiering_stats['passes'] += 1
+            for key, value in report.items():
+                self.tiering_stats[key] += value
+        if report['files_converted']:
+            logging.info("Tiering pass converted %d of %d cold files to RS(%d,%d), reclaiming %d bytes at %.1f MB/s read",
+                         report['files_converted'], len(cold), k, m, report['bytes_reclaimed'],
+                         report['bytes_read'] / max(report['seconds'], 1e-9) / 1e6)
+        return {'status': 'success', 'cold_files': len(cold), **report}
+
+    def convert_to_ec(self, filename, k, m):
+        """Rewrite a replicated file as RS(k, m) stripes; returns (bytes_read, bytes_reclaimed) or None if skipped.
+
+        Each data chunk keeps one of its replicas where the stripe allows it, so mostly parity
+        is written; the surplus replicas are deleted once the new layout is published. Files
+        that share chunks, take record appends or change during the conversion are skipped.
+        """
+        started = time.time()
+        with self.namespace_lock.read():
+            chunk_ids = list(self.file_map.get(filename, []))
+            generation = self.file_info.get(filename, {}).get('generation', 0)
+        with self.placement_lock.read():
+            if not chunk_ids or len(set(chunk_ids)) != len(chunk_ids) or len(self.active_servers) < k + m:
+                return None
+            if any(self.chunk_refs.get(chunk_id, 1) > 1 or chunk_id in self.chunk_stripes
+                   or self.chunk_primaries.get(chunk_id, {}).get('expires', 0) > started for chunk_id in chunk_ids):
+                return None
+            stripes = [chunk_ids[start:start + k] + [new_chunk_id(filename, f'parity_{start // k}_{j}', generation)
+                                                     for j in range(m)]
+                       for start in range(0, len(chunk_ids), k)]
+            locations = {chunk_id: list(self.chunk_locations.get(chunk_id, [])) for chunk_id in chunk_ids}
+            versions = {chunk_id: self.chunk_versions[chunk_id] for chunk_id in chunk_ids if chunk_id in self.chunk_versions}
+            plan = {}  # Member -> the one server holding it in the new layout
+            for stripe in stripes:
+                used = set()
+                for chunk_id in stripe[:-m]:
+                    keep = next((server for server in locations[chunk_id]
+                                 if server in self.active_servers and server not in used), None)
+                    if keep is None:  # Every replica collides with another member: move the chunk
+                        keep = next(iter(self.select_chunk_servers(1, exclude=used)), None)
+                    if keep is None:
+                        return None
+                    plan[chunk_id] = keep
+                    used.add(keep)
+                parity_servers = self.select_chunk_servers(m, exclude=used)
+                if len(parity_servers) < m:
+                    return None
+                plan.update(zip(stripe[-m:], parity_servers))
+
+        bytes_read, written = 0, {}
+        for start in range(0, len(stripes), TIERING_STRIPES):
+            step_started = time.time()
+            step = stripes[start:start + TIERING_STRIPES]
+            fetched = self.read_chunks({chunk_id: locations[chunk_id] for stripe in step for chunk_id in stripe[:-m]}, versions)
+            data = [[fetched.get(chunk_id) for chunk_id in stripe[:-m]] for stripe in step]
+            if any(chunk is None for chunks in data for chunk in chunks):
+                logging.warning("Tiering skipped %s: some chunks could not be read", filename)
+                self.delete_chunks(written)
+                return None
+            per_server = {}
+            for stripe, chunks, parity in zip(step, data, erasure.parity_chunks(data, k, m)):
+                for chunk_id, chunk in zip(stripe, chunks + parity):
+                    if plan[chunk_id] not in locations.get(chunk_id, ()):
+                        per_server.setdefault(plan[chunk_id], []).append(
+                            {'filename': chunk_owner(chunk_id), 'chunk_id': chunk_id, 'data': chunk,
+                             'checksum': hashlib.sha256(chunk).hexdigest(), 'version': versions.get(chunk_id, 0)})
+                        written.setdefault(plan[chunk_id], []).append((chunk_owner(chunk_id), chunk_id))
+                bytes_read += sum(len(chunk) for chunk in chunks)
+            if not self.store_chunks(per_server):
+                logging.warning("Tiering skipped %s: some chunks could not be written", filename)
+                self.delete_chunks(written)
+                return None
+            # Throttle to TIERING_BYTES_PER_SECOND of reads
+            step_bytes = sum(len(chunk) for chunks in data for chunk in chunks)
+            time.sleep(max(0, step_bytes / TIERING_BYTES_PER_SECOND - (time.time() - step_started)))
+
+        # Publish the new layout unless the file changed or a snapshot or dedup upload shared its chunks in the meantime
+        surplus = {}
+        with self.file_lock(filename), self.namespace_lock.write(), self.placement_lock.write():
+            if self.file_map.get(filename) != chunk_ids or self.file_info[filename].get('ec') \
+                    or any(self.chunk_primaries.get(chunk_id, {}).get('expires', 0) > started
+                           or self.chunk_refs.get(chunk_id, 1) > 1 for chunk_id in chunk_ids):
+                abandoned = True
+            else:
+                abandoned = False
+                replica_bytes = self.replica_bytes
+                for stripe in stripes:
+                    width = max(self.chunk_sizes.get(chunk_id, 0) for chunk_id in stripe[:-m])
+                    self.create_chunks({chunk_id: width for chunk_id in stripe[-m:]})
+                    for chunk_id in stripe:
+                        for server in list(self.chunk_locations[chunk_id]):
+                            if server != plan[chunk_id]:
+                                self.remove_replica(chunk_id, server)
+                                surplus.setdefault(server, []).append((chunk_owner(chunk_id), chunk_id))
+                        if plan[chunk_id] not in self.chunk_locations[chunk_id]:
+                            self.add_replica(chunk_id, plan[chunk_id])
+                    self.set_stripe(stripe)
+                self.update_file(filename, {'ec': (k, m), 'stripes': stripes})
+                reclaimed = replica_bytes - self.replica_bytes
+        if abandoned:
+            logging.info("Tiering skipped %s: the file changed or its chunks became shared during conversion", filename)
+            self.delete_chunks(written)
+            return None
+        self.journal.sync()  # The surplus replicas must stay until the new layout survives a restart
+        self.delete_chunks(surplus)
+        logging.info("Converted %s to RS(%d,%d), reclaiming %d bytes", filename, k, m, reclaimed)
+        return bytes_read, reclaimed
+
+    def rebalance_servers(self):
+        """Periodically move chunks from over- to under-utilized chunk servers."""
+        while True:
+            time.sleep(REBALANCE_INTERVAL)
+            try:
+                self.run_rebalance()
+            except Exception as e:
+                logging.error("Rebalancing round failed: %s", e)
+
+    def run_rebalance(self):
+        """Plan and execute one round of chunk moves, throttled to REBALANCE_BYTES_PER_SECOND."""
+        with self.data_movement_lock:
+            started = time.time()
+            with self.placement_lock.read():
+                utilization = self.server_utilization()
+                moves = self.plan_rebalance(utilization)
+            report = {'chunks_moved': 0, 'bytes_moved': 0, 'failed_moves': 0}
+            for chunk_id, source, target in moves:
+                move_started = time.time()
+                size = self.move_chunk(chunk_id, source, target)
+                if size is None:
+                    report['failed_moves'] += 1
+                    continue
+                report['chunks_moved'] += 1
+                report['bytes_moved'] += size
+                time.sleep(max(0, size / REBALANCE_BYTES_PER_SECOND - (time.time() - move_started)))
+            report['seconds'] = time.time() - started
+            self.rebalance_stats['rounds'] += 1
+            for key, value in report.items():
+                self.rebalance_stats[key] += value
+        if moves:
+            logging.info("Rebalancing moved %d chunks (%d bytes, %d failed) in %.1f s; utilization was %s",
+                         report['chunks_moved'], report['bytes_moved'], report['failed_moves'], report['seconds'], utilization)
+        return {'status': 'success', 'utilization': utilization, 'planned_moves': len(moves), **report}
+
+    def server_utilization(self):
+        """Return {server: used bytes / capacity} for active servers with a heartbeat report."""
+        return {server: self.servers[server]['used_bytes'] / self.server_capacity(server)
+                for server in self.active_servers if self.servers[server].get('used_bytes') is not None}
+
+    def plan_rebalance(self, utilization):
+        """Plan (chunk_id, source, target) moves that bring every server within REBALANCE_TOLERANCE of the mean.
+
+        Utilization comes from heartbeat reports and is projected forward as moves are planned.
+        A chunk never moves onto a server holding another replica or another member of its
+        stripe, and chunks taking record appends stay put.
+        """
+        if len(utilization) < 2:
+            return []
+        used = {server: utilization[server] * self.server_capacity(server) for server in utilization}
+        mean = sum(used.values()) / sum(self.server_capacity(server) for server in used)
+        if mean == 0:
+            return []
+        projected = dict(utilization)
+        candidates = {server: iter(list(self.chunk_servers_info.get(server, ()))) for server in utilization}
+        moves, planned, now = [], set(), time.time()
+        while len(moves) < REBALANCE_MAX_MOVES:
+            source = max(projected, key=projected.get)
+            target = min(projected, key=projected.get)
+            if projected[source] <= mean * (1 + REBALANCE_TOLERANCE) and projected[target] >= mean * (1 - REBALANCE_TOLERANCE):
+                break
+            for chunk_id in candidates[source]:
+                holders = set(self.chunk_locations.get(chunk_id, ()))
+                for member in self.chunk_stripes.get(chunk_id, ()):
+                    holders.update(self.chunk_locations.get(member, ()))
+                if chunk_id not in planned and target not in holders and self.chunk_sizes.get(chunk_id) \
+                        and self.chunk_primaries.get(chunk_id, {}).get('expires', 0) <= now:
+                    break
+            else:
+                del projected[source]  # Nothing left on the source that may move to the target
+                if len(projected) < 2:
+                    break
+                continue
+            size = self.chunk_sizes[chunk_id]
+            projected[source] -= size / self.server_capacity(source)
+            projected[target] += size / self.server_capacity(target)
+            planned.add(chunk_id)
+            moves.append((chunk_id, source, target))
+        return moves
+
+    def request_replication(self, chunk_id, source, target):
+        """Have source send its replica of chunk_id to target; returns the target's response."""
+        try:
+            with socket.create_connection(server_address(source), timeout=30) as s:
+                s.sendall(pickle.dumps({'command': 'replicate_to', 'filename': chunk_owner(chunk_id), 'chunk_id': chunk_id,
+                                        'target': target}))
+                return pickle.load(s.makefile('rb'))
+        except Exception as e:
+            return {'status': 'error', 'message': str(e)}
+
+    def move_chunk(self, chunk_id, source, target):
+        """Copy chunk_id from source to target through the replicate path, then drop the source copy.
+
+        The source replica is deleted only after the target confirmed the copy and the new
+        location was recorded. Returns the bytes moved, or None if the move did not happen.
+        """
+        filename = chunk_owner(chunk_id)
+        response = self.request_replication(chunk_id, source, target)
+        if response.get('status') != 'success':
+            logging.warning("Failed to move chunk %s from server %s to %s: %s", chunk_id, source, target, response.get('message'))
+            return None
+
+        with self.placement_lock.write():
+            servers = self.chunk_locations.get(chunk_id, [])
+            moved = source in servers and target not in servers
+            stray = target not in servers
+            if moved:
+                self.add_replica(chunk_id, target)
+                self.remove_replica(chunk_id, source)
+                size = self.chunk_sizes.get(chunk_id, 0)
+        if not moved:
+            if stray:  # The chunk changed hands meanwhile and nothing references the copy just made
+                self.delete_chunks({target: [(filename, chunk_id)]})
+            return None
+        self.journal.sync()  # The source copy must stay until the new location survives a restart
+        self.delete_chunks({source: [(filename, chunk_id)]})
+        # Project the move into the usage reports until the next heartbeats replace them
+        for server, delta in ((source, -size), (target, size)):
+            info = self.servers.get(server)
+            if info is not None and info.get('used_bytes') is not None:
+                self.servers[server] = dict(info, used_bytes=info['used_bytes'] + delta)
+        return size
+
+    def collect_garbage(self):
+        """Periodically reclaim deleted files and remove chunk files the metadata no longer places."""
+        while True:
+            time.sleep(GC_INTERVAL)
+            try:
+                self.run_gc(DELETE_GRACE_SECONDS)
+            except Exception as e:
+                logging.error("Garbage collection pass failed: %s", e)
+
+    def run_gc(self, grace_seconds):
+        """Reclaim files deleted more than grace_seconds ago, then delete orphaned chunk files; returns the pass report.
+
+        Every active chunk server's inventory is compared with the metadata, and the chunk
+        files it holds that the metadata does not place there are deleted in batches of
+        GC_DELETE_BATCH, throttled to GC_DELETES_PER_SECOND per server. Runs as a data-movement
+        job, since tiering and rebalancing store copies before recording them.
+        """
+        with self.data_movement_lock:
+            started = time.time()
+            with self.namespace_lock.read():
+                expired = [filename for filename, info in self.file_info.items()
+                           if info.get('deleted', started) < started - grace_seconds]
+            report = {'files_reclaimed': len(expired), 'chunks_reclaimed': 0, 'orphans_deleted': 0, 'bytes_freed': 0}
+            for start in range(0, len(expired), GC_RECLAIM_BATCH):
+                with self.namespace_lock.write(), self.placement_lock.write():
+                    report['chunks_reclaimed'] += self.remove_files(expired[start:start + GC_RECLAIM_BATCH])
+            self.journal.sync()  # Reclaimed chunks must stay forgotten across a restart before their files go
+
+            orphans, unreachable = self.find_orphans()
+            for server, chunk_ids in orphans.items():
+                for start in range(0, len(chunk_ids), GC_DELETE_BATCH):
+                    batch_started = time.time()
+                    with self.placement_lock.read():  # Skip chunks placed on the server since the diff
+                        batch = [chunk_id for chunk_id in chunk_ids[start:start + GC_DELETE_BATCH]
+                                 if chunk_id not in self.chunk_servers_info.get(server, ())]
+                    report['bytes_freed'] += self.delete_chunks({server: [(chunk_owner(chunk_id), chunk_id) for chunk_id in batch]})
+                    report['orphans_deleted'] += len(batch)
+                    time.sleep(max(0, len(batch) / GC_DELETES_PER_SECOND - (time.time() - batch_started)))
+            report['seconds'] = time.time() - started
+            self.gc_stats['passes'] += 1
+            for key, value in report.items():
+                self.gc_stats[key] += value
+        if expired or any(orphans.values()):
+            logging.info("Garbage collection reclaimed %d files (%d chunks) and deleted %d orphaned chunk files (%d bytes) in %.1f s",
+                         report['files_reclaimed'], report['chunks_reclaimed'], report['orphans_deleted'],
+                         report['bytes_freed'], report['seconds'])
+        return {'status': 'success', 'unreachable_servers': unreachable, **report}
+
+    def find_orphans(self):
+        """Diff the inventories of the active chunk servers with the metadata; returns ({server: [chunk IDs]}, unreachable servers).
+
+        A chunk the metadata no longer knows is an orphan wherever it is. A copy of a known
+        chunk on a server that does not hold a replica of it is an orphan only once enough of
+        the recorded replicas were seen in their servers' inventories, so the last good copy
+        of a chunk whose recorded replicas were lost is kept. A copy older than the chunk's
+        version is dropped from the replicas and is an orphan once one current replica was seen.
+        """
+        with self.placement_lock.read():
+            servers = list(self.active_servers)
+        inventories, unreachable = {}, []
+        for server in servers:
+            try:
+                with socket.create_connection(server_address(server), timeout=60) as s:
+                    s.sendall(pickle.dumps({'command': 'inventory'}))
+                    response = pickle.load(s.makefile('rb'))
+                    inventories[server] = (set(response['chunk_ids']), response.get('versions', {}))
+            except Exception as e:
+                logging.warning("Failed to take the chunk inventory of server %s: %s", server, e)
+                unreachable.append(server)
+        def current(server, chunk_id):
+            chunk_ids, versions = inventories.get(server, ((), {}))
+            return chunk_id in chunk_ids and versions.get(chunk_id, 0) >= self.chunk_versions.get(chunk_id, 0)
+
+        orphans = {}
+        with self.placement_lock.write():
+            for server, (inventory, versions) in inventories.items():
+                placed = self.chunk_servers_info.get(server, set())
+                stale = [chunk_id for chunk_id, version in versions.items()
+                         if chunk_id in inventory and version < self.chunk_versions.get(chunk_id, 0)]
+                orphans[server] = [chunk_id for chunk_id in inventory - placed - set(stale) - self.pending_copies
+                                   if chunk_id not in self.chunk_locations
+                                   or sum(current(holder, chunk_id) for holder in self.chunk_locations[chunk_id])
+                                   >= self.replication_target(chunk_id)]
+                for chunk_id in stale:
+                    if any(current(holder, chunk_id) for holder in self.chunk_locations.get(chunk_id, ()) if holder != server):
+                        if server in self.chunk_locations[chunk_id]:
+                            self.remove_replica(chunk_id, server)
+                        orphans[server].append(chunk_id)
+        self.journal.sync()
+        return orphans, unreachable
+
+    def read_chunks(self, locations, versions=None):
+        """Read {chunk_id: servers} at {chunk_id: version}, trying the replicas in turn; returns {chunk_id: data}."""
+        fetched = {}
+        locations = {chunk_id: servers for chunk_id, servers in locations.items() if servers}
+        while locations:
+            per_server = {}
+            for chunk_id, servers in locations.items():
+                per_server.setdefault(servers[0], []).append(chunk_id)
+            for server, chunk_ids in per_server.items():
+                try:
+                    with socket.create_connection(server_address(server), timeout=30) as s:
+                        s.sendall(pickle.dumps({'command': 'download_batch', 'versions': versions or {},
+                                                'chunks': [(chunk_owner(chunk_id), chunk_id) for chunk_id in chunk_ids]}))
+                        stream = s.makefile('rb')
+                        for _ in chunk_ids:
+                            response = pickle.load(stream)
+                            if response.get('status') == 'success' \
+                                    and hashlib.sha256(response['data']).hexdigest() == response['checksum']:
+                                fetched[response['chunk_id']] = response['data']
+                except Exception as e:
+                    logging.warning("Failed to read %d chunks from server %s: %s", len(chunk_ids), server, e)
+            locations = {chunk_id: servers[1:] for chunk_id, servers in locations.items()
+                         if chunk_id not in fetched and len(servers) > 1}
+        return fetched
+
+    def store_chunks(self, per_server):
+        """Write {server: [chunk dicts]} with store_batch; returns whether every chunk was stored."""
+        for server, chunks in per_server.items():
+            try:
+                with socket.create_connection(server_address(server), timeout=30) as s:
+                    s.sendall(pickle.dumps({'command': 'store_batch', 'chunks': chunks}))
+                    results = pickle.load(s.makefile('rb'))['results']
+            except Exception as e:
+                logging.warning("Failed to store chunks on server %s: %s", server, e)
+                return False
+            if any(result.get('status') != 'success' for result in results.values()):
+                return False
+        return True
+
+    def delete_chunks(self, per_server):
+        """Ask each server in {server: [(filename, chunk_id)]} to delete those chunks; returns the bytes freed.
+
+        Failures leave garbage behind for garbage collection to find.
+        """
+        freed = 0
+        for server, chunks in per_server.items():
+            try:
+                with socket.create_connection(server_address(server), timeout=30) as s:
+                    s.sendall(pickle.dumps({'command': 'delete_batch', 'chunks': chunks}))
+                    freed += pickle.load(s.makefile('rb')).get('freed', 0)
+            except Exception as e:
+                logging.warning("Failed to delete %d chunks on server %s: %s", len(chunks), server, e)
+        return freed
 
     def lease_file(self, filename, client_address):
         """Lease a file to a client for exclusive write access."""
-        if filename in self.leases and self.leases[filename]['expires'] > time.time():
+        lease = self.lease_manager.grant(filename, client_address, LEASE_DURATION)
+        if lease is None:
             return {'status': 'error', 'message': f'File {filename} is already leased.'}
 
-        # Grant lease and set expiration time
-        self.leases[filename] = {
-            'expires': time.time() + LEASE_DURATION,
-            'client': client_address
-        }
+        self.push_lease(filename, lease['expires'])
         logging.info("Leased file %s to client %s for %d seconds", filename, client_address, LEASE_DURATION)
-        return {'status': 'success', 'message': f'File {filename} leased for {LEASE_DURATION} seconds.'}
+        return {'status': 'success', 'message': f'File {filename} leased for {LEASE_DURATION} seconds.',
+                'lease_id': lease['lease_id'], 'expires': lease['expires']}
+
+    def renew_lease(self, filename, lease_id):
+        """Extend a lease for its current holder."""
+        lease = self.lease_manager.renew(filename, lease_id, LEASE_DURATION)
+        if lease is None:
+            return {'status': 'error', 'message': f'File {filename} is not leased under this lease ID.'}
+
+        self.push_lease(filename, lease['expires'])
+        return {'status': 'success', 'message': f'Lease on {filename} extended for {LEASE_DURATION} seconds.',
+                'lease_id': lease_id, 'expires': lease['expires']}
 
     def unlease_file(self, filename):
         """Release a lease on a file, allowing other clients to access it."""
-        if filename in self.leases:
-            del self.leases[filename]
+        if self.lease_manager.release(filename):
+            self.push_lease(filename, None)
             logging.info("Unleased file %s", filename)
             return {'status': 'success', 'message': f'File {filename} has been unleased.'}
         else:
             return {'status': 'error', 'message': f'File {filename} was not leased.'}
 
-    def lease_expiration_checker(self):
-        """Periodically check and expire leases that have timed out."""
-        while True:
-            time.sleep(5)  # Check every 5 seconds
-            current_time = time.time()
-            expired_leases = [file for file, lease in self.leases.items() if lease['expires'] < current_time]
-            for filename in expired_leases:
-                del self.leases[filename]
-                logging.info("Lease expired for file %s", filename)
+    def push_version(self, chunk_id, servers, version, primary=None):
+        """Send the new version of chunk_id to its replicas and drop the replicas that miss it; returns those servers.
+
+        A replica that missed the version is stale from now on. The version is journaled first,
+        so no replica can hold a version the master could forget. With a primary lease grant,
+        the replica it names learns that it is primary until the grant expires; every other
+        replica forgets any grant it held for the chunk.
+        """
+        self.journal.sync()
+        missed = []
+        for server in servers:
+            granted = primary is not None and primary['primary'] == server
+            message = pickle.dumps({'command': 'set_version', 'filename': chunk_owner(chunk_id), 'chunk_id': chunk_id,
+                                    'version': version, 'expires': primary['expires'] if granted else None})
+            try:
+                with socket.create_connection(server_address(server), timeout=LEASE_PUSH_TIMEOUT) as s:
+                    s.sendall(message)
+                    response = pickle.load(s.makefile('rb'))
+            except Exception as e:
+                response = {'status': 'error', 'message': str(e)}
+            if response.get('status') != 'success':
+                logging.warning("Server %s missed version %d of chunk %s: %s", server, version, chunk_id, response.get('message'))
+                missed.append(server)
+        if missed:
+            with self.placement_lock.write():
+                for server in missed:
+                    self.remove_replica(chunk_id, server)
+        return missed
+
+    def push_copy(self, chunk_id, copy_id, servers):
+        """Have each server copy its replica of chunk_id to copy_id; returns the servers that did."""
+        message = pickle.dumps({'command': 'copy_chunk', 'filename': chunk_owner(chunk_id), 'chunk_id': chunk_id,
+                                'copy_filename': chunk_owner(copy_id), 'copy_id': copy_id})
+        copied = []
+        for server in servers:
+            try:
+                with socket.create_connection(server_address(server), timeout=30) as s:
+                    s.sendall(message)
+                    response = pickle.load(s.makefile('rb'))
+            except Exception as e:
+                response = {'status': 'error', 'message': str(e)}
+            if response.get('status') == 'success':
+                copied.append(server)
+            else:
+                logging.warning("Server %s failed to copy chunk %s to %s: %s", server, chunk_id, copy_id, response.get('message'))
+        return copied
+
+    def check_versions(self, server, versions):
+        """Drop the replicas on server that {chunk_id: version} shows to be older than the chunk; GC deletes them."""
+        with self.placement_lock.write():
+            for chunk_id, version in versions.items():
+                if version < self.chunk_versions.get(chunk_id, 0) and server in self.chunk_locations.get(chunk_id, ()):
+                    log_sampled(logging.WARNING, 'stale_replica', chunk_id=chunk_id, server=server, version=version,
+                                current=self.chunk_versions[chunk_id])
+                    self.remove_replica(chunk_id, server)
 
-    def allocate_chunks(self, chunk_ids):
+    def push_lease(self, filename, expires):
+        """Send a lease grant (expires) or release (None) to every active chunk server.
+
+        Chunk servers cache the expiry time and check it locally on store, so expiry itself
+        needs no message. The pushes run in parallel and the request waits at most
+        LEASE_PUSH_TIMEOUT for them; heartbeat responses carry a full snapshot that repairs
+        servers the push missed or reached late.
+        """
+        with self.placement_lock.read():
+            servers = list(self.active_servers)
+        message = pickle.dumps({'command': 'lease_update', 'filename': filename, 'expires': expires})
+        wait([self.lease_pushes.submit(self.send_lease_update, server, filename, message) for server in servers],
+             timeout=LEASE_PUSH_TIMEOUT)
+
+    def send_lease_update(self, server, filename, message):
+        """Deliver one pickled lease update to a chunk server and wait for its acknowledgement."""
+        try:
+            with socket.create_connection(server_address(server), timeout=LEASE_PUSH_TIMEOUT) as s:
+                s.sendall(message)
+                s.recv(4096)  # Wait for the cache update to be acknowledged
+        except Exception as e:
+            logging.warning("Failed to push lease update for %s to server %s: %s", filename, server, e)
+
+    def allocate_chunks(self, chunk_ids, chunk_sizes):
         """Allocate chunks across available chunk servers with replication."""
         chunk_allocation = {}
-        for chunk_id in chunk_ids:
-            servers = self.select_chunk_servers(REPLICATION_FACTOR)
-            self.chunk_locations[chunk_id] = servers
+        with self.placement_lock.write():
+            self.create_chunks(chunk_sizes)
+            for chunk_id in chunk_ids:
+                servers = self.select_chunk_servers(REPLICATION_FACTOR)
 
-            # Track chunk assignments for each server
-            for server in servers:
-                self.chunk_servers_info[server].append(chunk_id)
+                # Track chunk assignments for each server
+                for server in servers:
+                    self.add_replica(chunk_id, server)
 
-            chunk_allocation[chunk_id] = servers
+                chunk_allocation[chunk_id] = servers
         return chunk_allocation
 
-    def select_chunk_servers(self, replication_factor):
-        """Select servers for chunk replication based on their current load and active status."""
-        active_servers_info = {s: self.chunk_servers_info[s] for s in self.active_servers}
-        available_servers = sorted(active_servers_info.items(), key=lambda x: len(x[1]))
-        selected_servers = [server for server, _ in available_servers[:replication_factor]]
+    def allocate_stripes(self, stripes, chunk_sizes, parity_shards):
+        """Place each member of each erasure-coded stripe once, on distinct chunk servers.
+
+        Parity chunks are as long as the longest data chunk of their stripe.
+        """
+        chunk_allocation = {}
+        with self.placement_lock.write():
+            for stripe in stripes:
+                width = max(chunk_sizes[chunk_id] for chunk_id in stripe[:-parity_shards])
+                servers = self.select_chunk_servers(len(stripe))
+                self.create_chunks({chunk_id: chunk_sizes.get(chunk_id, width) for chunk_id in stripe})
+                self.set_stripe(stripe)
+                for chunk_id, server in zip(stripe, servers):
+                    self.add_replica(chunk_id, server)
+                    chunk_allocation[chunk_id] = [server]
+        return chunk_allocation
+
+    def replication_target(self, chunk_id):
+        """Return how many copies chunk_id should have: stripe members rely on parity instead of replicas."""
+        return 1 if chunk_id in self.chunk_stripes else REPLICATION_FACTOR
+
+    def create_chunks(self, chunk_sizes):
+        """Record new chunks of the given {chunk_id: size}, each with one reference and no replicas yet.
+
+        Like the other placement helpers, the caller must hold placement_lock for writing, and
+        the change is journaled so that replaying the journal repeats it after a restart.
+        """
+        self.journal.log('create_chunks', chunk_sizes)
+        self.chunk_sizes.update(chunk_sizes)
+        for chunk_id in chunk_sizes:
+            self.chunk_refs[chunk_id] = 1
+            self.chunk_locations[chunk_id] = []
+
+    def set_stripe(self, stripe):
+        """Record the members of an erasure-coded stripe."""
+        self.journal.log('set_stripe', stripe)
+        for chunk_id in stripe:
+            self.chunk_stripes[chunk_id] = stripe
+
+    def ref_chunk(self, chunk_id):
+        """Take another file reference to a stored chunk."""
+        self.journal.log('ref_chunk', chunk_id)
+        self.chunk_refs[chunk_id] += 1
+
+    def index_chunk(self, checksum, chunk_id):
+        """Enter chunk_id into the dedup index under the SHA-256 of its content."""
+        self.journal.log('index_chunk', checksum, chunk_id)
+        self.chunk_hashes[checksum] = chunk_id
+        self.chunk_checksums[chunk_id] = checksum
+
+    def set_primary(self, chunk_id, primary):
+        """Make {'primary': <server>, 'expires': <time>, 'version': <n>} the record-append primary of chunk_id at version n."""
+        self.journal.log('set_primary', chunk_id, primary)
+        self.chunk_primaries[chunk_id] = primary
+        self.chunk_versions[chunk_id] = primary.get('version', 0)
+
+    def add_replica(self, chunk_id, server):
+        """Record a replica of chunk_id on server and account for its bytes."""
+        self.journal.log('add_replica', chunk_id, server)
+        self.chunk_locations.setdefault(chunk_id, []).append(server)
+        self.chunk_servers_info.setdefault(server, set()).add(chunk_id)  # Replayed replicas may precede registration
+        size = self.chunk_sizes.get(chunk_id, 0)
+        self.server_usage[server] = self.server_usage.get(server, 0) + size
+        self.replica_bytes += size
+
+    def remove_replica(self, chunk_id, server):
+        """Forget the replica of chunk_id on server and release its bytes."""
+        if server in self.chunk_locations.get(chunk_id, []):
+            self.journal.log('remove_replica', chunk_id, server)
+            self.chunk_locations[chunk_id].remove(server)
+            self.chunk_servers_info[server].discard(chunk_id)
+            size = self.chunk_sizes.get(chunk_id, 0)
+            self.server_usage[server] -= size
+            self.replica_bytes -= size
+
+    def resize_chunk(self, chunk_id, size):
+        """Set the accounted length of chunk_id, adjusting the usage of every replica."""
+        with self.placement_lock.write():
+            self.journal.log('resize_chunk', chunk_id, size)
+            delta = size - self.chunk_sizes.get(chunk_id, 0)
+            self.chunk_sizes[chunk_id] = size
+            for server in self.chunk_locations.get(chunk_id, []):
+                self.server_usage[server] += delta
+                self.replica_bytes += delta
+            self.chunk_primaries.pop(chunk_id, None)  # Sealed chunks take no more appends
+
+    def create_file(self, filename, chunk_ids, info):
+        """Publish a new file made of chunk_ids; the caller holds namespace_lock for writing."""
+        self.journal.log('create_file', filename, chunk_ids, info)
+        self.file_map[filename] = list(chunk_ids)
+        self.namespace.add(filename)
+        self.file_info[filename] = dict(info)
+        self.logical_bytes += info['size']
+
+    def append_file_chunk(self, filename, chunk_id, grown, mtime):
+        """Add a new last chunk to a record-append file, which grew by grown bytes when its previous last chunk was sealed."""
+        self.journal.log('append_file_chunk', filename, chunk_id, grown, mtime)
+        self.file_map[filename].append(chunk_id)
+        self.file_info[filename]['size'] += grown
+        self.file_info[filename]['mtime'] = mtime
+        self.logical_bytes += grown
+
+    def update_file(self, filename, fields):
+        """Update fields of a file's info, such as its access time or erasure-coded layout."""
+        self.journal.log('update_file', filename, fields)
+        self.file_info[filename].update(fields)
+
+    def hide_file(self, filename, deleted):
+        """Move a deleted file out of the namespace to a hidden name, which is returned (namespace_lock held for writing)."""
+        self.journal.log('hide_file', filename, deleted)
+        self.deletions += 1
+        hidden = f"{DELETED_PREFIX}{self.deletions}/{filename}"
+        self.file_map[hidden] = self.file_map.pop(filename)
+        self.file_info[hidden] = dict(self.file_info.pop(filename), deleted=deleted)
+        self.namespace.remove(filename)
+        self.logical_bytes -= self.file_info[hidden]['size']
+        return hidden
+
+    def copy_file(self, src, dst, mtime):
+        """Publish dst as a snapshot of src sharing its chunks; namespace_lock and placement_lock are held for writing."""
+        self.journal.log('copy_file', src, dst, mtime)
+        self.snapshots += 1
+        chunk_ids = set(self.file_map[src])  # References are counted per file, as in remove_files
+        for chunk_id in list(chunk_ids):
+            chunk_ids.update(self.chunk_stripes.get(chunk_id, ()))
+        for chunk_id in chunk_ids:
+            self.chunk_refs[chunk_id] = self.chunk_refs.get(chunk_id, 1) + 1
+        info = dict(self.file_info[src], mtime=mtime, atime=mtime, generation=self.deletions)
+        info.pop('deleted', None)
+        self.file_map[dst] = list(self.file_map[src])
+        self.file_info[dst] = info
+        self.namespace.add(dst)
+        self.logical_bytes += info['size']
+
+    def replace_chunk(self, filename, chunk_id, copy_id):
+        """Make copy_id, which takes over the version of chunk_id, the last chunk of filename instead of the shared chunk_id."""
+        self.journal.log('replace_chunk', filename, chunk_id, copy_id)
+        self.file_map[filename][-1] = copy_id
+        if chunk_id in self.chunk_versions:
+            self.chunk_versions[copy_id] = self.chunk_versions[chunk_id]
+        self.chunk_refs[chunk_id] -= 1
+        if self.chunk_refs[chunk_id] <= 0:  # The other files were reclaimed while the chunk was copied
+            self.drop_chunks({chunk_id})
+
+    def remove_files(self, filenames):
+        """Forget hidden files for good, dropping the chunks no other file references; returns the number dropped.
+
+        Both namespace_lock and placement_lock must be held for writing. The chunk files stay on
+        the chunk servers until garbage collection finds them missing from the metadata.
+        """
+        self.journal.log('remove_files', filenames)
+        dropped = set()
+        for filename in filenames:
+            chunk_ids = set(self.file_map.pop(filename))  # A file references a repeated chunk once
+            del self.file_info[filename]
+            for chunk_id in list(chunk_ids):
+                chunk_ids.update(self.chunk_stripes.get(chunk_id, ()))  # Parity belongs to the file too
+            for chunk_id in chunk_ids:
+                refs = self.chunk_refs.get(chunk_id, 1) - 1
+                self.chunk_refs[chunk_id] = refs
+                if refs <= 0:
+                    dropped.add(chunk_id)
+        self.drop_chunks(dropped)
+        return len(dropped)
+
+    def drop_chunks(self, dropped):
+        """Forget the chunks in the set dropped, which no file references any more (not journaled itself)."""
+        for chunk_id in dropped:
+            size = self.chunk_sizes.pop(chunk_id, 0)
+            for server in self.chunk_locations.pop(chunk_id, []):
+                self.chunk_servers_info[server].discard(chunk_id)
+                self.server_usage[server] -= size
+                self.replica_bytes -= size
+            del self.chunk_refs[chunk_id]
+            self.chunk_stripes.pop(chunk_id, None)
+            self.chunk_primaries.pop(chunk_id, None)
+            self.chunk_versions.pop(chunk_id, None)
+            checksum = self.chunk_checksums.pop(chunk_id, None)
+            if checksum is not None and self.chunk_hashes.get(checksum) == chunk_id:
+                del self.chunk_hashes[checksum]
+
+    def restore_lease(self, filename, lease):
+        """Replay a journaled lease grant, renewal or release (lease None)."""
+        self.lease_manager.restore(filename, lease)
+
+    def server_capacity(self, server):
+        """Return the capacity a server last reported, or 1 so unreported servers compare by bytes alone."""
+        return self.servers.get(server, {}).get('capacity') or 1
+
+    def select_chunk_servers(self, replication_factor, exclude=()):
+        """Select the active servers with the lowest byte utilization (chunk count breaks ties)."""
+        available_servers = sorted((s for s in self.active_servers if s not in exclude),
+                                   key=lambda s: (self.server_usage[s] / self.server_capacity(s), len(self.chunk_servers_info[s])))
+        selected_servers = available_servers[:replication_factor]
 
         if len(selected_servers) < replication_factor:
             logging.warning("Not enough active servers for full replication.")
         
         return selected_servers
 
-    def update_server_status(self, port):
-        """Update active server list based on heartbeat signals."""
-        if port not in self.active_servers:
-            self.active_servers.add(port)
-            logging.info("Server on port %d is now active", port)
+    def update_server_status(self, host, port, used_bytes=None, capacity=None, tags=(), active_requests=0):
+        """Register a chunk server on its first heartbeat and refresh its liveness and usage report."""
+        server = f"{host}:{port}"
+        report = {'used_bytes': used_bytes, 'capacity': capacity, 'tags': list(tags), 'active_requests': active_requests,
+                  'last_seen': time.time()}
+        info = self.servers.get(server)
+        if info is not None and server in self.active_servers:
+            self.servers[server] = dict(info, **report)  # Entries are replaced whole, never mutated
+            return server
+        with self.placement_lock.write():
+            if server not in self.servers:
+                self.chunk_servers_info.setdefault(server, set())
+                self.server_usage.setdefault(server, 0)
+                logging.info("Registered chunk server %s (tags %s)", server, report['tags'])
+            self.servers[server] = {'host': host, 'port': port, 'registered': info['registered'] if info else time.time(), **report}
+            self.active_servers.add(server)
+        logging.info("Chunk server %s is now active", server)
+        return server
+
+    def list_servers(self):
+        """Return the membership table with each server's liveness and placed bytes."""
+        with self.placement_lock.read():
+            servers = {server: dict(info, active=server in self.active_servers, placed_bytes=self.server_usage[server],
+                                    chunks=len(self.chunk_servers_info[server]))
+                       for server, info in self.servers.items()}
+        return {'status': 'success', 'servers': servers}
 
     def heartbeat(self):
-        """Check active status of all chunk servers periodically."""
+        """Declare chunk servers failed once their last heartbeat is older than SERVER_TIMEOUT."""
         logging.info("Heartbeat check initiated.")
         while True:
             time.sleep(HEARTBEAT_INTERVAL)
-            inactive_servers = set(CHUNK_PORTS) - self.active_servers
-            for port in inactive_servers:
-                self.handle_server_failure(port)
-            self.active_servers.clear()  # Reset active status for next interval
-
-    def handle_server_failure(self, port):
-        """Handle chunk server failure by reallocating chunks."""
-        logging.warning("Chunk server on port %d has failed", port)
-        if port in self.chunk_servers_info:
-            for chunk_id in self.chunk_servers_info[port]:
+            deadline = time.time() - SERVER_TIMEOUT
+            with self.placement_lock.write():
+                for server in [s for s in self.active_servers if self.servers[s]['last_seen'] < deadline]:
+                    self.active_servers.discard(server)
+                    self.handle_server_failure(server)
+            self.journal.sync()
+
+    def handle_server_failure(self, server):
+        """Handle chunk server failure by reallocating chunks (placement_lock held for writing)."""
+        logging.warning("Chunk server %s has failed", server)
+        if server in self.chunk_servers_info:
+            for chunk_id in list(self.chunk_servers_info[server]):
                 # Reallocate the failed chunk to another active server
-                self.reallocate_chunk(chunk_id, port)
+                self.reallocate_chunk(chunk_id, server)
 
             # Clear failed server's data
-            self.chunk_servers_info[port] = []
+            self.chunk_servers_info[server] = set()
 
     def reallocate_chunk(self, chunk_id, failed_server):
-        """Reallocate chunk replicas when a server goes down."""
-        # Remove the failed server from chunk locations
+        """Drop the replica of chunk_id on a failed server (placement_lock held for writing).
+
+        No replacement is recorded here: check_replication_integrity has a surviving replica
+        copy the chunk to another server first, so only replicas that hold the data count.
+        """
         if chunk_id in self.chunk_locations:
-            self.chunk_locations[chunk_id] = [s for s in self.chunk_locations[chunk_id] if s != failed_server]
-            
-            # Add a new replica if replication factor is not met
-            if len(self.chunk_locations[chunk_id]) < REPLICATION_FACTOR:
-                new_server = self.select_chunk_servers(1)[0]
-                self.chunk_locations[chunk_id].append(new_server)
-                self.chunk_servers_info[new_server].append(chunk_id)
-                logging.info("Reallocated chunk %s to server on port %d", chunk_id, new_server)
+            self.remove_replica(chunk_id, failed_server)
+
+    def re_replicate(self, chunk_id):
+        """Copy an under-replicated chunk from a surviving replica to a new server; returns whether a replica was added.
+
+        The new replica is recorded only once the target stored the copy. A chunk taking record
+        appends has its primary lease revoked first, and the copy is discarded if a new lease was
+        granted meanwhile, since appends under it may be missing from the copy.
+        """
+        with self.placement_lock.write():
+            servers = self.chunk_locations.get(chunk_id)
+            if servers is None or len(servers) >= self.replication_target(chunk_id):
+                return False  # Dropped or repaired since the scan
+            log_sampled(logging.WARNING, 'chunk_under_replicated', chunk_id=chunk_id, replicas=','.join(servers))
+            exclude = list(servers)
+            for member in self.chunk_stripes.get(chunk_id, ()):
+                exclude += self.chunk_locations.get(member, [])
+            targets = self.select_chunk_servers(1, exclude=exclude)
+            if not targets:
+                logging.warning("No available servers to reallocate chunk %s", chunk_id)
+                return False
+            target = targets[0]
+            if not self.chunk_sizes.get(chunk_id) and chunk_id not in self.chunk_versions:
+                self.add_replica(chunk_id, target)  # Allocated empty and never written: there is nothing to copy
+                return True
+            sources = [server for server in servers if server in self.active_servers]
+            if not sources:
+                log_sampled(logging.WARNING, 'chunk_without_replicas', chunk_id=chunk_id)
+                return False
+            leased = self.chunk_primaries.get(chunk_id, {}).get('expires', 0) > time.time()
+        if leased:
+            self.revoke_primary(chunk_id)
+        with self.placement_lock.read():
+            version = self.chunk_versions.get(chunk_id, 0)
+        response = self.request_replication(chunk_id, sources[0], target)
+        if response.get('status') != 'success':
+            logging.warning("Failed to copy chunk %s from server %s to %s: %s", chunk_id, sources[0], target,
+                            response.get('message'))
+            return False
+        with self.placement_lock.write():
+            servers = self.chunk_locations.get(chunk_id)
+            stray = servers is None or target not in servers
+            added = stray and servers is not None and len(servers) < self.replication_target(chunk_id) \
+                and self.chunk_versions.get(chunk_id, 0) == version
+            if added:
+                self.add_replica(chunk_id, target)
+        if not added:
+            if stray:  # Dropped, repaired or appended to during the copy: nothing references the copy
+                self.delete_chunks({target: [(chunk_owner(chunk_id), chunk_id)]})
+            return False
+        log_sampled(logging.INFO, 'chunk_reallocated', chunk_id=chunk_id, server=target)
+        return True
 
     def check_replication_integrity(self):
-        """Periodically verify that each chunk has the correct replication level."""
+        """Periodically verify that each chunk has the correct replication level and copy the missing replicas."""
         while True:
             time.sleep(HEARTBEAT_INTERVAL * 3)
-            for chunk_id, servers in self.chunk_locations.items():
-                if len(servers) < REPLICATION_FACTOR:
-                    logging.warning("Chunk %s under-replicated, current replicas: %s", chunk_id, servers)
-                    self.reallocate_chunk(chunk_id, None)
+            try:
+                with self.placement_lock.read():
+                    under_replicated = [chunk_id for chunk_id, servers in self.chunk_locations.items()
+                                        if len(servers) < self.replication_target(chunk_id)]
+                self.under_replicated = len(under_replicated)
+                with self.data_movement_lock:  # Garbage collection must not take the copies for orphans
+                    for chunk_id in under_replicated:
+                        self.re_replicate(chunk_id)
+                self.journal.sync()
+            except Exception as e:
+                logging.error("Replication check failed: %s", e)
 
-    def listen_to_chunk_server(self, client, address, filename, chunk_no, recv_port):
+    def listen_to_chunk_server(self, client, address, filename, chunk_no, recv_server):
         """Handle requests from chunk servers for chunk locations."""
         chunk_no = int(chunk_no)
-        servers = self.chunk_locations.get(f"{filename}_chunk_{chunk_no}", [])
+        with self.placement_lock.read():
+            servers = list(self.chunk_locations.get(f"{filename}_chunk_{chunk_no}", []))
         for server in servers:
-            if server != int(recv_port):
+            if server != recv_server:
                 client.send(pickle.dumps(server))
                 return
         client.send(pickle.dumps(None))
 
 
+def build_checkpoint(directory, number):
+    """Write checkpoint number from the previous checkpoint and the journal segments below number.
+
+    Runs in a child process of the master, so its memory and CPU time are not the master's.
+    """
+    master = MasterServer('localhost', 0, metadata_dir='')
+    master.load_metadata(directory, until=number)
+    journal.write_checkpoint(directory, number, master.checkpoint_state())
+
+
 if __name__ == "__main__":
-    master = MasterServer('localhost', 7082)
-    logging.info("Master Server Running on port 7082")
+    # Usage: python master_server.py [port]
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 7082
+    master = MasterServer('localhost', port)
+    logging.info("Master Server Running on port %d", port)
     master.start()
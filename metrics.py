@@ -0,0 +1,236 @@
+import bisect
+import logging
+import threading
+import weakref
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency buckets in seconds, from sub-millisecond RPCs to multi-second uploads
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class _Shard:
+    """One thread's private metric values; folded into the registry when the thread exits."""
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.values = {}  # Metric key -> number (counters) or [bucket counts..., sum] (histograms)
+
+    def __del__(self):
+        self.registry._retire(self)
+
+
+class Registry:
+    """Counters, histograms and gauges rendered in the Prometheus text format.
+
+    Every thread updates its own shard without taking a lock; the registry lock is only
+    taken when a thread records its first value, when it exits, and on scrape.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()  # Reentrant: a shard can be finalized while the lock is held
+        self._local = threading.local()
+        self._shards = weakref.WeakSet()
+        self._retired = {}  # Values of exited threads
+        self._families = {}  # Metric name -> family, in registration order
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _Shard(self)
+            with self._lock:
+                self._shards.add(shard)
+            return shard
+
+    def _retire(self, shard):
+        with self._lock:
+            _merge(self._retired, shard.values)
+            shard.values = {}  # The weak reference may outlive this call; don't count the values twice
+
+    def _snapshot(self):
+        with self._lock:
+            totals = {}
+            _merge(totals, self._retired)
+            for shard in list(self._shards):
+                _merge(totals, dict(shard.values))
+        return totals
+
+    def _register(self, family):
+        with self._lock:
+            if family.name in self._families:
+                raise ValueError(f"Metric {family.name} is already registered")
+            self._families[family.name] = family
+        return family
+
+    def counter(self, name, help, labelnames=()):
+        """Register a monotonically increasing counter."""
+        return self._register(_Family(self, name, help, 'counter', labelnames, Counter))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        """Register a histogram with fixed upper bounds (an implicit +Inf bucket is added)."""
+        return self._register(_Family(self, name, help, 'histogram', labelnames, Histogram, tuple(sorted(buckets))))
+
+    def gauge(self, name, help, read, labelnames=()):
+        """Register a gauge computed at scrape time by read().
+
+        read returns a number, or with labelnames a dict of label value tuples to numbers.
+        """
+        family = _Family(self, name, help, 'gauge', labelnames, None)
+        family.read = read
+        return self._register(family)
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        totals = self._snapshot()
+        lines = []
+        for family in list(self._families.values()):
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.type}")
+            if family.type == 'gauge':
+                try:
+                    values = family.read()
+                except Exception as e:
+                    logging.warning("Failed to read gauge %s: %s", family.name, e)
+                    continue
+                if not family.labelnames:
+                    values = {(): values}
+                for labelvalues, value in values.items():
+                    lines.append(f"{family.name}{_labels(family.labelnames, labelvalues)} {_number(value)}")
+                continue
+            for labelvalues, metric in list(family.children.items()):
+                value = totals.get(metric.key)
+                if family.type == 'counter':
+                    lines.append(f"{family.name}{_labels(family.labelnames, labelvalues)} {_number(value or 0)}")
+                    continue
+                counts = value or [0] * (len(family.buckets) + 2)
+                cumulative = 0
+                for bound, count in zip(family.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    le = _labels(family.labelnames + ('le',), labelvalues + (_number(bound),))
+                    lines.append(f"{family.name}_bucket{le} {cumulative}")
+                labels = _labels(family.labelnames, labelvalues)
+                lines.append(f"{family.name}_sum{labels} {_number(counts[-1])}")
+                lines.append(f"{family.name}_count{labels} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+
+class _Family:
+    """A metric name with its labelled children."""
+
+    def __init__(self, registry, name, help, type, labelnames, child_class, buckets=None):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labelnames = tuple(labelnames)
+        self.child_class = child_class
+        self.buckets = buckets  # Histogram upper bounds
+        self.children = {}
+        if child_class is not None and not self.labelnames:
+            self._default = self.labels()
+
+    def labels(self, *labelvalues):
+        """Return the child metric for these label values, creating it on first use."""
+        child = self.children.get(labelvalues)
+        if child is None:
+            if len(labelvalues) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            child = self.children.setdefault(labelvalues, self.child_class(self, labelvalues))
+        return child
+
+    def inc(self, amount=1):
+        """Increment an unlabelled counter."""
+        self._default.inc(amount)
+
+    def observe(self, value):
+        """Observe a value on an unlabelled histogram."""
+        self._default.observe(value)
+
+
+class Counter:
+    """One labelled child of a counter family."""
+
+    def __init__(self, family, labelvalues):
+        self.registry = family.registry
+        self.key = (family.name, labelvalues)
+
+    def inc(self, amount=1):
+        """Add amount to the counter."""
+        values = self.registry._shard().values
+        values[self.key] = values.get(self.key, 0) + amount
+
+
+class Histogram:
+    """One labelled child of a histogram family."""
+
+    def __init__(self, family, labelvalues):
+        self.registry = family.registry
+        self.key = (family.name, labelvalues)
+        self.buckets = family.buckets
+
+    def observe(self, value):
+        """Count value in its bucket and add it to the sum."""
+        values = self.registry._shard().values
+        cells = values.get(self.key)
+        if cells is None:
+            cells = values[self.key] = [0] * (len(self.buckets) + 2)
+        cells[bisect.bisect_left(self.buckets, value)] += 1
+        cells[-1] += value
+
+
+def _merge(totals, values):
+    """Add shard values into totals; histogram cells are copied, never shared."""
+    for key, value in values.items():
+        if isinstance(value, list):
+            current = totals.get(key)
+            totals[key] = list(value) if current is None else [a + b for a, b in zip(current, value)]
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+
+def _number(value):
+    """Format a sample value or bucket bound the way the exposition format expects."""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+def _labels(names, values):
+    """Render a label set such as {command="upload"}."""
+    if not names:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+REGISTRY = Registry()  # The process-wide registry served by start_http_server
+
+
+def start_http_server(port, host='', registry=REGISTRY):
+    """Serve registry.render() at /metrics on a daemon thread; returns the server, or None if it cannot bind."""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes would otherwise print a line each
+
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        logging.error("Cannot serve metrics on port %d: %s", port, e)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info("Serving metrics on port %d", server.server_address[1])
+    return server
@@ -0,0 +1,211 @@
+import io
+import os
+import sys
+import time
+import pickle
+import socket
+import pstats
+import cProfile
+import logging
+import argparse
+import threading
+import traceback
+from collections import Counter
+
+PROFILE_DIR = os.environ.get('GFS_PROFILE_DIR', '.')  # Where finished profiles are written
+PROFILE_SAMPLE_INTERVAL = 0.005  # Seconds between stack samples of the sampling profiler
+PROFILE_MAX_SECONDS = 600  # Longest profiling window; a forgotten profile stops by itself
+PROFILE_TOP = 25  # Functions listed in the summary returned when a profile stops
+
+
+class Profiler:
+    """A profile of this process that admins start and stop at runtime.
+
+    mode 'cprofile' runs every request handler under its own cProfile.Profile and merges
+    the results, so the stats cover request work only; they are dumped in pstats format.
+    mode 'sampling' records the stacks of all threads every PROFILE_SAMPLE_INTERVAL from
+    a background thread, costing the handlers nothing; the samples are dumped in the
+    folded format flame graph tools read. Samples are wall-clock: blocked threads count too.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mode = None  # 'cprofile' or 'sampling' while a profile runs
+        self.started = None
+        self.stats = None  # pstats.Stats merged from the handlers' profiles
+        self.samples = Counter()  # Folded stack -> samples
+        self.stopped = threading.Event()
+        self.timer = None
+        self.last = None  # Response of the most recently stopped profile
+
+    def start(self, mode='sampling', seconds=60):
+        """Start profiling for at most seconds; returns a response dict."""
+        if mode not in ('cprofile', 'sampling'):
+            return {'status': 'error', 'message': f'Unknown profiling mode {mode}'}
+        seconds = min(float(seconds), PROFILE_MAX_SECONDS)
+        with self.lock:
+            if self.mode is not None:
+                return {'status': 'error', 'message': f'A {self.mode} profile is already running'}
+            self.mode, self.started = mode, time.time()
+            self.stats, self.samples = None, Counter()
+            self.stopped.clear()
+            if mode == 'sampling':
+                threading.Thread(target=self.sample, name='profiler', daemon=True).start()
+            self.timer = threading.Timer(seconds, self.stop)
+            self.timer.daemon = True
+            self.timer.start()
+        logging.info("Started %s profile for up to %.0f seconds", mode, seconds)
+        return {'status': 'success', 'mode': mode, 'seconds': seconds}
+
+    def stop(self):
+        """Stop profiling, write the profile to PROFILE_DIR and return its path and a summary."""
+        with self.lock:
+            if self.mode is None:
+                return {'status': 'error', 'message': 'No profile is running'}
+            mode, self.mode = self.mode, None
+            self.timer.cancel()
+            self.stopped.set()
+            stats, samples = self.stats, self.samples
+        seconds = time.time() - self.started
+        name = f"profile-{os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0]}-{os.getpid()}-{int(self.started)}"
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        if mode == 'cprofile':
+            path = os.path.join(PROFILE_DIR, name + '.prof')
+            summary = io.StringIO()
+            if stats is None:
+                summary.write("No requests were handled while profiling\n")
+                open(path, 'wb').close()
+            else:
+                stats.dump_stats(path)
+                stats.stream = summary
+                stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+            summary = summary.getvalue()
+        else:
+            path = os.path.join(PROFILE_DIR, name + '.folded')
+            with open(path, 'w') as f:
+                f.writelines(f"{stack} {count}\n" for stack, count in samples.most_common())
+            summary = summarize_samples(samples)
+        logging.info("Stopped %s profile after %.1f seconds, written to %s", mode, seconds, path)
+        self.last = {'status': 'success', 'mode': mode, 'seconds': round(seconds, 3), 'path': os.path.abspath(path),
+                     'summary': summary}
+        return self.last
+
+    def status(self):
+        """Report the running profile, if any, and the last finished one."""
+        with self.lock:
+            running = {'mode': self.mode, 'elapsed': round(time.time() - self.started, 3)} if self.mode else None
+        return {'status': 'success', 'running': running, 'last': self.last}
+
+    def begin(self):
+        """Profile the calling request handler if a cprofile profile runs; returns the token for end()."""
+        if self.mode != 'cprofile':
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:  # Another profiler is active in this thread
+            return None
+        return profile
+
+    def end(self, profile):
+        """Stop a handler's profile from begin() and merge it into the running profile."""
+        if profile is None:
+            return
+        profile.disable()
+        with self.lock:
+            if self.mode != 'cprofile':
+                return  # Stopped while the handler ran
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+
+    def sample(self):
+        """Fold the stack of every other thread into self.samples until the profile stops."""
+        me = threading.get_ident()
+        while not self.stopped.wait(PROFILE_SAMPLE_INTERVAL):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)).split('-')[0])  # Pool threads share a root
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def handle(self, request):
+        """Serve a 'profile' admin request: action start (mode, seconds), stop or status."""
+        action = request.get('action', 'status')
+        if action == 'start':
+            return self.start(request.get('mode', 'sampling'), request.get('seconds', 60))
+        if action == 'stop':
+            return self.stop()
+        if action == 'status':
+            return self.status()
+        return {'status': 'error', 'message': f'Unknown profile action {action}'}
+
+
+def summarize_samples(samples, top=PROFILE_TOP):
+    """List the functions seen most often in folded stacks, by own and by inclusive samples."""
+    total = sum(samples.values()) or 1
+    own, inclusive = Counter(), Counter()
+    for stack, count in samples.items():
+        frames = stack.split(';')[1:]
+        if frames:
+            own[frames[-1]] += count
+        for frame in set(frames):
+            inclusive[frame] += count
+    lines = [f"{total} samples", f"{'own':>7} {'incl':>7}  function"]
+    for frame, count in own.most_common(top):
+        lines.append(f"{count / total:7.1%} {inclusive[frame] / total:7.1%}  {frame}")
+    return '\n'.join(lines) + '\n'
+
+
+def thread_stacks():
+    """Snapshot every thread of this process: the thread count and each thread's current stack."""
+    frames = sys._current_frames()
+    threads = {}
+    for thread in threading.enumerate():
+        frame = frames.get(thread.ident)
+        stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+        threads[f"{thread.name} ({thread.ident})"] = {'daemon': thread.daemon, 'stack': stack}
+    return {'status': 'success', 'threads': len(threads), 'stacks': threads}
+
+
+PROFILER = Profiler()  # The process-wide profiler driven by the 'profile' admin command
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile a running master or chunk server, or dump its thread stacks.")
+    parser.add_argument('server', help="host:port of the master or chunk server")
+    parser.add_argument('action', choices=['start', 'stop', 'status', 'stacks'])
+    parser.add_argument('--mode', choices=['sampling', 'cprofile'], default='sampling')
+    parser.add_argument('--seconds', type=float, default=60, help="stop automatically after this long")
+    args = parser.parse_args()
+    if args.action == 'stacks':
+        request = {'command': 'stacks'}
+    else:
+        request = {'command': 'profile', 'action': args.action, 'mode': args.mode, 'seconds': args.seconds}
+    host, port = args.server.rsplit(':', 1)
+    with socket.create_connection((host, int(port))) as s:
+        s.sendall(pickle.dumps(request))
+        response = pickle.load(s.makefile('rb'))
+    if response.get('status') != 'success':
+        sys.exit(f"Error: {response.get('message')}")
+    if args.action == 'stacks':
+        print(f"{response['threads']} threads")
+        for name, thread in response['stacks'].items():
+            print(f"\n{name}{' daemon' if thread['daemon'] else ''}\n{thread['stack']}", end='')
+    elif args.action == 'stop':
+        print(f"{response['mode']} profile of {response['seconds']} s written to {response['path']}\n")
+        print(response['summary'], end='')
+    elif args.action == 'start':
+        print(f"Started {response['mode']} profile for up to {response['seconds']:.0f} s")
+    else:
+        running, last = response['running'], response['last']
+        print(f"Running: {running['mode']} for {running['elapsed']:.0f} s" if running else "No profile running")
+        if last:
+            print(f"Last: {last['mode']} profile of {last['seconds']} s at {last['path']}")
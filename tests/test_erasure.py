@@ -0,0 +1,59 @@
+import itertools
+import random
+
+import pytest
+
+import erasure
+
+
+def shards(k, length, seed=0):
+    rng = random.Random(seed)
+    return [bytes(rng.randrange(256) for _ in range(length)) for _ in range(k)]
+
+
+def test_field_inverse():
+    for a in range(1, 256):
+        assert erasure.gf_mul(a, erasure.gf_inv(a)) == 1
+
+
+@pytest.mark.parametrize('k, m', [(3, 1), (4, 2), (6, 3)])
+def test_decode_any_m_lost(k, m):
+    data = shards(k, 64)
+    parity = erasure.encode(data, m, vectorized=False)
+    assert len(parity) == m and all(len(shard) == 64 for shard in parity)
+    for lost in itertools.combinations(range(k + m), m):
+        degraded = [None if i in lost else shard for i, shard in enumerate(data + parity)]
+        assert erasure.decode(degraded, k, m, vectorized=False) == data
+
+
+def test_decode_too_many_lost():
+    data = shards(4, 16)
+    degraded = [None, None, None] + data[3:] + erasure.encode(data, 2, vectorized=False)
+    with pytest.raises(ValueError):
+        erasure.decode(degraded, 4, 2, vectorized=False)
+
+
+def test_encode_unequal_shards():
+    with pytest.raises(ValueError):
+        erasure.encode([b'ab', b'abc'], 1, vectorized=False)
+
+
+def test_encode_stripes_matches_per_stripe_encode():
+    stripes = [shards(3, 40, seed=1), shards(3, 40, seed=2)[:2], [b'short', b'longer shard']]
+    for stripe, parity in zip(stripes, erasure.encode_stripes(stripes, 3, 2, vectorized=False)):
+        width = max(len(shard) for shard in stripe)
+        padded = [shard.ljust(width, b'\0') for shard in stripe] + [bytes(width)] * (3 - len(stripe))
+        assert parity == erasure.encode(padded, 2, vectorized=False)
+
+
+@pytest.mark.parametrize('k, m', [(3, 1), (4, 2), (6, 3)])
+def test_recover_chunks_of_short_last_stripe(k, m):
+    chunks = [b'x' * 100, b'y' * 37][:k - 1]  # Fewer and shorter chunks than a full stripe
+    parity = erasure.parity_chunks([chunks], k, m, vectorized=False)[0]
+    lost = [None] + chunks[1:]
+    assert erasure.recover_chunks(lost, [None] * (m - 1) + parity[m - 1:], k, m, vectorized=False) == chunks
+
+
+def test_recover_chunks_without_parity():
+    with pytest.raises(ValueError):
+        erasure.recover_chunks([None, b'a'], [None], 3, 1, vectorized=False)
@@ -0,0 +1,103 @@
+import os
+import threading
+
+import journal
+
+
+def records(directory, segment):
+    return list(journal.read_segment(journal.segment_path(directory, segment)))
+
+
+def test_sync_writes_logged_records(tmp_path):
+    log = journal.Journal(str(tmp_path), 1)
+    log.log('add', 'a', 1)
+    log.log('remove', 'b')
+    assert log.unsynced()
+    log.sync()
+    assert not log.unsynced()
+    assert records(str(tmp_path), 1) == [('add', ('a', 1)), ('remove', ('b',))]
+
+
+def test_sync_without_records_writes_nothing(tmp_path):
+    log = journal.Journal(str(tmp_path), 1)
+    log.sync()
+    assert os.path.getsize(journal.segment_path(str(tmp_path), 1)) == 0
+
+
+def test_concurrent_syncs_keep_every_record(tmp_path):
+    log = journal.Journal(str(tmp_path), 1)
+
+    def mutate(n):
+        for i in range(50):
+            log.log('op', n, i)
+            log.sync()
+
+    threads = [threading.Thread(target=mutate, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    replayed = records(str(tmp_path), 1)
+    assert sorted(args for _, args in replayed) == [(n, i) for n in range(8) for i in range(50)]
+    for n in range(8):  # Each thread's records are replayed in the order it logged them
+        assert [i for _, (m, i) in replayed if m == n] == list(range(50))
+
+
+def test_replay_stops_at_torn_frame(tmp_path):
+    log = journal.Journal(str(tmp_path), 1)
+    log.log('op', 1)
+    log.sync()
+    log.log('op', 2)
+    log.sync()
+    path = journal.segment_path(str(tmp_path), 1)
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 1)
+    assert records(str(tmp_path), 1) == [('op', (1,))]
+
+
+def test_replay_stops_at_crc_mismatch(tmp_path):
+    log = journal.Journal(str(tmp_path), 1)
+    for n in range(3):
+        log.log('op', n)
+        log.sync()
+    path = journal.segment_path(str(tmp_path), 1)
+    with open(path, 'rb') as f:
+        data = bytearray(f.read())
+    length, _ = journal.FRAME.unpack_from(data, 0)
+    data[journal.FRAME.size + length + journal.FRAME.size] ^= 0xff  # First payload byte of the second frame
+    with open(path, 'wb') as f:
+        f.write(data)
+    assert records(str(tmp_path), 1) == [('op', (0,))]
+
+
+def test_rotate_starts_next_segment(tmp_path):
+    log = journal.Journal(str(tmp_path), 1)
+    log.log('op', 1)
+    assert log.rotate() == 1
+    log.log('op', 2)
+    log.sync()
+    assert records(str(tmp_path), 1) == [('op', (1,))]
+    assert records(str(tmp_path), 2) == [('op', (2,))]
+    assert journal.numbered(str(tmp_path), journal.JOURNAL_PREFIX) == [1, 2]
+
+
+def test_checkpoint_prunes_superseded_files(tmp_path):
+    directory = str(tmp_path)
+    log = journal.Journal(directory, 1)
+    log.log('op', 1)
+    log.rotate()
+    journal.write_checkpoint(directory, 2, {'files': 1})
+    open(journal.checkpoint_path(directory, 3) + journal.TEMP_SUFFIX, 'wb').close()  # Cut short by a crash
+    assert journal.load_checkpoint(directory) == (2, {'files': 1})
+    journal.prune(directory, 2)
+    assert sorted(os.listdir(directory)) == [os.path.basename(journal.checkpoint_path(directory, 2)),
+                                            os.path.basename(journal.segment_path(directory, 2))]
+
+
+def test_load_checkpoint_skips_unreadable(tmp_path):
+    directory = str(tmp_path)
+    assert journal.load_checkpoint(directory) == (0, None)
+    journal.write_checkpoint(directory, 1, 'old')
+    with open(journal.checkpoint_path(directory, 2), 'wb') as f:
+        f.write(b'not a pickle')
+    assert journal.load_checkpoint(directory) == (1, 'old')
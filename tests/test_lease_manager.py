@@ -0,0 +1,64 @@
+import threading
+import time
+
+from master_server import LeaseManager
+
+
+def started(**kwargs):
+    manager = LeaseManager(**kwargs)
+    threading.Thread(target=manager.run, daemon=True).start()
+    return manager
+
+
+def test_grant_is_exclusive_until_released():
+    changes = []
+    manager = LeaseManager(on_change=lambda filename, lease: changes.append((filename, lease)))
+    lease = manager.grant('f', 'client1', 60)
+    assert lease['client'] == 'client1'
+    assert manager.grant('f', 'client2', 60) is None
+    assert manager.get('f')['lease_id'] == lease['lease_id']
+    assert manager.release('f')
+    assert not manager.release('f')
+    assert manager.grant('f', 'client2', 60) is not None
+    assert [filename for filename, _ in changes] == ['f', 'f', 'f']
+    assert changes[1][1] is None
+
+
+def test_renew_requires_the_lease_id():
+    manager = LeaseManager()
+    lease = manager.grant('f', 'client', 60)
+    assert manager.renew('f', 'someone else', 60) is None
+    assert manager.renew('g', lease['lease_id'], 60) is None
+    renewed = manager.renew('f', lease['lease_id'], 120)
+    assert renewed['expires'] > lease['expires']
+
+
+def test_leases_expire_on_time():
+    expired = []
+    done = threading.Event()
+    manager = started(on_expire=lambda filename: (expired.append(filename), done.set()))
+    manager.grant('f', 'client', 0.05)
+    manager.grant('g', 'client', 60)
+    assert done.wait(5)
+    assert expired == ['f']
+    assert manager.get('f') is None and manager.get('g') is not None
+    assert manager.grant('f', 'client', 60) is not None
+
+
+def test_renewed_lease_outlives_its_first_deadline():
+    expired = threading.Event()
+    manager = started(on_expire=lambda filename: expired.set())
+    lease = manager.grant('f', 'client', 0.1)
+    manager.renew('f', lease['lease_id'], 60)
+    assert not expired.wait(0.3)
+    assert manager.get('f') is not None
+
+
+def test_restore_skips_expired_leases():
+    manager = LeaseManager()
+    now = time.time()
+    manager.restore('live', {'expires': now + 60, 'client': 'c', 'lease_id': '1'})
+    manager.restore('stale', {'expires': now - 1, 'client': 'c', 'lease_id': '2'})
+    assert set(manager.snapshot()) == {'live'}
+    manager.restore('live', None)
+    assert manager.snapshot() == {}
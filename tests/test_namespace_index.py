@@ -0,0 +1,74 @@
+import random
+
+from master_server import NamespaceIndex
+
+
+def list_all(index, **kwargs):
+    """Page through a listing, returning all files and directories in order."""
+    files, dirs, cursor = [], [], None
+    while True:
+        page_files, page_dirs, cursor = index.list(cursor=cursor, **kwargs)
+        files += page_files
+        dirs += page_dirs
+        if cursor is None:
+            return files, dirs
+
+
+def test_add_remove_contains():
+    index = NamespaceIndex()
+    assert index.add('b') and index.add('a')
+    assert not index.add('a')
+    assert 'a' in index and 'c' not in index
+    assert index.remove('a')
+    assert not index.remove('a')
+    assert len(index) == 1 and list(index.iter_from('')) == ['b']
+
+
+def test_stays_sorted_across_bucket_splits(monkeypatch):
+    monkeypatch.setattr(NamespaceIndex, 'BUCKET_SIZE', 4)
+    paths = [f'file{i:03d}' for i in range(200)]
+    shuffled = paths[:]
+    random.Random(0).shuffle(shuffled)
+    index = NamespaceIndex()
+    for path in shuffled:
+        index.add(path)
+    assert len(index.buckets) > 1
+    assert list(index.iter_from('')) == paths
+    for path in shuffled[:150]:
+        index.remove(path)
+    assert list(index.iter_from('')) == sorted(shuffled[150:])
+    assert index.maxes == [bucket[-1] for bucket in index.buckets]
+
+
+def test_bulk_build_matches_inserts(monkeypatch):
+    monkeypatch.setattr(NamespaceIndex, 'BUCKET_SIZE', 3)
+    paths = [f'p{i}' for i in range(20)]
+    assert list(NamespaceIndex(reversed(paths)).iter_from('')) == sorted(paths)
+
+
+def test_pages_cover_every_file_once(monkeypatch):
+    monkeypatch.setattr(NamespaceIndex, 'BUCKET_SIZE', 8)
+    paths = sorted(f'dir{i % 3}/file{i:03d}' for i in range(100))
+    index = NamespaceIndex(paths)
+    for limit in (1, 7, 100, 1000):
+        assert list_all(index, limit=limit) == (paths, [])
+    assert list_all(index, prefix='dir1/', limit=5) == ([path for path in paths if path.startswith('dir1/')], [])
+
+
+def test_delimiter_rolls_up_directories():
+    index = NamespaceIndex(['a', 'logs/2024/jan', 'logs/2024/feb', 'logs/2025/jan', 'logs/top', 'z'])
+    assert index.list(delimiter='/') == (['a', 'z'], ['logs/'], None)
+    assert index.list(prefix='logs/', delimiter='/') == (['logs/top'], ['logs/2024/', 'logs/2025/'], None)
+    for limit in (1, 2):
+        assert list_all(index, prefix='logs/', delimiter='/', limit=limit) == (['logs/top'], ['logs/2024/', 'logs/2025/'])
+
+
+def test_file_named_like_directory_is_not_skipped():
+    index = NamespaceIndex(['a/', 'a/b', 'a0'])
+    assert list_all(index, delimiter='/', limit=1) == (['a0'], ['a/'])
+    assert list_all(index, limit=1) == (['a/', 'a/b', 'a0'], [])
+
+
+def test_cursor_before_prefix_is_ignored():
+    index = NamespaceIndex(['a', 'b1', 'b2'])
+    assert index.list(prefix='b', cursor='fa') == (['b1', 'b2'], [], None)
@@ -0,0 +1,18 @@
+import os
+import sys
+import json
+import subprocess
+
+BENCH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench.py')
+STRESS_SECONDS = os.environ.get('GFS_STRESS_SECONDS', '40')  # A chunk server is down for half of it
+
+
+def test_concurrent_uploads_downloads_and_server_failure(tmp_path):
+    """Run bench.py's stress workload: no file may be lost or corrupt and the master's metadata must stay consistent."""
+    output = tmp_path / 'stress.json'
+    run = subprocess.run([sys.executable, BENCH, '--workloads', 'stress', '--stress-seconds', STRESS_SECONDS,
+                          '--output', str(output)], capture_output=True, text=True, timeout=float(STRESS_SECONDS) + 300)
+    assert run.returncode == 0, run.stderr[-2000:]
+    stress = json.loads(output.read_text())['results']['stress']
+    assert stress['files'] > 0
+    assert (stress['unreadable'], stress['corrupt'], stress['violations']) == (0, [], [])
@@ -0,0 +1,322 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import socket
+import argparse
+import functools
+import threading
+import metrics
+
+TRACE_EXPORT = os.environ.get('GFS_TRACE', '')  # '' disables tracing; a file path appends JSON lines; udp://host:port sends to a collector
+TRACE_SAMPLE_RATE = float(os.environ.get('GFS_TRACE_SAMPLE_RATE', 1))  # Fraction of client operations traced
+TRACE_QUEUE_SIZE = 10000  # Spans buffered for the exporter thread; further spans are dropped, never waited on
+COLLECTOR_PORT = 7090  # Default UDP port of the span collector
+WATERFALL_WIDTH = 50  # Characters in a waterfall bar
+WATERFALL_CHILDREN = 10  # Slowest children drawn per span; a chunk-by-chunk upload has thousands
+
+DROPPED = metrics.REGISTRY.counter('gfs_trace_spans_dropped_total', "Spans dropped because the export queue was full")
+
+_local = threading.local()  # The span the current thread is working in, as _local.span
+_exporter = None
+_exporter_lock = threading.Lock()
+_config = {'export': TRACE_EXPORT, 'sample_rate': TRACE_SAMPLE_RATE,
+           'service': os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0]}
+
+
+def configure(export=None, sample_rate=None, service=None):
+    """Override GFS_TRACE, GFS_TRACE_SAMPLE_RATE or the service name spans are recorded under.
+
+    Takes effect for spans started afterwards; the export target cannot change once a span was exported.
+    """
+    for key, value in (('export', export), ('sample_rate', sample_rate), ('service', service)):
+        if value is not None:
+            _config[key] = value
+
+
+class Span:
+    """A timed stage of a traced operation, exported as one JSON record when it finishes."""
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'attrs', 'start_time', 'started', 'previous')
+
+    def __init__(self, name, trace_id, parent_id, attrs):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.attrs = attrs
+
+    def start(self):
+        """Start the clock and make this the current thread's span; returns the span."""
+        self.previous = getattr(_local, 'span', None)
+        _local.span = self
+        self.start_time = time.time()
+        self.started = time.perf_counter()
+        return self
+
+    def finish(self):
+        """Stop the clock, restore the previous current span and export the record."""
+        duration = time.perf_counter() - self.started
+        _local.span = self.previous
+        export({'trace_id': self.trace_id, 'span_id': self.span_id, 'parent_id': self.parent_id, 'name': self.name,
+                'service': _config['service'], 'start': self.start_time, 'duration_ms': duration * 1000,
+                'attrs': self.attrs})
+
+    def set(self, **attrs):
+        """Add attributes to the span."""
+        self.attrs.update(attrs)
+
+    def context(self):
+        """The IDs a child span in another thread or process needs, as sent in request dicts."""
+        return {'trace_id': self.trace_id, 'span_id': self.span_id}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.attrs['error'] = repr(exc)
+        self.finish()
+
+
+class _NoopSpan:
+    """Stands in for a span when tracing is off or the operation is not sampled."""
+
+    def start(self):
+        return self
+
+    def finish(self):
+        pass
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+NOOP = _NoopSpan()
+
+
+def start_trace(name, **attrs):
+    """Begin a new trace whose root span is name; returns a no-op span when tracing is off or not sampled."""
+    if not _config['export'] or random.random() >= _config['sample_rate']:
+        return NOOP
+    return Span(name, os.urandom(16).hex(), None, attrs)
+
+
+def span(name, parent=None, **attrs):
+    """Return a child span of parent (a context from a request) or of the current thread's span.
+
+    Work outside any trace gets a no-op span, so untraced requests and background jobs cost nothing.
+    """
+    if not _config['export']:
+        return NOOP
+    if parent is None:
+        current = getattr(_local, 'span', None)
+        if current is None:
+            return NOOP
+        parent = current.context()
+    return Span(name, parent['trace_id'], parent['span_id'], attrs)
+
+
+def traced(name):
+    """Decorate an operation so each call records a span: the root of a new trace, or a child inside one."""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name) if getattr(_local, 'span', None) is not None else start_trace(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def annotate(**attrs):
+    """Add attributes to the current thread's span, if any."""
+    current = getattr(_local, 'span', None)
+    if current is not None:
+        current.set(**attrs)
+
+
+def inject(request):
+    """Add the current span's context to a request dict so the receiving server continues the trace."""
+    current = getattr(_local, 'span', None)
+    if current is not None:
+        request['trace'] = current.context()
+    return request
+
+
+def wrap(function):
+    """Bind function to the current span, so work handed to a thread pool stays in the trace."""
+    current = getattr(_local, 'span', None)
+    if current is None:
+        return function
+
+    def traced(*args, **kwargs):
+        previous = getattr(_local, 'span', None)
+        _local.span = current
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _local.span = previous
+    return traced
+
+
+class _Exporter:
+    """Write finished spans to a JSON lines file or a UDP collector from a background thread."""
+
+    def __init__(self, target):
+        self.target = target
+        self.spans = queue.Queue(TRACE_QUEUE_SIZE)
+        self.thread = threading.Thread(target=self.run, name='span-exporter', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)  # Flush what is still queued on exit
+
+    def run(self):
+        if self.target.startswith('udp://'):
+            host, port = self.target[len('udp://'):].rsplit(':', 1)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            write = lambda lines: [sock.sendto(line.encode(), (host, int(port))) for line in lines]
+        else:
+            # O_APPEND keeps the batches of processes sharing one file from overwriting each other
+            fd = os.open(self.target, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            write = lambda lines: os.write(fd, ''.join(lines).encode())
+        while True:
+            batch = [self.spans.get()]
+            while len(batch) < 1000:
+                try:
+                    batch.append(self.spans.get_nowait())
+                except queue.Empty:
+                    break
+            lines = [json.dumps(record, default=str) + '\n' for record in batch if record is not None]
+            try:
+                if lines:
+                    write(lines)
+            except OSError:
+                DROPPED.inc(len(lines))
+            for _ in batch:
+                self.spans.task_done()
+            if None in batch:
+                return
+
+    def export(self, record):
+        try:
+            self.spans.put_nowait(record)
+        except queue.Full:
+            DROPPED.inc()
+
+    def close(self):
+        try:
+            self.spans.put(None, timeout=1)
+        except queue.Full:
+            return
+        self.thread.join(timeout=5)
+
+
+def export(record):
+    """Queue a finished span record for the exporter, starting it on first use."""
+    global _exporter
+    if _exporter is None:
+        with _exporter_lock:
+            if _exporter is None:
+                _exporter = _Exporter(_config['export'])
+    _exporter.export(record)
+
+
+def flush():
+    """Wait until every span finished so far has been written out."""
+    if _exporter is not None:
+        _exporter.spans.join()
+
+
+def collect(port=COLLECTOR_PORT, output='spans.jsonl', host=''):
+    """Receive spans sent to udp://<host>:<port> and append them to output; a stand-in for a tracing backend."""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock, open(output, 'a') as f:
+        sock.bind((host, port))
+        print(f"Collecting spans on udp port {port} into {output}", file=sys.stderr)
+        while True:
+            data, _ = sock.recvfrom(65536)
+            f.write(data.decode().rstrip('\n') + '\n')
+            f.flush()
+
+
+def load_traces(path):
+    """Read a span file into {trace_id: [span records]}, skipping lines cut short by a crash."""
+    traces = {}
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            traces.setdefault(record['trace_id'], []).append(record)
+    return traces
+
+
+def waterfall(path, slowest=5, name=None, max_children=WATERFALL_CHILDREN, width=WATERFALL_WIDTH, out=sys.stdout):
+    """Print the span tree of the slowest traces in path as a timeline, one bar per span.
+
+    Only traces whose root span is called name are considered when name is given. Of the
+    children of a span only the max_children slowest are drawn; the rest are summed up.
+    """
+    roots = []
+    for trace_id, spans in load_traces(path).items():
+        root = next((s for s in spans if s['parent_id'] is None), None)
+        if root is not None and (name is None or root['name'] == name):
+            roots.append((root, spans))
+    roots.sort(key=lambda item: item[0]['duration_ms'], reverse=True)
+
+    for root, spans in roots[:slowest]:
+        children = {}
+        ids = {s['span_id'] for s in spans}
+        for s in spans:
+            if s is not root:
+                # Spans whose parent was dropped or never exported hang off the root
+                parent = s['parent_id'] if s['parent_id'] in ids else root['span_id']
+                children.setdefault(parent, []).append(s)
+        total = max(root['duration_ms'], 1e-6)
+        print(f"trace {root['trace_id']} {root['name']} {root['duration_ms']:.1f} ms, {len(spans)} spans", file=out)
+
+        def show(s, depth):
+            offset = (s['start'] - root['start']) * 1000
+            begin = min(width - 1, int(offset / total * width))
+            length = max(1, int(s['duration_ms'] / total * width))
+            bar = ' ' * begin + '=' * min(length, width - begin)
+            attrs = ' '.join(f'{key}={value}' for key, value in s['attrs'].items())
+            print(f"  {offset:9.1f} {s['duration_ms']:9.1f} |{bar:<{width}}| {'  ' * depth}{s['name']} [{s['service']}] {attrs}".rstrip(),
+                  file=out)
+            shown = sorted(children.get(s['span_id'], ()), key=lambda c: c['duration_ms'], reverse=True)
+            shown, elided = shown[:max_children], shown[max_children:]
+            for child in sorted(shown, key=lambda c: c['start']):
+                show(child, depth + 1)
+            if elided:
+                print(f"  {'':9} {sum(c['duration_ms'] for c in elided):9.1f} |{'':<{width}}| {'  ' * (depth + 1)}"
+                      f"... {len(elided)} faster spans", file=out)
+        show(root, 0)
+        print(file=out)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collect spans or print a waterfall of the slowest traces.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    collector = commands.add_parser('collect', help="receive spans over UDP and append them to a file")
+    collector.add_argument('--port', type=int, default=COLLECTOR_PORT)
+    collector.add_argument('--output', default='spans.jsonl')
+    viewer = commands.add_parser('waterfall', help="print the span tree of the slowest traces in a span file")
+    viewer.add_argument('path')
+    viewer.add_argument('-n', '--slowest', type=int, default=5, help="number of traces to print")
+    viewer.add_argument('--name', help="only consider traces whose root span has this name, e.g. client.download")
+    viewer.add_argument('--max-children', type=int, default=WATERFALL_CHILDREN, help="slowest children drawn per span")
+    args = parser.parse_args()
+    try:
+        if args.command == 'collect':
+            collect(args.port, args.output)
+        else:
+            waterfall(args.path, args.slowest, args.name, args.max_children)
+    except KeyboardInterrupt:
+        pass
@@ -1,28 +1,112 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS  # Import CORS
 from flask import send_file
-from client import Client
+from client import Client, READ_WORKERS
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import os
+import sys
+import queue
+import threading
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for the Flask app
 CORS(app, resources={r"/*": {"origins": "*"}})
-client = Client()
 
 UPLOAD_FOLDER = 'tmp/uploads'  # Change this to your preferred path
+GATEWAY_HOST = os.environ.get('GFS_GATEWAY_HOST', '127.0.0.1')  # Address to listen on; '0.0.0.0' exposes the gateway on every interface
+GATEWAY_PORT = 7083
+GATEWAY_WORKERS = int(os.environ.get('GFS_GATEWAY_WORKERS', 4))  # Worker processes in production mode
+GATEWAY_THREADS = int(os.environ.get('GFS_GATEWAY_THREADS', 32))  # Request threads per worker
+GATEWAY_MAX_CONCURRENCY = int(os.environ.get('GFS_GATEWAY_MAX_CONCURRENCY', 32))  # Pooled clients per worker for file transfers
+GATEWAY_QUEUE_TIMEOUT = float(os.environ.get('GFS_GATEWAY_QUEUE_TIMEOUT', 0.05))  # Max wait for a pooled transfer client
+GATEWAY_METADATA_CLIENTS = int(os.environ.get('GFS_GATEWAY_METADATA_CLIENTS', 4))  # Pooled clients per worker for metadata calls
+GATEWAY_RPC_TIMEOUT = float(os.environ.get('GFS_GATEWAY_RPC_TIMEOUT', 5))  # Socket timeout for master/chunk calls
+
+
+class GatewayBusy(Exception):
+    """Raised when no pooled client becomes free within the queue timeout."""
+
+
+class ClientPool:
+    """Thread-safe pool of Client instances shared by the request threads of one worker.
+
+    The pool size doubles as a concurrency limit: a request that cannot check out a
+    client within queue_timeout is shed with a 503 instead of queueing without bound.
+    Transfers and metadata calls use separate pools, so uploads holding every transfer
+    client never delay listings. All clients of a worker share one chunk read executor.
+    """
+
+    def __init__(self, size, rpc_timeout, queue_timeout):
+        self.size = size
+        self.rpc_timeout = rpc_timeout
+        self.queue_timeout = queue_timeout
+        self.pid = None
+        self.lock = threading.Lock()
+        self.clients = None
+
+    def _ensure_pool(self):
+        # Pre-fork servers import this module once and then fork, so each worker builds its own pool
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.clients = queue.Queue()
+                    for _ in range(self.size):
+                        self.clients.put(Client(timeout=self.rpc_timeout, read_pool=worker_read_pool()))
+                    self.pid = os.getpid()
+
+    @contextmanager
+    def client(self):
+        """Check out a client for the duration of a request."""
+        self._ensure_pool()
+        try:
+            pooled = self.clients.get(timeout=self.queue_timeout)
+        except queue.Empty:
+            raise GatewayBusy(f"All {self.size} gateway clients are busy")
+        try:
+            yield pooled
+        finally:
+            self.clients.put(pooled)
+
+
+read_pools = {}  # Chunk read executor of each worker process: {pid: ThreadPoolExecutor}
+read_pools_lock = threading.Lock()
+
+
+def worker_read_pool():
+    """Return the chunk read executor shared by every pooled client of this worker process."""
+    with read_pools_lock:
+        if os.getpid() not in read_pools:
+            read_pools[os.getpid()] = ThreadPoolExecutor(max_workers=READ_WORKERS)
+        return read_pools[os.getpid()]
+
+
+client_pool = ClientPool(GATEWAY_MAX_CONCURRENCY, GATEWAY_RPC_TIMEOUT, GATEWAY_QUEUE_TIMEOUT)  # Uploads and downloads
+# Metadata calls are short, so they may wait for a client rather than be shed after GATEWAY_QUEUE_TIMEOUT
+metadata_pool = ClientPool(GATEWAY_METADATA_CLIENTS, GATEWAY_RPC_TIMEOUT, GATEWAY_RPC_TIMEOUT)
+
+
+@app.errorhandler(GatewayBusy)
+def handle_gateway_busy(e):
+    return jsonify({"status": "error", "message": str(e)}), 503
 
 @app.route('/storage_used', methods=['GET'])
 def get_storage_used():
-    """Calculate and return the total storage used in UPLOAD_FOLDER."""
-    print("Calculating storage used...")
+    """Return the storage counters maintained by the master."""
     try:
-        total_size = 0
-        for filename in os.listdir(UPLOAD_FOLDER):
-            filepath = os.path.join(UPLOAD_FOLDER, filename)
-            if os.path.isfile(filepath):
-                total_size += os.path.getsize(filepath)
-        
-        return jsonify({"status": "success", "storageUsed": total_size})
+        with metadata_pool.client() as client:
+            usage = client.storage_usage()
+        if usage.get('status') != 'success':
+            return jsonify({"status": "failure", "message": usage.get('message')}), 502
+        return jsonify({
+            "status": "success",
+            "storageUsed": usage['total_bytes'],
+            "replicaBytes": usage['replica_bytes'],
+            "numFiles": usage['num_files'],
+            "servers": {str(server): used for server, used in usage['servers'].items()},
+        })
+    except GatewayBusy:
+        raise
     except Exception as e:
         print("Error calculating storage used:", e)
         return jsonify({"status": "failure", "message": str(e)}), 500
@@ -42,8 +126,11 @@ def upload_file():
     
     try:
         file.save(filepath)  # Save the uploaded file
-        response = client.upload_file(filepath)  # Process the file in the client
-        return jsonify(response)
+        with client_pool.client() as client:
+            response = client.upload_file(filepath)  # Process the file in the client
+        return jsonify({**response, "fileName": file.filename, "fileSize": os.path.getsize(filepath)})
+    except GatewayBusy:
+        raise
     except Exception as e:
         print("Error saving file:", e)
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -68,19 +155,24 @@ def download_file():
 
 @app.route('/list_files', methods=['GET'])
 def list_files():
-    """HTTP endpoint to list files in the upload directory."""
+    """HTTP endpoint returning one page of file metadata from the master."""
     try:
-        files = []
-        for filename in os.listdir(UPLOAD_FOLDER):
-            filepath = os.path.join(UPLOAD_FOLDER, filename)
-            if os.path.isfile(filepath):
-                files.append({
-                    "name": filename,
-                    "size": os.path.getsize(filepath),
-                    "lastModified": os.path.getmtime(filepath)  # Unix timestamp of last modification
-                })
-        print("Retrieved file list (HTTP):", files)
-        return jsonify({"status": "success", "files": files})
+        cursor = request.args.get('cursor')
+        limit = request.args.get('limit', type=int)
+        with metadata_pool.client() as client:
+            # Uploads are stored under their gateway path, so list only that directory
+            stats = client.file_stats(UPLOAD_FOLDER.rstrip('/') + '/', cursor, limit)
+        if stats.get('status') != 'success':
+            return jsonify({"status": "error", "message": stats.get('message')}), 502
+        files = [{
+            "name": os.path.basename(info['name']),
+            "size": info['size'],
+            "lastModified": info['mtime'],  # Unix timestamp of the upload
+            "replicas": info['replicas'],
+        } for info in stats['files']]
+        return jsonify({"status": "success", "files": files, "nextCursor": stats['next_cursor']})
+    except GatewayBusy:
+        raise
     except Exception as e:
         print("Error retrieving file list (HTTP):", e)
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -94,8 +186,13 @@ def lease_file():
     
     # Call the Client lease function
     try:
-        client.lease_file(filename)
+        with metadata_pool.client() as client:
+            response = client.lease_file(filename)
+        if response.get('status') != 'success':
+            return jsonify({"status": "failure", "message": response.get('message')}), 409
         return jsonify({"status": "success", "message": f"Lease granted for {filename}"})
+    except GatewayBusy:
+        raise
     except Exception as e:
         print("Error leasing file:", e)
         return jsonify({"status": "failure", "message": str(e)}), 500
@@ -109,12 +206,51 @@ def unlease_file():
     
     # Call the Client unlease function
     try:
-        client.unlease_file(filename)
+        with metadata_pool.client() as client:
+            response = client.unlease_file(filename)
+        if response.get('status') != 'success':
+            return jsonify({"status": "failure", "message": response.get('message')}), 409
         return jsonify({"status": "success", "message": f"Lease released for {filename}"})
+    except GatewayBusy:
+        raise
     except Exception as e:
         print("Error releasing lease:", e)
         return jsonify({"status": "failure", "message": str(e)}), 500
 
 
+def serve_production():
+    """Serve the app with a multi-worker WSGI server, falling back to the threaded dev server."""
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        BaseApplication = None
+
+    if BaseApplication is not None:
+        class GatewayApplication(BaseApplication):
+            def load_config(self):
+                self.cfg.set('bind', f'{GATEWAY_HOST}:{GATEWAY_PORT}')
+                self.cfg.set('workers', GATEWAY_WORKERS)
+                self.cfg.set('worker_class', 'gthread')
+                self.cfg.set('threads', GATEWAY_THREADS)
+                self.cfg.set('timeout', int(GATEWAY_RPC_TIMEOUT * 6))
+
+            def load(self):
+                return app
+
+        GatewayApplication().run()
+        return
+
+    try:
+        from waitress import serve
+    except ImportError:
+        print("gunicorn/waitress not installed, using the threaded Flask server")
+        app.run(host=GATEWAY_HOST, port=GATEWAY_PORT, threaded=True)
+        return
+    serve(app, host=GATEWAY_HOST, port=GATEWAY_PORT, threads=GATEWAY_THREADS)
+
+
 if __name__ == "__main__":
-    app.run(port=7083)
+    if '--dev' in sys.argv:
+        app.run(host=GATEWAY_HOST, port=GATEWAY_PORT)
+    else:
+        serve_production()